@@ -1,12 +1,21 @@
 
+import copy
+import itertools
+import logging
+
 from pydicom.dataset import Dataset
-import yaml
+from pydicom.multival import MultiValue
 
-from pseudonym_clients import MIIClient, gPASClient
+import metrics
+import settings
+import tracing
+import workers
+from pseudonym_clients import MIIClient, gPASClient, PseudonymizationError, UnknownPseudonym
+from pseudonym_index import PseudonymIndex, is_wildcard
+from settings import config
+from shared_cache import read_mappings
 
-with open("configs/config.yml")as f:
-    config = yaml.safe_load(f)
-    pseudonym_config = config["PSEUDONYMIZATION_SERVER"]
+pseudonym_config = config["PSEUDONYMIZATION_SERVER"]
 
 
 class Anonymizer:
@@ -19,28 +28,103 @@ class Anonymizer:
                 self.pseudonym_client = MIIClient()
             case _:
                 raise Exception(f"No such CLIENT_TYPE={client_version} is supported!")
-            
+
+        self.configure()
+        settings.on_reload(self.configure)
+
+        # Issued pseudonyms, for wildcard queries. The index is not shared, with several workers each would answer
+        # the same query differently.
+        self.wildcards = workers.count == 1
+        self.index = PseudonymIndex(config.get("PSEUDONYM_INDEX_SIZE", 1000000) if self.wildcards else 0)
+        if self.wildcards and pseudonym_config.get("CACHE_WARM_START"):
+            try:
+                for original, pseudonym in read_mappings(pseudonym_config["CACHE_WARM_START"]):
+                    self.index.add(None, pseudonym, original)
+            except OSError as e:
+                logging.warning(f"Could not load the pseudonym index: {e}")
+
+    def configure(self, changed=None):
+        """Applies the field lists and limits of the (reloaded) config"""
         # Fields that will be swapped by pseudonym value
         self.pseudonymize_fields = config["FIELDS_FOR_PSEUDO"]
 
         # Fields that will be cleared
         self.anonymize_fields = config["FIELDS_FOR_REMOVAL"]
 
-
+        self.max_query_expansion = config.get("MAX_QUERY_EXPANSION", 100)
 
     def shield_query(self, dataset):
-        dataset = self._anonymize(dataset)
-        dataset = self._depseudonymize(dataset)
+        with metrics.ANONYMIZATION_SECONDS.time(operation="query"), tracing.span("shield_query"):
+            dataset = self._anonymize(dataset)
+            dataset = self._depseudonymize(dataset)
         return dataset
     
+    def shield_find(self, dataset):
+        """Like shield_query for C-FIND identifiers, which may use wildcard or list matching on pseudonymized fields.
+
+        Patterns are resolved with the index of issued pseudonyms. Returns the identifiers to query upstream: UIDs
+        matching several originals become a list of UIDs, other fields one identifier per original. Returns [] if no
+        known pseudonym matches.
+        """
+        with metrics.ANONYMIZATION_SECONDS.time(operation="query"), tracing.span("shield_query"):
+            dataset = self._anonymize(dataset)
+            resolved = {}
+            for attr in self.pseudonymize_fields:
+                if attr not in dataset or dataset[attr].value in ("", None):
+                    continue
+                values = self._values(dataset[attr].value)
+                if "*" in values:
+                    setattr(dataset, attr, "")  # Universal matching
+                    continue
+
+                exact = [value for value in values if not is_wildcard(value)]
+                if len(exact) < len(values) and not self.wildcards:
+                    raise PseudonymizationError(f"Wildcard matching on {attr} needs a single worker process")
+                found = self.pseudonym_client.depseudonomize(dict(enumerate(exact)))
+                originals = [found[value] for value in exact if value in found]
+                for pseudonym in exact:
+                    if pseudonym in found:
+                        self.index.add(attr, pseudonym, found[pseudonym])
+                for pattern in values:
+                    if is_wildcard(pattern):
+                        originals.extend(self.index.match(attr, pattern).values())
+                if not originals:
+                    logging.info(f"No known pseudonym matches {attr}={dataset[attr].value}")
+                    return []
+                resolved[attr] = list(dict.fromkeys(originals))
+
+            split = {}
+            for attr, originals in resolved.items():
+                if len(originals) == 1 or dataset[attr].VR == "UI":
+                    setattr(dataset, attr, originals if len(originals) > 1 else originals[0])
+                else:
+                    split[attr] = originals  # List matching is defined for UIDs only
+
+            combinations = list(itertools.product(*split.values()))
+            if len(combinations) > self.max_query_expansion:
+                raise PseudonymizationError(f"Query matches {len(combinations)} pseudonyms, "
+                                            f"more than MAX_QUERY_EXPANSION={self.max_query_expansion}")
+            identifiers = []
+            for combination in combinations:
+                identifier = copy.deepcopy(dataset)
+                for attr, original in zip(split, combination):
+                    setattr(identifier, attr, original)
+                identifiers.append(identifier)
+        return identifiers
+
     def shield_retrieve(self, dataset):
-        dataset = self._anonymize(dataset)
-        dataset = self._pseudonymize(dataset)
+        with metrics.ANONYMIZATION_SECONDS.time(operation="retrieve"), tracing.span("shield_retrieve"):
+            dataset = self._anonymize(dataset)
+            dataset = self._pseudonymize(dataset)
         return dataset
     
     
     def shield_store(self, dataset):
         return dataset
+
+    def shield_capture(self, dataset):
+        """Clears FIELDS_FOR_REMOVAL of a request identifier for the capture, pseudonyms are kept"""
+        return self._anonymize(dataset)
     
 
     def _anonymize(self, dataset: Dataset):
@@ -63,7 +147,11 @@ class Anonymizer:
         pseudo_attrs = self.pseudonym_client.pseudonomize(to_pseudo_attrs)
 
         for attr in to_pseudo_attrs:
-            val = str(pseudo_attrs.get(to_pseudo_attrs[attr], None))
+            val = pseudo_attrs.get(str(to_pseudo_attrs[attr]))
+            if val is None:
+                # Never hand out the original value
+                raise PseudonymizationError(f"No pseudonym was returned for {attr}")
+            self.index.add(attr, val, str(to_pseudo_attrs[attr]))
             setattr(dataset, attr, val)
 
         return dataset
@@ -74,12 +162,23 @@ class Anonymizer:
             if attr in dataset:
                 value = getattr(dataset, attr)
                 if value == "": continue
-                to_depseudo_attrs[attr] = value
+                to_depseudo_attrs[attr] = self._values(value)
 
-        depseudo_attrs = self.pseudonym_client.depseudonomize(to_depseudo_attrs)
+        pseudonyms = [value for values in to_depseudo_attrs.values() for value in values]
+        depseudo_attrs = self.pseudonym_client.depseudonomize(dict(enumerate(pseudonyms)))
 
-        for attr in to_depseudo_attrs:
-            val = str(depseudo_attrs.get(to_depseudo_attrs[attr], None))
-            setattr(dataset, attr, val)
+        for attr, values in to_depseudo_attrs.items():
+            if any(value not in depseudo_attrs for value in values):
+                # Unknown pseudonym or rejected request, never query upstream with a placeholder
+                raise UnknownPseudonym(f"No original value was returned for {attr}")
+            originals = [str(depseudo_attrs[value]) for value in values]
+            for pseudonym, original in zip(values, originals):
+                self.index.add(attr, pseudonym, original)
+            setattr(dataset, attr, originals if len(originals) > 1 else originals[0])
+
+        return dataset
 
-        return dataset
\ No newline at end of file
+    @staticmethod
+    def _values(value):
+        """The values of a (possibly multi-valued) element as strings"""
+        return [str(item) for item in value] if isinstance(value, MultiValue) else [str(value)]
\ No newline at end of file
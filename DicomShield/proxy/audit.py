@@ -0,0 +1,225 @@
+"""Audit log of which caller received which pseudonymized patients and studies.
+
+Handlers only append a tuple to an in-memory ring buffer; a background thread writes the buffered events in batches
+(one write and fsync per batch) to an append-only JSON lines file, rotated by size:
+    {"t": unix time, "caller": calling AE title or DICOMweb client address, "op": "find" | "get" | "move" | "qido" |
+     "wado", "keys": {"PatientID": [...], "StudyInstanceUID": [...]}, "n": number of results or instances}
+
+If the writer falls behind by more than BUFFER events, the oldest are dropped (dicomshield_audit_dropped_total).
+Buffered events are written before the process exits, also on SIGTERM.
+The ingest rate can be measured with
+    python audit.py --rate 10000 --seconds 10
+"""
+import argparse
+import atexit
+import functools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# Pseudonymized attributes recorded per event
+KEYS = ("PatientID", "StudyInstanceUID")
+PENDING = (0xFF00, 0xFF01)
+
+_log = None
+
+
+class Tally:
+    """Pseudonymized keys and number of the datasets sent to a caller"""
+
+    def __init__(self):
+        self.count = 0
+        self.keys = {}
+
+    def add(self, ds):
+        self.count += 1
+        for keyword in KEYS:
+            value = ds.get(keyword)
+            if value:
+                self.keys.setdefault(keyword, set()).add(str(value))
+
+
+class AuditLog:
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backups=10, buffer_size=65536, batch_size=4096,
+                 interval=1, fsync=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self._buffer = deque(maxlen=buffer_size)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        threading.Thread(target=self._run, name="audit-writer", daemon=True).start()
+
+    def record(self, caller, operation, keys, count):
+        buffer = self._buffer
+        if len(buffer) == buffer.maxlen:
+            metrics.AUDIT_DROPPED_TOTAL.inc()
+        buffer.append((time.time(), caller, operation, keys, count))
+        if len(buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            while self._buffer:
+                self._write(self._take())
+
+    def _take(self):
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _write(self, batch):
+        lines = []
+        for t, caller, operation, keys, count in batch:
+            entry = {"t": round(t, 3), "caller": caller, "op": operation,
+                     "keys": {keyword: sorted(values) for keyword, values in keys.items()}, "n": count}
+            lines.append(json.dumps(entry, separators=(",", ":")))
+        data = ("\n".join(lines) + "\n").encode()
+        try:
+            if self._file.tell() and self._file.tell() + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            metrics.AUDIT_WRITTEN_TOTAL.inc(len(batch))
+        except OSError as e:
+            metrics.AUDIT_DROPPED_TOTAL.inc(len(batch))
+            logging.error(f"Could not write {len(batch)} audit events to {self.path}: {e}")
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.truncate(self.path, 0)
+        self._file = open(self.path, "ab")
+
+    def pending(self):
+        return len(self._buffer)
+
+
+def configure(entry, path):
+    global _log
+    _log = AuditLog(path, entry.get("MAX_BYTES", 100 * 1024 * 1024), entry.get("BACKUPS", 10),
+                    entry.get("BUFFER", 65536), interval=entry.get("FLUSH_INTERVAL", 1), fsync=entry.get("FSYNC", True))
+    metrics.AUDIT_PENDING.set_function(_log.pending)
+    atexit.register(_log.flush)
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def terminate(signum, frame):
+        _log.flush()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    logging.info(f"Writing the audit log to {path}")
+
+
+def record(caller, operation, tally: Tally):
+    if _log is not None:
+        _log.record(caller, operation, tally.keys, tally.count)
+
+
+def audited(operation):
+    """Decorator for pynetdicom handlers that records the datasets sent with Pending statuses"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(event, *args, **kwargs):
+            if _log is None:
+                yield from function(event, *args, **kwargs)
+                return
+            tally = Tally()
+            results = function(event, *args, **kwargs)
+            try:
+                for item in results:
+                    if type(item) is tuple and len(item) == 2 and item[0] in PENDING and item[1] is not None:
+                        tally.add(item[1])
+                    yield item
+            finally:
+                results.close()
+                record(event.assoc.requestor.ae_title, operation, tally)
+        return wrapper
+    return decorator
+
+
+def counted(instances, tally: Tally):
+    """Yields from `instances`, adding each to `tally`"""
+    for ds in instances:
+        tally.add(ds)
+        yield ds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures the ingest rate of the audit log")
+    parser.add_argument("--rate", type=int, default=10000, help="events per second, 0 for as fast as possible")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--file", default="audit-benchmark.jsonl")
+    args = parser.parse_args()
+
+    log = AuditLog(args.file)
+    tally = Tally()
+    tally.keys = {"PatientID": {"PSN0123456789"}, "StudyInstanceUID": {"2.25.123456789012345678901234567890"}}
+    tally.count = 42
+    latencies = [[] for _ in range(args.threads)]
+
+    def produce(index):
+        interval = args.threads / args.rate if args.rate else 0
+        start = time.perf_counter()
+        deadline = start + args.seconds
+        sent = 0
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if interval and now < start + sent * interval:
+                time.sleep(start + sent * interval - now)
+            before = time.perf_counter()
+            log.record("BENCHMARK", "find", tally.keys, tally.count)
+            latencies[index].append(time.perf_counter() - before)
+            sent += 1
+
+    started = time.perf_counter()
+    producers = [threading.Thread(target=produce, args=(i,)) for i in range(args.threads)]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    elapsed = time.perf_counter() - started
+    log.flush()
+    drained = time.perf_counter() - started
+
+    recorded = sorted(latency for thread in latencies for latency in thread)
+    percentile = lambda p: recorded[min(len(recorded) - 1, int(p * len(recorded)))] * 1e6
+    print(f"{len(recorded)} events in {elapsed:.2f}s ({len(recorded) / elapsed:.0f}/s), written after {drained:.2f}s")
+    print(f"record() p50 {percentile(0.5):.1f} µs | p99 {percentile(0.99):.1f} µs | max {recorded[-1] * 1e6:.1f} µs")
+    with open(args.file, "rb") as f:
+        written = sum(1 for _ in f)
+    print(f"{written} lines, {os.path.getsize(args.file) / 1e6:.1f} MB in {args.file}")
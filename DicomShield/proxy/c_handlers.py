@@ -1,48 +1,141 @@
+import copy
+import itertools
 import logging
+import threading
 import time
+from queue import Empty, Queue
 from typing import Tuple
 
-from pydicom.uid import XRayAngiographicImageStorage
+from pydicom.uid import (
+    UID,
+    XRayAngiographicImageStorage,
+    ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian,
+    DeflatedExplicitVRLittleEndian,
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+    JPEG2000Lossless,
+    JPEG2000,
+    RLELossless,
+)
 from pynetdicom.events import Event
-from pynetdicom import AE, evt, AllStoragePresentationContexts, build_role
+from pynetdicom import AE, evt, AllStoragePresentationContexts, build_role, build_context
 from pynetdicom.sop_class import (
     StudyRootQueryRetrieveInformationModelGet,
     StudyRootQueryRetrieveInformationModelFind,
     StudyRootQueryRetrieveInformationModelMove,
     PatientRootQueryRetrieveInformationModelFind,
     PatientRootQueryRetrieveInformationModelMove,
+    PatientRootQueryRetrieveInformationModelGet,
     MRImageStorage,
     CTImageStorage,
     OphthalmicThicknessMapStorage
 )
 
 from pydicom import Dataset
-import yaml
-
-from utils import shared_queue, shield_anonymizer
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
-with open("configs/config.yml") as f:
-    config = yaml.safe_load(f)
+import audit
+import capture
+import log
+import metrics
+from cancellation import Cancellation, stop_upstream
+import tracing
+import transcoding
+import upstreams
+import workers
+from pseudonym_clients import PseudonymizationError
+from settings import config
+from upstreams import UpstreamBusy
+from utils import pending_moves, shield_anonymizer
 
 retrieveMoveMap = {
     "STUDY": StudyRootQueryRetrieveInformationModelMove,
     "SERIES": StudyRootQueryRetrieveInformationModelMove,
     "INSTANCES": StudyRootQueryRetrieveInformationModelMove,
+    "IMAGE": StudyRootQueryRetrieveInformationModelMove,
     "PATIENT": PatientRootQueryRetrieveInformationModelMove,
 }
 
+retrieveGetMap = {
+    "STUDY": StudyRootQueryRetrieveInformationModelGet,
+    "SERIES": StudyRootQueryRetrieveInformationModelGet,
+    "IMAGE": StudyRootQueryRetrieveInformationModelGet,
+    "PATIENT": PatientRootQueryRetrieveInformationModelGet,
+}
+
+# Storage SOP classes we accept from upstream via C-GET. If we select all, we get > 128 presentation contexts
+retrieveStorageClasses = [MRImageStorage, CTImageStorage, XRayAngiographicImageStorage, OphthalmicThicknessMapStorage]
+
+# Compressed transfer syntaxes negotiated for storage besides the uncompressed ones. Encapsulated pixel data is
+# passed through as received, only the header is pseudonymized
+uncompressedTransferSyntaxes = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+compressedTransferSyntaxes = [UID(uid) for uid in config.get("TRANSFER_SYNTAXES", [
+    JPEGLSLossless, JPEG2000Lossless, RLELossless, JPEGLosslessSV1, JPEGLSNearLossless, JPEG2000,
+    JPEGBaseline8Bit, JPEGExtended12Bit, DeflatedExplicitVRLittleEndian])]
+
+# pynetdicom accepts the first of its transfer syntaxes that the requestor offers in a context. The ingress sends
+# C-GET sub-operations and prefers uncompressed: an instance can always be decompressed for an uncompressed context
+# (for_association), but an uncompressed or differently compressed instance cannot be sent over a context that
+# accepted one compressed syntax. C-GET clients that want encapsulated pixel data offer each compressed syntax in a
+# context of its own, like storage_contexts does, and receive it passed through. The internal Store SCP receives and
+# prefers the encapsulated syntaxes. Deflate costs CPU on both ends and comes last.
+ingressTransferSyntaxes = uncompressedTransferSyntaxes + compressedTransferSyntaxes
+internalTransferSyntaxes = ([uid for uid in compressedTransferSyntaxes if uid.is_compressed] +
+                            uncompressedTransferSyntaxes +
+                            [uid for uid in compressedTransferSyntaxes if not uid.is_compressed])
+
+# Presentation contexts left for storage SOP classes next to the query/retrieve contexts of handle_event
+MAX_STORAGE_CONTEXTS = 120
+
+# Bytes of the SOP Instance UID list of one C-GET identifier: Explicit VR limits UI values to 64 KB
+MAX_UID_LIST_BYTES = 32768
+
+# "MOVE": the upstream PACS sends C-STORE sub-operations to run_internal_server (C_STORE_ENDPOINT)
+# "GET": instances are fetched with C-GET over the upstream association itself
+retrieve_mode = config.get("RETRIEVE_MODE", "MOVE")
+
+# Unique key of each query/retrieve level
+LEVEL_KEYS = {
+    "PATIENT": "PatientID",
+    "STUDY": "StudyInstanceUID",
+    "SERIES": "SeriesInstanceUID",
+    "IMAGE": "SOPInstanceUID",
+}
+
 retrieveFindMap = {
     "STUDY": StudyRootQueryRetrieveInformationModelFind,
     "SERIES": StudyRootQueryRetrieveInformationModelFind,
     "PATIENT": PatientRootQueryRetrieveInformationModelFind,
+    "IMAGE": StudyRootQueryRetrieveInformationModelFind,
 }
 
+# pynetdicom sends C-FIND/C-GET requests with this Message ID unless told otherwise
+UPSTREAM_MESSAGE_ID = 1
+
+
+class UpstreamFailure(Exception):
+    """The upstream failed a C-MOVE without any sub-operation"""
+
+
+# Message IDs of upstream C-MOVEs, the PACS echoes them as MoveOriginatorMessageID in its C-STORE sub-operations
+_move_message_ids = itertools.count()
+
+
+def next_move_message_id():
+    # Tells which worker process issued the C-MOVE, see workers.py
+    return workers.move_message_id(next(_move_message_ids))
+
+
+def trace_request(event: Event):
+    """Annotates the current (ingress) span with the identity of the request"""
+    span = tracing.current_span()
+    span.set_attribute("dicom.calling_aet", event.assoc.requestor.ae_title)
+    span.set_attribute("dicom.message_id", event.request.MessageID)
+    span.set_attribute("dicom.query_level", event.identifier.get("QueryRetrieveLevel", ""))
+
 
 # def handle_store(event):
 #     """Callback function to handle and forward C-STORE."""
@@ -75,20 +168,99 @@ retrieveFindMap = {
 
 
 def handle_store(event):
-    """Callback function to handle and forward C-STORE."""
-    logging.info(f"store(...) was called: {event}")
-    dataset = event.dataset
-    dataset.file_meta = event.file_meta
+    """Refuses C-STORE requests outside of C-GET/C-MOVE retrievals: DicomShield only forwards instances to clients
+    that retrieved them, it does not store any."""
+    log.event("store.refused", logging.WARNING, calling_aet=event.assoc.requestor.ae_title,
+              sop_instance_uid=event.request.AffectedSOPInstanceUID)
+    return 0x0124  # Refused: Not authorized
 
-    # Perform anonymization
-    anonymized_ds = shield_anonymizer.shield_store(dataset)
 
-    shared_queue.put(anonymized_ds)
-    logging.info(f"dataset was put in the queue {event}")
-    return 0x0000
+def storage_contexts(sop_classes, transfer_syntaxes=None):
+    """Presentation contexts for `sop_classes`: an uncompressed one per SOP class, then one per compressed transfer
+    syntax, since an acceptor picks a single transfer syntax per context. Limited to the 128 contexts of an
+    association, compressed contexts are dropped first.
+    """
+    contexts = [build_context(sop_class, uncompressedTransferSyntaxes) for sop_class in sop_classes]
+    for transfer_syntax in compressedTransferSyntaxes if transfer_syntaxes is None else transfer_syntaxes:
+        contexts.extend(build_context(sop_class, transfer_syntax) for sop_class in sop_classes)
+    return contexts[:128]
+
+
+def outbound_contexts(datasets, compress_syntax=None):
+    """Presentation contexts for sending `datasets` to a move destination, first those of its COMPRESS policy"""
+    sop_classes = sorted({ds.SOPClassUID for ds in datasets})
+    transfer_syntaxes = {ds.file_meta.TransferSyntaxUID for ds in datasets} - set(uncompressedTransferSyntaxes)
+    return storage_contexts(sop_classes, policy_first(sorted(transfer_syntaxes), compress_syntax))
+
+
+def policy_first(transfer_syntaxes, compress_syntax):
+    """`transfer_syntaxes` with `compress_syntax` moved to the front, so its contexts are not dropped"""
+    if compress_syntax is None:
+        return transfer_syntaxes
+    return [compress_syntax] + [uid for uid in transfer_syntaxes if uid != compress_syntax]
+
+
+def move_destination(target, contexts):
+    """C-MOVE destination as yielded to pynetdicom, for an ALLOWED_AET entry ([ip, port] or {IP, PORT, ...}).
+    The returned list receives the outbound association once it is established (see destinations.PooledAE), to check
+    its accepted transfer syntaxes with for_association."""
+    store_assoc = []
+    kwargs = {"contexts": contexts, "on_association": store_assoc.append}
+    return (*destination_address(target), kwargs), store_assoc
+
+
+def destination_address(target):
+    if isinstance(target, dict):
+        return target["IP"], target["PORT"]
+    return target[0], target[1]
+
+
+def accepts(assoc, sop_class, transfer_syntax):
+    return any(cx.abstract_syntax == sop_class and cx.transfer_syntax[0] == transfer_syntax
+               for cx in assoc.accepted_contexts)
+
+
+def for_destination(datasets, target, store_assoc):
+    """`datasets` compressed according to the COMPRESS policy of the move destination, see transcoding.py"""
+    compress_syntax = transcoding.transfer_syntax(target)
+    if compress_syntax is None:
+        return datasets
+
+    def accepted(ds):
+        return bool(store_assoc) and accepts(store_assoc[0], ds.SOPClassUID, compress_syntax)
+    return transcoding.compressed(datasets, compress_syntax, accepted)
+
+
+def for_association(ds: Dataset, assoc):
+    """`ds` as it can be sent over `assoc`: unchanged if a context accepted its transfer syntax, else decompressed.
+
+    Uncompressed and deflated syntaxes are converted by pynetdicom itself.
+    """
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if assoc is None or not transfer_syntax.is_compressed:
+        return ds
+    if accepts(assoc, ds.SOPClassUID, transfer_syntax):
+        return ds
+
+    logging.info(f"Destination does not accept {transfer_syntax.name}, decompressing {ds.SOPInstanceUID}")
+    return decompress(ds)
+
+
+def decompress(ds: Dataset):
+    """Decompresses `ds` in place to Explicit VR Little Endian, returns it unchanged if that fails"""
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    try:
+        ds.decompress()
+    except Exception as e:
+        # No pixel data handler for the syntax installed, the C-STORE sub-operation will fail
+        logging.error(f"Failed to decompress {ds.SOPInstanceUID} ({transfer_syntax.name}): {e}")
+        return ds
+    metrics.DECOMPRESSED_TOTAL.inc()
+    return ds
 
 
-def handle_event(dataset: Dataset, event_context, action="FIND"):
+def handle_event(dataset: Dataset, event_context, action="FIND", evt_handlers=None, storage_classes=None,
+                 upstream=None, parent=None):
     if 'QueryRetrieveLevel' not in dataset:
         raise Exception("QueryRetrieveLevel not valid")
     queryRetrieveLevel = dataset.QueryRetrieveLevel
@@ -98,29 +270,38 @@ def handle_event(dataset: Dataset, event_context, action="FIND"):
             queryRetrieveLevel = retrieveFindMap.get(queryRetrieveLevel)
         case "MOVE" | "MOVE_SCP":
             queryRetrieveLevel = retrieveMoveMap.get(queryRetrieveLevel)
+        case "GET":
+            queryRetrieveLevel = retrieveGetMap.get(queryRetrieveLevel)
 
     # Create an identical association for query retrieval
     ae = AE("DICOMSHIELD")
     ae.add_requested_context(event_context.abstract_syntax, event_context.transfer_syntax)
 
-    roles = []
-    for context in [MRImageStorage, CTImageStorage, XRayAngiographicImageStorage,
-                    OphthalmicThicknessMapStorage]:  # If we select all, we get > 128
-        ae.add_requested_context(context)
-        roles.append(build_role(context, scp_role=True))
+    if storage_classes is None:
+        storage_classes = retrieveStorageClasses
+    for context in storage_contexts(storage_classes)[:MAX_STORAGE_CONTEXTS]:
+        ae.add_requested_context(context.abstract_syntax, context.transfer_syntax)
+    roles = [build_role(sop_class, scp_role=True) for sop_class in storage_classes]
 
     ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
+    ae.add_requested_context(PatientRootQueryRetrieveInformationModelGet)
     ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
     ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
     ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
     ae.add_requested_context(PatientRootQueryRetrieveInformationModelMove)
 
-    association = ae.associate(
-        config["UPSTREAM"]["IP"], config["UPSTREAM"]["PORT"],
-        ae_title=config["UPSTREAM"].get("AET", "ANY-SCP"),
-        evt_handlers=[(evt.EVT_C_STORE, handle_store)],
-        ext_neg=roles
-    )
+    upstream = upstream or upstreams.primary
+    with metrics.UPSTREAM_ASSOCIATION_SECONDS.time(), \
+            tracing.span("upstream.associate", parent=parent, kind="client", peer=upstream.ip, upstream=upstream.name):
+        try:
+            association = upstream.associate(
+                ae,
+                evt_handlers=evt_handlers or [(evt.EVT_C_STORE, handle_store)],
+                ext_neg=roles
+            )
+        except UpstreamBusy as e:
+            logging.warning(str(e))
+            return None
 
     if association.is_established:
         return association, queryRetrieveLevel
@@ -128,128 +309,614 @@ def handle_event(dataset: Dataset, event_context, action="FIND"):
         return None
 
 
+@tracing.traced("C-FIND", kind="server")
+@audit.audited("find")
+@log.summarized("find")
 def handle_find(event: Event):
     """Callback function to handle and forward C-FIND."""
-    identifier = event.identifier
-    ae = handle_event(identifier, event.context)
-
-    if ae is None:
+    metrics.REQUESTS_TOTAL.inc(operation="find")
+    capture.record(event, "find")
+    trace_request(event)
+    # First depseudonymize the identifier for internal querying, wildcards may expand it into several
+    try:
+        identifiers = shield_anonymizer.shield_find(event.identifier)
+    except PseudonymizationError as e:
+        logging.error(f"C-FIND rejected: {e}")
         yield 0xC000, None  # Failure
         return
-    else:
-        (assoc, queryRetrieveLevel) = ae
-
-    logging.info("Handling C-FIND request")
-    # First depseudonymize the identifier for internal querying
-    identifier: Dataset = shield_anonymizer.shield_query(identifier)
-    logging.info(f"Anonymized identifier for FIND: {identifier}")
-
-    # Forward the C-FIND request and yield results
-    responses = assoc.send_c_find(identifier, queryRetrieveLevel)
-
-    # Then re-pseudonomize the identifier for data return
-    for (status, identifier_resp) in responses:
-        if identifier_resp is not None:
-            identifier_resp = shield_anonymizer.shield_retrieve(identifier_resp)
-
-        yield status, identifier_resp
-
-    assoc.release()
-
-
+    if not identifiers:
+        return  # No pseudonym matches, nothing to ask upstream
+    log.dataset("Depseudonymized identifiers for C-FIND", identifiers)
+
+    with Cancellation(event) as cancellation:
+        results = fan_out_find(identifiers, event.context, cancellation)
+        try:
+            for identifier_resp in pseudonymized_results(results, identifiers[0].QueryRetrieveLevel, cancellation):
+                yield 0xFF00, identifier_resp  # Pending
+        except PseudonymizationError as e:
+            logging.error(f"C-FIND aborted: {e}")
+            yield 0xC000, None  # Failure
+            return
+
+    if cancellation.cancelled:
+        if not cancellation.disconnected:
+            yield 0xFE00, None  # Cancel
+        return
+    if not results.succeeded:
+        yield 0xC000, None  # Failure, no upstream answered
+
+
+def pseudonymized_results(results, level, cancellation):
+    """Yields the results of a fan_out_find re-pseudonymized, every entity once.
+
+    Stops with the cancellation; if a result cannot be pseudonymized, PseudonymizationError is raised. Either way,
+    and when the caller stops early, the C-FINDs still running are stopped.
+    """
+    # Upstreams may hold copies of the same objects
+    key = LEVEL_KEYS.get(level)
+    seen = set()
+    try:
+        for (upstream, identifier_resp) in results:
+            if cancellation.check():
+                return  # Remaining results are not pseudonymized anymore
+            if identifier_resp is None:
+                continue
+            upstreams.location_index.learn(upstream.name, identifier_resp)
+            if key is not None and key in identifier_resp:
+                if identifier_resp[key].value in seen:
+                    continue
+                seen.add(identifier_resp[key].value)
+
+            yield shield_anonymizer.shield_retrieve(identifier_resp)
+    finally:
+        results.close()
+
+
+class fan_out_find:
+    """Sends the C-FIND to all upstreams in parallel and yields (upstream, result) as they arrive.
+
+    `identifier` may be a list of identifiers, all of them are sent to every upstream, one after the other over up
+    to MAX_PARALLEL_FINDS associations per upstream. Upstreams that fail are skipped, `succeeded` tells afterwards
+    whether at least one of them answered.
+    """
+
+    def __init__(self, identifier, event_context, cancellation=None, targets=None):
+        self.targets = targets or upstreams.upstreams
+        identifiers = identifier if isinstance(identifier, list) else [identifier]
+        parallel = max(1, min(len(identifiers), config.get("MAX_PARALLEL_FINDS", 4)))  # reloadable
+        self.succeeded = False
+        self._results = Queue()
+        self._running = len(self.targets) * parallel
+        self._stop = threading.Event()
+        self._associations = []
+        if cancellation is not None:
+            # The C-CANCEL of stop_upstream only ends the running C-FIND, the remaining identifiers are not sent
+            cancellation.on_cancel(lambda disconnected: self._stop.set())
+        span = tracing.current_span()
+        for upstream in self.targets:
+            pending = Queue()
+            for identifier in identifiers:
+                pending.put(copy.deepcopy(identifier))
+            for _ in range(parallel):
+                threading.Thread(target=self._query, args=(upstream, pending, event_context, cancellation, span),
+                                 name="upstream-find", daemon=True).start()
+
+    def _query(self, upstream, pending, event_context, cancellation, span):
+        """Sends the identifiers of `pending` over one association with `upstream`"""
+        succeeded = False
+        try:
+            try:
+                identifier = pending.get_nowait()
+            except Empty:
+                return  # Taken by the other associations
+            result = handle_event(identifier, event_context, upstream=upstream, parent=span)
+            if result is None:
+                logging.warning(f"Failed to establish association with upstream '{upstream.name}' for C-FIND")
+                return
+            (assoc, queryRetrieveLevel) = result
+            self._associations.append(assoc)
+            if cancellation is not None:
+                cancellation.on_cancel(stop_upstream(assoc, UPSTREAM_MESSAGE_ID, queryRetrieveLevel))
+
+            while identifier is not None and not self._stop.is_set() and assoc.is_established:
+                with tracing.span("upstream.C-FIND", parent=span, kind="client", upstream=upstream.name):
+                    responses = metrics.UPSTREAM_REQUEST_SECONDS.time_iter(
+                        assoc.send_c_find(identifier, queryRetrieveLevel, msg_id=UPSTREAM_MESSAGE_ID),
+                        operation="find")
+                    for (status, identifier_resp) in responses:
+                        if self._stop.is_set() or not status:
+                            break
+                        if status.Status in (0xFF00, 0xFF01):
+                            self._results.put((upstream, identifier_resp))
+                        elif status.Status == 0x0000:
+                            succeeded = True
+                        else:
+                            logging.warning(f"C-FIND at upstream '{upstream.name}' failed: 0x{status.Status:04X}")
+                try:
+                    identifier = pending.get_nowait()
+                except Empty:
+                    identifier = None
+            if assoc.is_established:
+                assoc.release()
+        except Exception as e:
+            logging.error(f"C-FIND at upstream '{upstream.name}' failed: {e}")
+        finally:
+            self._results.put((upstream, succeeded))
+
+    def __iter__(self):
+        while self._running:
+            upstream, item = self._results.get()
+            if isinstance(item, bool):
+                self._running -= 1
+                self.succeeded |= item
+            else:
+                yield upstream, item
+
+    def close(self):
+        """Stops the C-FINDs still running"""
+        self._stop.set()
+        for assoc in self._associations:
+            if assoc.is_established:
+                assoc.abort()
+
+
+def locate(identifier: Dataset, event_context, cancellation=None):
+    """The upstream to retrieve `identifier` from.
+
+    With several upstreams the location index is consulted first. Unknown objects are looked up with a C-FIND at
+    all upstreams, which fills the index; if none holds them, the first upstream is asked.
+    """
+    if len(upstreams.upstreams) == 1:
+        return upstreams.primary
+    upstream = upstreams.route(identifier)
+    if upstream is None:
+        query = copy.deepcopy(identifier)
+        if query.QueryRetrieveLevel not in retrieveFindMap:
+            query.QueryRetrieveLevel = "STUDY"
+        for (found_at, identifier_resp) in fan_out_find(query, event_context, cancellation):
+            if identifier_resp is not None:
+                upstreams.location_index.learn(found_at.name, identifier_resp)
+        upstream = upstreams.route(identifier)
+    logging.info(f"Routing retrieve to upstream '{(upstream or upstreams.primary).name}'")
+    return upstream or upstreams.primary
+
+
+@tracing.traced("C-GET", kind="server")
+@audit.audited("get")
+@log.summarized("get")
 def handle_get(event: Event):
     """Callback function to handle and forward C-GET."""
-    identifier = event.identifier
-    ae = handle_event(identifier, event.context)
-
-    if ae is None:
+    metrics.REQUESTS_TOTAL.inc(operation="get")
+    capture.record(event, "get")
+    trace_request(event)
+    # First depseudonymize the identifier for internal querying
+    try:
+        identifier: Dataset = shield_anonymizer.shield_query(event.identifier)
+    except PseudonymizationError as e:
+        logging.error(f"C-GET rejected: {e}")
+        yield 1
         yield 0xC000, None  # Failure
-        logging.info("Handling C-GET request failed!")
         return
-    else:
-        (assoc, queryRetrieveLevel) = ae
-
-    logging.info("Handling C-GET request")
-    # First depseudonymize the identifier for internal querying
-    identifier: Dataset = shield_anonymizer.shield_query(identifier)
-    logging.info(f"Anonymized identifier for FIND: {identifier}")
+    log.dataset("Depseudonymized identifier for C-GET", identifier)
+
+    # Fetch from upstream and forward every instance as soon as it is pseudonymized
+    with Cancellation(event) as cancellation:
+        upstream = locate(identifier, event.context, cancellation)
+        found = find_instances(identifier, event.context, cancellation, upstream)
+        instances = retrieve_via_get(identifier, event.context, found, cancellation, upstream)
+        count = next(instances)
+        yield announced(count, cancellation)
+
+        forwarded = 0
+        for ds in instances:
+            with metrics.OUTBOUND_STORE_SECONDS.time(), \
+                    tracing.span("outbound.C-STORE", kind="client", sop_instance_uid=ds.get("SOPInstanceUID", "")):
+                yield 0xFF00, for_association(ds, event.assoc)  # 0xFF00 = Pending
+            forwarded += 1
+            metrics.INSTANCES_TOTAL.inc(direction="forwarded")
+
+    if cancellation.cancelled:
+        if not cancellation.disconnected:
+            yield 0xFE00, None  # Cancel
+        return
 
-    # Forward the C-GET request and yield results
-    responses = assoc.send_c_get(identifier, queryRetrieveLevel)
+    yield final_status(count, forwarded), None
+
+
+def handle_store_pseudonymized(event, received: Queue, stop: threading.Event):
+    """C-STORE sub-operation of an upstream C-GET: pseudonymize and hand over to the waiting handler"""
+    if stop.is_set():
+        # The client cancelled, don't spend a pseudonymization request on the instance
+        return 0xA700  # Out of resources
+    metrics.INSTANCES_TOTAL.inc(direction="received")
+    metrics.RECEIVED_BYTES_TOTAL.inc(len(event.request.DataSet.getvalue()))
+    with tracing.span("upstream.C-STORE", parent=tracing.bound(event.assoc), kind="server",
+                      sop_instance_uid=event.request.AffectedSOPInstanceUID):
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        try:
+            ds = shield_anonymizer.shield_retrieve(ds)
+        except PseudonymizationError as e:
+            logging.error(f"Dropping instance {event.request.AffectedSOPInstanceUID}: {e}")
+            return 0xA700  # Out of resources
+
+    received.put(("instance", ds))
+    return 0x0000
 
-    # Then pseudonomyze the identifiers for data return
-    for (status, identifier_resp) in responses:
-        logging.info(f"responses: ({status}, identifier_resp={identifier_resp})")
-        # if identifier_resp is not None:
-        #   identifier_resp = shield_anonymizer.shield_retrieve(identifier_resp)
 
-    yield shared_queue.qsize()
+def find_instances(identifier: Dataset, event_context, cancellation=None, upstream=None):
+    """IMAGE-level C-FIND of everything `identifier` refers to.
 
-    while shared_queue.qsize() > 0:
-        logging.info(f"sending item to client")
-        yield 0xFF00, shared_queue.get()  # 0xFF00 = Pending
+    Returns [(StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID, SOPClassUID)] or None if the upstream
+    cannot answer it, in which case the caller falls back to a single C-GET.
+    """
+    # The caller's identifier is still needed for the fallback C-GET at its own level
+    query = copy.deepcopy(identifier)
+    query.QueryRetrieveLevel = "IMAGE"
+    for attr in ("StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "SOPClassUID"):
+        if attr not in query:
+            setattr(query, attr, "")
 
+    result = handle_event(query, event_context, action="FIND", storage_classes=[], upstream=upstream)
+    if result is None:
+        return None
+    (assoc, _) = result
+
+    if cancellation is not None:
+        cancellation.on_cancel(stop_upstream(assoc, UPSTREAM_MESSAGE_ID, StudyRootQueryRetrieveInformationModelFind))
+
+    instances = []
+    with tracing.span("upstream.C-FIND", kind="client", level="IMAGE"):
+        responses = metrics.UPSTREAM_REQUEST_SECONDS.time_iter(
+            assoc.send_c_find(query, StudyRootQueryRetrieveInformationModelFind, msg_id=UPSTREAM_MESSAGE_ID),
+            operation="find")
+        for (status, ds) in responses:
+            if cancellation is not None and cancellation.check():
+                assoc.abort()
+                return []
+            if ds is not None and status and status.Status in (0xFF00, 0xFF01):
+                instances.append((ds.get("StudyInstanceUID"), ds.get("SeriesInstanceUID"),
+                                  ds.get("SOPInstanceUID"), ds.get("SOPClassUID")))
     assoc.release()
 
-
+    if not instances or not all(all(instance) for instance in instances):
+        logging.info("Upstream did not return SOP classes for an IMAGE-level C-FIND")
+        return None
+    return instances
+
+
+def partition_instances(instances):
+    """Splits instances by SOP class over as many associations as the presentation context limit requires,
+    but over up to MAX_PARALLEL_GETS associations to fetch them concurrently.
+
+    Returns [(storage SOP classes, instances)], balanced by number of instances.
+    """
+    by_class = {}
+    for instance in instances:
+        by_class.setdefault(instance[3], []).append(instance)
+
+    # One uncompressed context per SOP class plus one per compressed transfer syntax
+    classes_per_association = MAX_STORAGE_CONTEXTS // (1 + len(compressedTransferSyntaxes))
+    needed = -(-len(by_class) // classes_per_association)
+    max_parallel_gets = config.get("MAX_PARALLEL_GETS", 4)  # reloadable
+    partitions = [([], []) for _ in range(max(needed, min(max_parallel_gets, len(by_class))))]
+    for sop_class, class_instances in sorted(by_class.items(), key=lambda item: -len(item[1])):
+        candidates = [p for p in partitions if len(p[0]) < classes_per_association]
+        classes, members = min(candidates, key=lambda p: len(p[1]))
+        classes.append(sop_class)
+        members.extend(class_instances)
+    return [partition for partition in partitions if partition[0]]
+
+
+def series_identifiers(instances):
+    """IMAGE-level C-GET identifiers listing the SOP Instance UIDs to retrieve, one per series unless the list
+    exceeds MAX_UID_LIST_BYTES"""
+    by_series = {}
+    sizes = {}
+    for (study_uid, series_uid, sop_instance_uid, _) in instances:
+        series = (study_uid, series_uid)
+        chunks = by_series.setdefault(series, [[]])
+        sizes[series] = sizes.get(series, 0) + len(sop_instance_uid) + 1  # with the separating backslash
+        if sizes[series] > MAX_UID_LIST_BYTES + 1:
+            chunks.append([])
+            sizes[series] = len(sop_instance_uid) + 1
+        chunks[-1].append(sop_instance_uid)
+
+    identifiers = []
+    for (study_uid, series_uid), chunks in by_series.items():
+        for sop_instance_uids in chunks:
+            ds = Dataset()
+            ds.QueryRetrieveLevel = "IMAGE"
+            ds.StudyInstanceUID = study_uid
+            ds.SeriesInstanceUID = series_uid
+            ds.SOPInstanceUID = sop_instance_uids
+            identifiers.append(ds)
+    return identifiers
+
+
+def retrieve_via_get(identifier: Dataset, event_context, instances=None, cancellation=None, upstream=None):
+    """Retrieves the (depseudonymized) `identifier` with C-GETs over upstream associations.
+
+    `instances` as returned by find_instances are partitioned by SOP class over several associations, since one
+    association cannot offer all storage SOP classes (> 128 presentation contexts). Without them a single C-GET
+    offering retrieveStorageClasses is sent. Yields the number of instances first, then every instance as soon as
+    it has been pseudonymized, like the handlers of pynetdicom expect it.
+
+    Once `cancellation` fires, the upstream C-GETs are cancelled, instances still arriving are dropped without
+    pseudonymizing them and the generator ends.
+    """
+    received = Queue()
+    stop = threading.Event()
+    associations = []
+    span = tracing.current_span()
+
+    def cancel(disconnected):
+        stop.set()
+        received.put(("cancelled", None))  # Wakes up the generator
+
+    if cancellation is not None:
+        cancellation.on_cancel(cancel)
+
+    if instances is None:
+        jobs = [(retrieveStorageClasses, [identifier])]
+    else:
+        jobs = [(classes, series_identifiers(members)) for classes, members in partition_instances(instances)]
+
+    def send_c_gets(storage_classes, identifiers):
+        try:
+            result = handle_event(identifiers[0], event_context, action="GET", storage_classes=storage_classes,
+                                  evt_handlers=[(evt.EVT_C_STORE, handle_store_pseudonymized, [received, stop])],
+                                  upstream=upstream, parent=span)
+            if result is None:
+                logging.info("Failed to establish upstream association for C-GET")
+                return
+            (assoc, queryRetrieveLevel) = result
+            associations.append(assoc)
+            if cancellation is not None:
+                cancellation.on_cancel(stop_upstream(assoc, UPSTREAM_MESSAGE_ID, queryRetrieveLevel))
+
+            with tracing.span("upstream.C-GET", parent=span, kind="client", sop_classes=len(storage_classes)) \
+                    as get_span:
+                # The C-STORE sub-operations are handled in the thread of the upstream association
+                tracing.bind(assoc, get_span)
+                try:
+                    for get_identifier in identifiers:
+                        if stop.is_set() or not assoc.is_established:
+                            break
+                        responses = metrics.UPSTREAM_REQUEST_SECONDS.time_iter(
+                            assoc.send_c_get(get_identifier, queryRetrieveLevel, msg_id=UPSTREAM_MESSAGE_ID),
+                            operation="get")
+                        for (status, _) in responses:
+                            received.put(("status", status))
+                finally:
+                    tracing.unbind(assoc)
+                    if assoc.is_established:
+                        assoc.release()
+        finally:
+            received.put(("done", None))
+
+    for storage_classes, identifiers in jobs:
+        threading.Thread(target=send_c_gets, args=(storage_classes, identifiers),
+                         name="upstream-get", daemon=True).start()
+
+    # Without a C-FIND the total is only known with the first C-GET response,
+    # which follows the first C-STORE sub-operation
+    count = len(instances) if instances is not None else None
+    forwarded = 0
+    buffered = []
+    running = len(jobs)
+    try:
+        if count is not None:
+            yield count
+        while running and not stop.is_set():
+            kind, item = received.get()
+            if kind == "instance":
+                if count is None:
+                    buffered.append(item)
+                else:
+                    forwarded += 1
+                    yield item
+            elif kind == "status" and count is None and "NumberOfRemainingSuboperations" in item:
+                count = sum(item.get(attr, 0) or 0 for attr in (
+                    "NumberOfRemainingSuboperations", "NumberOfCompletedSuboperations",
+                    "NumberOfFailedSuboperations", "NumberOfWarningSuboperations"))
+                yield count
+                forwarded += len(buffered)
+                yield from buffered
+                buffered.clear()
+            elif kind == "done":
+                running -= 1
+            elif kind == "cancelled":
+                break
+
+        if stop.is_set():
+            buffered.clear()
+            logging.info(f"Upstream C-GET cancelled after {forwarded} instances")
+            if count is None:
+                yield 0
+        elif count is None:
+            # No pending responses, everything arrived before the final response
+            yield len(buffered)
+            yield from buffered
+        elif forwarded < count:
+            logging.warning(f"Upstream C-GET delivered {forwarded} of {count} instances")
+    finally:
+        if running and not stop.is_set():
+            # Closed by pynetdicom without a cancellation, e.g. after the client association broke down
+            stop.set()
+            for assoc in associations:
+                assoc.abort()
+
+
+@tracing.traced("C-MOVE", kind="server")
+@audit.audited("move")
+@log.summarized("move")
 def handle_move(event):
-    logging.info("Handling C-MOVE request")
-    handle_move_internally(event)
-    received_items_cnt = shared_queue.qsize()
-    logging.info(f"Received {received_items_cnt} datasets from internal MOVE SCP handler")
-
-    # if received_items_cnt == 0:
-    #    yield None, None
+    metrics.REQUESTS_TOTAL.inc(operation="move")
+    capture.record(event, "move")
+    trace_request(event)
+    with Cancellation(event) as cancellation:
+        if retrieve_mode == "GET":
+            yield from move_via_get(event, cancellation)
+            return
+
+        try:
+            datasets, count = handle_move_internally(event, cancellation)
+        except (PseudonymizationError, UpstreamFailure) as e:
+            # Raising before the first yield makes pynetdicom answer with a failure status right away
+            logging.error(f"C-MOVE rejected: {e}")
+            raise
+        received_items_cnt = len(datasets)
+
+        target = config["ALLOWED_AET"][event.move_destination]
+        target_ip, target_port = destination_address(target)
+
+        log.event("move.forward", instances=received_items_cnt, destination=event.move_destination,
+                  address=f"{target_ip}:{target_port}")
+        # Forward received datasets to the original client. Without any, pynetdicom still associates with the
+        # destination to report the failed or cancelled sub-operations
+        contexts = outbound_contexts(datasets, transcoding.transfer_syntax(target)) or \
+            storage_contexts(retrieveStorageClasses[:1], [])
+        destination, store_assoc = move_destination(target, contexts)
+        yield destination
+        # Includes the sub-operations that failed upstream, they remain and are reported as failed
+        yield announced(count, cancellation)
+
+        forwarded = 0
+        for ds in for_destination(datasets, target, store_assoc):
+            if cancellation.check():
+                break
+            # pynetdicom performs the C-STORE sub-operation before resuming this generator
+            with metrics.OUTBOUND_STORE_SECONDS.time(), \
+                    tracing.span("outbound.C-STORE", kind="client", sop_instance_uid=ds.get("SOPInstanceUID", "")):
+                yield 0xFF00, for_association(ds, next(iter(store_assoc), None))  # Pending status
+            forwarded += 1
+            metrics.INSTANCES_TOTAL.inc(direction="forwarded")
+
+    if cancellation.cancelled:
+        datasets.clear()
+        if not cancellation.disconnected:
+            yield 0xFE00, None  # Cancel
+        return
 
-    source_ip = event.assoc.requestor.address
-    source_port = event.assoc.requestor.port
-    logging.info(f"handle_move-move-destination='{event.move_destination}' source_ip={source_ip}:{source_port}")
+    yield final_status(count, forwarded), None
 
-    target = config["ALLOWED_AET"][event.move_destination]
-    target_ip, target_port = target
 
-    logging.info(f"Forwarding {received_items_cnt} datasets to original client {target_ip}:{target_port}")
-    # Forward received datasets to the original client
-    yield target_ip, target_port
-    yield received_items_cnt
+def move_via_get(event, cancellation):
+    """C-MOVE that fetches from upstream with C-GET and forwards every instance as soon as it is pseudonymized"""
+    identifier = shield_anonymizer.shield_query(event.identifier)
 
-    while shared_queue.qsize() > 0:
-        yield 0xFF00, shared_queue.get()  # Pending status
+    upstream = locate(identifier, event.context, cancellation)
+    found = find_instances(identifier, event.context, cancellation, upstream)
+    # Only the storage SOP classes offered on the upstream associations can arrive
+    sop_classes = sorted({instance[3] for instance in found}) if found else retrieveStorageClasses
+    target = config["ALLOWED_AET"][event.move_destination]
+    transfer_syntaxes = policy_first(compressedTransferSyntaxes, transcoding.transfer_syntax(target))
+    destination, store_assoc = move_destination(target, storage_contexts(sop_classes, transfer_syntaxes))
+    yield destination
+    if cancellation.cancelled:
+        yield announced(0, cancellation)
+        if not cancellation.disconnected:
+            yield 0xFE00, None  # Cancel
+        return
 
-    logging.info(f"Handling of C-MOVE request finished")
-    yield 0x0000, None  # Success
+    instances = retrieve_via_get(identifier, event.context, found, cancellation, upstream)
+    count = next(instances)
+    yield announced(count, cancellation)
+
+    forwarded = 0
+    for ds in for_destination(instances, target, store_assoc):
+        # pynetdicom performs the C-STORE sub-operation before resuming this generator
+        with metrics.OUTBOUND_STORE_SECONDS.time(), \
+                tracing.span("outbound.C-STORE", kind="client", sop_instance_uid=ds.get("SOPInstanceUID", "")):
+            yield 0xFF00, for_association(ds, next(iter(store_assoc), None))  # Pending status
+        forwarded += 1
+        metrics.INSTANCES_TOTAL.inc(direction="forwarded")
+
+    if cancellation.cancelled:
+        if not cancellation.disconnected:
+            yield 0xFE00, None  # Cancel
+        return
 
+    yield final_status(count, forwarded), None
 
-def handle_move_internally(event):
-    logging.info("Handling internal C-MOVE request")
 
+def handle_move_internally(event, cancellation):
+    """Sends the C-MOVE upstream with run_internal_server as destination and returns the pseudonymized instances"""
     identifier = shield_anonymizer.shield_query(event.identifier)
-    logging.info(f"Anonymized identifier '{event.identifier}' for MOVE: {identifier}")
+    log.dataset("Depseudonymized identifier for C-MOVE", identifier)
     # logging.info(f"Event Context {event.context}")
 
     # Setup AE for move, request all required contexts
-    result = handle_event(identifier, event.context, action="FIND")
+    upstream = locate(identifier, event.context, cancellation)
+    result = handle_event(identifier, event.context, action="MOVE", upstream=upstream)
     if result is None:
-        logging.info("Failed to establish internal association for C-MOVE")
-        return None  # Failure
-    else:
-        (assoc, queryRetrieveLevel) = result
+        raise UpstreamFailure("Failed to establish internal association for C-MOVE")
+    (assoc, queryRetrieveLevel) = result
 
     # C-MOVE to our local AE (the running C-STORE-SCP server)
-    responses = assoc.send_c_move(identifier, config["C_STORE_ENDPOINT"]["AET"], queryRetrieveLevel)
-    logging.info(f"C-MOVE sent to SCP server: {assoc.dul.socket.socket.getpeername()}")
-
-    for (status, ds) in responses:
-        logging.warning(status)
-        if status.Status != 0x0000:
-            continue
-        else:
-            break
-
-    # time.sleep(1)  # Allow time for the mock server to process the request
-
-    assoc.release()
-    return None
+    msg_id = next_move_message_id()
+    pending_moves.open(msg_id)
+    # Cancelling frees the instances received so far, later ones are dropped by run_internal_server
+    cancellation.on_cancel(lambda disconnected: pending_moves.close(msg_id))
+    cancellation.on_cancel(stop_upstream(assoc, msg_id, queryRetrieveLevel))
+    try:
+        with tracing.span("upstream.C-MOVE", kind="client", message_id=msg_id) as span:
+            # The C-STORE sub-operations arrive at run_internal_server in another thread
+            tracing.bind(("move", msg_id), span)
+            responses = metrics.UPSTREAM_REQUEST_SECONDS.time_iter(
+                assoc.send_c_move(identifier, config["C_STORE_ENDPOINT"]["AET"], queryRetrieveLevel, msg_id=msg_id),
+                operation="move")
+            final = Dataset()
+            for (status, ds) in responses:
+                log.event("move.upstream_status", logging.DEBUG, message_id=msg_id, status=status.get("Status"),
+                          completed=status.get("NumberOfCompletedSuboperations"))
+                final = status
+                if cancellation.check() or status.get("Status") not in log.PENDING:
+                    break
+            tracing.unbind(("move", msg_id))
+    finally:
+        datasets = pending_moves.close(msg_id)
+
+    if assoc.is_established:
+        assoc.release()
+    if cancellation.cancelled:
+        return [], 0
+
+    # The upstream also counts the sub-operations rejected by run_internal_server or other workers as failed
+    status = final.get("Status")
+    status_text = "none" if status is None else f"0x{status:04X}"
+    reported = sum(final.get(attr) or 0 for attr in (
+        "NumberOfCompletedSuboperations", "NumberOfFailedSuboperations", "NumberOfWarningSuboperations"))
+    if not datasets and not reported and status != 0x0000:
+        raise UpstreamFailure(f"Upstream C-MOVE failed with status {status_text}")
+    if status != 0x0000 or reported > len(datasets):
+        logging.warning(f"Upstream C-MOVE ended with status {status_text}, received {len(datasets)} of "
+                        f"{max(reported, len(datasets))} instances")
+    return datasets, max(len(datasets), reported)
+
+
+def announced(count, cancellation):
+    """Number of sub-operations a C-GET/C-MOVE handler yields before the instances.
+
+    pynetdicom answers a request without sub-operations with Success right away, so a request the client cancelled
+    announces at least one, which is reported as remaining with the Cancel status.
+    """
+    if cancellation.cancelled and not cancellation.disconnected:
+        return max(count, 1)
+    return count
+
+
+def final_status(count, forwarded):
+    """Final status of a C-GET/C-MOVE that announced `count` sub-operations and sent `forwarded` instances.
+
+    pynetdicom reports the sub-operations that were never sent as failed.
+    """
+    if forwarded >= count:
+        return 0x0000  # Success, pynetdicom turns it into a warning if C-STORE sub-operations failed
+    if forwarded:
+        return 0xB000  # Warning: sub-operations complete, one or more failures
+    return 0xA702  # Failure: unable to perform sub-operations
 
 
 def handle_echo(event):
@@ -0,0 +1,90 @@
+"""Stops upstream work once a client cancels its request (C-CANCEL) or drops the association."""
+import logging
+import threading
+
+
+class Cancellation:
+    """Watches the request of a C-FIND/C-GET/C-MOVE handler in the background.
+
+    Handlers register callbacks that stop their upstream operations, e.g. send a C-CANCEL or abort the upstream
+    association. pynetdicom reports a C-CANCEL only once, so handlers check `cancelled` instead of the event.
+    Without an event (DICOMweb requests), only cancel() stops the request.
+
+        with Cancellation(event) as cancellation:
+            cancellation.on_cancel(lambda disconnected: assoc.abort())
+            ...
+    """
+
+    def __init__(self, event=None, interval=0.2):
+        self.event = event
+        self.interval = interval
+        self.cancelled = False
+        self.disconnected = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def on_cancel(self, callback):
+        """Registers `callback(disconnected)`, it is called right away if the request has been cancelled already"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback(self.disconnected)
+
+    def check(self):
+        """Returns True once the client cancelled the request or the association is gone"""
+        if self.cancelled or self.event is None:
+            return self.cancelled
+        if self.event.is_cancelled or not self.event.assoc.is_established:
+            self.cancel(not self.event.assoc.is_established)
+        return self.cancelled
+
+    def cancel(self, disconnected=True):
+        """Stops the upstream work, `disconnected` if the client is gone"""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.disconnected = disconnected
+            callbacks, self._callbacks = self._callbacks, []
+
+        if self.event is None:
+            logging.info("Request cancelled by the client, stopping upstream work")
+        else:
+            reason = "association closed" if self.disconnected else "C-CANCEL"
+            logging.info(f"Request {self.event.message_id} cancelled by the client ({reason}), "
+                         f"stopping upstream work")
+        for callback in callbacks:
+            try:
+                callback(self.disconnected)
+            except Exception as e:
+                logging.warning(f"Failed to stop upstream work: {e}")
+
+    def _watch(self):
+        while not self._done.wait(self.interval):
+            if self.check():
+                return
+
+    def __enter__(self):
+        if self.event is None:
+            return self
+        threading.Thread(target=self._watch, name="cancellation", daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._done.set()
+
+
+def stop_upstream(assoc, msg_id, query_model):
+    """Callback for Cancellation.on_cancel: forwards a C-CANCEL upstream, or aborts if the client is gone anyway"""
+
+    def stop(disconnected):
+        if not assoc.is_established:
+            return
+        if disconnected:
+            assoc.abort()
+        else:
+            assoc.send_c_cancel(msg_id, query_model=query_model)
+
+    return stop
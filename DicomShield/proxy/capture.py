@@ -0,0 +1,79 @@
+"""Records the incoming DIMSE requests to a compact file, so production load can be replayed with replay.py.
+
+Each line of the (gzip compressed) capture is a JSON object:
+    {"t": seconds since capture start, "op": "find" | "get" | "move", "calling_aet": ..., "model": SOP Class UID,
+     "move_destination": ..., "identifier": DICOM JSON of the request identifier}
+
+Identifiers are recorded as the client sent them, i.e. with pseudonyms, and FIELDS_FOR_REMOVAL are cleared.
+"""
+import copy
+import gzip
+import json
+import logging
+import threading
+import time
+from queue import Queue, Full
+
+_recorder = None
+
+
+class Recorder:
+    def __init__(self, path, anonymizer):
+        self.path = path
+        self.anonymizer = anonymizer
+        self.started = time.monotonic()
+        self.queue = Queue(maxsize=10000)
+        self.dropped = 0
+        threading.Thread(target=self._run, name="capture-writer", daemon=True).start()
+
+    def record(self, event, operation):
+        entry = {
+            "t": round(time.monotonic() - self.started, 6),
+            "op": operation,
+            "calling_aet": event.assoc.requestor.ae_title,
+            "model": str(event.context.abstract_syntax),
+            # Copied right away, the handlers depseudonymize the identifier in place
+            "identifier": copy.deepcopy(event.identifier),
+        }
+        if operation == "move":
+            entry["move_destination"] = event.move_destination
+        try:
+            self.queue.put_nowait(entry)
+        except Full:
+            self.dropped += 1  # Never block a handler thread for the capture
+
+    def _run(self):
+        with gzip.open(self.path, "at") as f:
+            while True:
+                entry = self.queue.get()
+                try:
+                    entry["identifier"] = self.anonymizer.shield_capture(entry["identifier"]).to_json_dict()
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                    if self.queue.empty():
+                        f.flush()
+                except Exception as e:
+                    # A broken identifier or a full disk must not end the capture
+                    self.dropped += 1
+                    logging.error(f"Failed to record {entry['op']} request of {entry['calling_aet']}: {e!r}")
+
+
+def configure(path, anonymizer):
+    global _recorder
+    _recorder = Recorder(path, anonymizer)
+    logging.info(f"Recording incoming requests to {path}")
+
+
+def record(event, operation):
+    if _recorder is not None:
+        _recorder.record(event, operation)
+
+
+def read(path):
+    """Yields the entries of a capture file"""
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            pass  # DicomShield was stopped while writing, every flushed entry has been read
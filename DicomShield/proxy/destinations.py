@@ -0,0 +1,252 @@
+"""Pool of outbound associations to the C-MOVE destinations.
+
+pynetdicom associates with the move destination for every C-MOVE and releases the association when the move is done.
+Clients that move series by series (viewers, AI pipelines) therefore pay a handshake per series. The ingress AE is a
+PooledAE instead: it hands pynetdicom an idle association to the destination that was negotiated with all the needed
+presentation contexts, and pynetdicom's release puts it back into the pool.
+
+New associations to a destination propose the contexts of the move plus those of its earlier moves (up to the 128 of
+an association), so consecutive moves of other SOP classes can reuse them as well. An idle association is checked with
+a C-ECHO before it is reused after CHECK_INTERVAL seconds and released after IDLE_TIMEOUT seconds.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from pynetdicom import AE, build_context
+from pynetdicom.sop_class import Verification
+
+import metrics
+import settings
+from settings import config
+
+MAX_CONTEXTS = 128
+
+
+def _key(context):
+    return context.abstract_syntax, tuple(context.transfer_syntax)
+
+
+class DestinationBusy(Exception):
+    """No association to the destination became free within the timeout"""
+
+
+class PooledAssociation:
+    """Wraps an association of the pool, release() returns it to the pool instead of releasing it"""
+
+    def __init__(self, pool, destination, assoc, proposed):
+        self._pool = pool
+        self.destination = destination
+        self.assoc = assoc
+        self.proposed = proposed  # context keys proposed when associating
+        self.idle_since = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self.assoc, name)
+
+    def covers(self, contexts):
+        return all(_key(context) in self.proposed for context in contexts)
+
+    def healthy(self, check_interval):
+        if not self.assoc.is_established:
+            return False
+        if time.monotonic() - self.idle_since < check_interval:
+            return True
+        try:
+            status = self.assoc.send_c_echo()
+        except ValueError:
+            return True  # Verification not accepted by the destination, rely on the connection state
+        return bool(status) and status.Status == 0x0000 and self.assoc.is_established
+
+    def release(self):
+        self._pool.put_back(self)
+
+    def abort(self):
+        self.assoc.abort()
+        self._pool.put_back(self)
+
+
+class DestinationPool:
+    """Up to `max_associations` associations per destination (AE title, address, port), idle or in use"""
+
+    def __init__(self, max_associations=4, idle_timeout=30, check_interval=10, timeout=60):
+        self.max_associations = max_associations
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._idle = {}  # destination -> [PooledAssociation], most recently used last
+        self._open = {}  # destination -> number of idle and used associations
+        self._contexts = {}  # destination -> OrderedDict of recently requested context keys -> context
+        self._condition = threading.Condition()
+        self._expiry = None  # started with the first association, in the worker process
+
+    @classmethod
+    def from_config(cls, entry):
+        return cls(entry.get("MAX_ASSOCIATIONS", 4), entry.get("IDLE_TIMEOUT", 30), entry.get("CHECK_INTERVAL", 10),
+                   entry.get("QUEUE_TIMEOUT", 60))
+
+    def configure(self, changed):
+        """Applies reloaded limits; open associations beyond a lowered cap are closed when they become idle"""
+        if "DESTINATION_POOL" not in changed:
+            return
+        entry = config.get("DESTINATION_POOL") or {}
+        with self._condition:
+            self.max_associations = entry.get("MAX_ASSOCIATIONS", 4)
+            self.idle_timeout = entry.get("IDLE_TIMEOUT", 30)
+            self.check_interval = entry.get("CHECK_INTERVAL", 10)
+            self.timeout = entry.get("QUEUE_TIMEOUT", 60)
+            self._condition.notify_all()
+
+    def acquire(self, ae, address, port, ae_title, contexts, evt_handlers=None):
+        """An association of `ae` to the destination covering `contexts`, reused or new"""
+        destination = (ae_title, address, port)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            stale = None
+            with self._condition:
+                if self._expiry is None:
+                    self._expiry = threading.Thread(target=self._expire, name="DestinationPool", daemon=True)
+                    self._expiry.start()
+                self._remember(destination, contexts)
+                while True:
+                    idle = self._idle.setdefault(destination, [])
+                    pooled = next((p for p in reversed(idle) if p.covers(contexts)), None)
+                    if pooled is not None:
+                        idle.remove(pooled)
+                        break
+                    if self._open.get(destination, 0) < self.max_associations:
+                        self._open[destination] = self._open.get(destination, 0) + 1
+                        break
+                    if idle:
+                        # At the cap, make room by replacing an idle association lacking some contexts
+                        stale = idle.pop(0)
+                        self._open[destination] -= 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DestinationBusy(f"No free association to '{ae_title}' within {self.timeout}s")
+                    self._condition.wait(remaining)
+                requested = None if pooled else self._proposal(destination, contexts)
+
+            if stale is not None:
+                stale.assoc.release()
+                continue
+            if pooled is not None:
+                if pooled.healthy(self.check_interval):
+                    metrics.DESTINATION_ASSOCIATIONS_TOTAL.inc(result="reused")
+                    return pooled
+                logging.info(f"Discarding broken association to '{ae_title}' at {address}:{port}")
+                self._discard(pooled)
+                continue
+            return self._associate(ae, destination, requested, evt_handlers)
+
+    def _associate(self, ae, destination, requested, evt_handlers):
+        ae_title, address, port = destination
+        try:
+            assoc = AE.associate(ae, address, port, contexts=requested, ae_title=ae_title,
+                                 evt_handlers=evt_handlers)
+        except BaseException:
+            self._close(destination)
+            raise
+        if not assoc.is_established:
+            self._close(destination)
+            return assoc  # pynetdicom answers the C-MOVE with 0xA801
+        metrics.DESTINATION_ASSOCIATIONS_TOTAL.inc(result="new")
+        if assoc.network_timeout is not None and assoc.network_timeout <= self.idle_timeout:
+            # pynetdicom aborts associations without network activity for network_timeout seconds
+            assoc.network_timeout = self.idle_timeout + self.check_interval
+        return PooledAssociation(self, destination, assoc, {_key(context) for context in requested})
+
+    def _remember(self, destination, contexts):
+        known = self._contexts.setdefault(destination, OrderedDict())
+        for context in contexts:
+            known[_key(context)] = context
+            known.move_to_end(_key(context))
+        while len(known) > MAX_CONTEXTS:
+            known.popitem(last=False)
+
+    def _proposal(self, destination, contexts):
+        """`contexts`, then the most recently requested other contexts of `destination` and Verification"""
+        requested = list(contexts)[:MAX_CONTEXTS - 1]
+        keys = {_key(context) for context in requested}
+        for key, context in reversed(self._contexts[destination].items()):
+            if len(requested) >= MAX_CONTEXTS - 1:
+                break
+            if key not in keys:
+                requested.append(build_context(context.abstract_syntax, context.transfer_syntax))
+                keys.add(key)
+        requested.append(build_context(Verification))
+        return requested
+
+    def put_back(self, pooled):
+        if not pooled.assoc.is_established:
+            self._discard(pooled)
+            return
+        pooled.idle_since = time.monotonic()
+        with self._condition:
+            surplus = self._open[pooled.destination] > self.max_associations  # the cap was lowered by a reload
+            if surplus:
+                self._open[pooled.destination] -= 1
+            else:
+                self._idle.setdefault(pooled.destination, []).append(pooled)
+            self._condition.notify()
+        if surplus:
+            pooled.assoc.release()
+
+    def _discard(self, pooled):
+        if pooled.assoc.is_established:
+            pooled.assoc.abort()
+        self._close(pooled.destination)
+
+    def _close(self, destination):
+        with self._condition:
+            self._open[destination] -= 1
+            self._condition.notify()
+
+    def _expire(self):
+        while True:
+            time.sleep(max(1, min(self.idle_timeout, self.check_interval) / 2))
+            now = time.monotonic()
+            expired = []
+            with self._condition:
+                for destination, idle in self._idle.items():
+                    for pooled in [p for p in idle if now - p.idle_since > self.idle_timeout
+                                   or not p.assoc.is_established]:
+                        idle.remove(pooled)
+                        self._open[destination] -= 1
+                        expired.append(pooled)
+                if expired:
+                    self._condition.notify_all()
+            for pooled in expired:
+                if pooled.assoc.is_established:
+                    pooled.assoc.release()
+
+    def size(self, in_use=False):
+        with self._condition:
+            idle = sum(len(associations) for associations in self._idle.values())
+            return sum(self._open.values()) - idle if in_use else idle
+
+
+pool_config = config.get("DESTINATION_POOL", {})
+pool = None if pool_config is False else DestinationPool.from_config(pool_config or {})
+if pool is not None:
+    settings.on_reload(pool.configure)
+    metrics.DESTINATION_POOL_ASSOCIATIONS.set_function(pool.size, state="idle")
+    metrics.DESTINATION_POOL_ASSOCIATIONS.set_function(lambda: pool.size(in_use=True), state="in_use")
+
+
+class PooledAE(AE):
+    """AE whose associations to move destinations come from the pool.
+
+    `on_association` is called with the (pooled) association, as EVT_ACCEPTED only fires for new ones.
+    """
+
+    def associate(self, addr, port, contexts=None, ae_title="ANY-SCP", on_association=None, **kwargs):
+        if pool is None or on_association is None:
+            assoc = super().associate(addr, port, contexts=contexts, ae_title=ae_title, **kwargs)
+        else:
+            assoc = pool.acquire(self, addr, port, ae_title, contexts, kwargs.get("evt_handlers"))
+        if on_association is not None and assoc.is_established:
+            on_association(assoc)
+        return assoc
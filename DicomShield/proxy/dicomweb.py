@@ -0,0 +1,334 @@
+"""DICOMweb front end: DicomShield serves QIDO-RS and WADO-RS itself, without a DIMSE relay like dicom-rst.
+
+Requests are translated into the same upstream C-FIND/C-GET requests as DIMSE requests: identifiers are
+depseudonymized with shield_query, results and instances pseudonymized with shield_retrieve. WADO-RS streams every
+instance to the client as a multipart/related part as soon as it has been pseudonymized.
+
+    GET {PREFIX}/studies | /series | /instances                       QIDO-RS
+    GET {PREFIX}/studies/{study}/series | /studies/{study}/instances  QIDO-RS
+    GET {PREFIX}/studies/{study}/series/{series}/instances            QIDO-RS
+    GET {PREFIX}/studies/{study}[/series/{series}[/instances/{sop}]]  WADO-RS instances
+    GET ...[/metadata]                                                WADO-RS metadata (without bulk data)
+"""
+import json
+import logging
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qsl, urlsplit
+
+from pydicom import Dataset, dcmwrite
+from pydicom.datadict import dictionary_VR, tag_for_keyword
+from pydicom.tag import Tag
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import build_context
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelGet
+
+import audit
+import metrics
+import settings
+import tracing
+import workers
+from c_handlers import decompress, fan_out_find, find_instances, locate, pseudonymized_results, retrieve_via_get
+from cancellation import Cancellation
+from pseudonym_clients import PseudonymizationError, UnknownPseudonym
+from utils import shield_anonymizer
+
+dicomweb_config = settings.config.get("DICOMWEB", {})
+
+PREFIX = dicomweb_config.get("PREFIX", "").rstrip("/")
+ALLOWED_IPS = dicomweb_config.get("ALLOWED_IPS", ["127.0.0.1", "::1"])  # Only local clients unless configured
+
+# Presentation contexts the upstream associations are requested with, like those of a DIMSE client
+FIND_CONTEXT = build_context(StudyRootQueryRetrieveInformationModelFind)
+GET_CONTEXT = build_context(StudyRootQueryRetrieveInformationModelGet)
+
+# Attributes returned by QIDO-RS, besides those asked for with `includefield`
+RETURN_KEYS = {
+    "STUDY": ["StudyDate", "StudyTime", "AccessionNumber", "ModalitiesInStudy", "ReferringPhysicianName",
+              "PatientName", "PatientID", "PatientBirthDate", "PatientSex", "StudyInstanceUID", "StudyID",
+              "StudyDescription", "NumberOfStudyRelatedSeries", "NumberOfStudyRelatedInstances"],
+    "SERIES": ["StudyInstanceUID", "Modality", "SeriesDescription", "SeriesNumber", "SeriesInstanceUID",
+               "NumberOfSeriesRelatedInstances", "PerformedProcedureStepStartDate",
+               "PerformedProcedureStepStartTime"],
+    "IMAGE": ["StudyInstanceUID", "SeriesInstanceUID", "SOPClassUID", "SOPInstanceUID", "InstanceNumber", "Rows",
+              "Columns", "BitsAllocated", "NumberOfFrames"],
+}
+
+# Left out of WADO-RS metadata
+BULK_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010)  # Float Pixel Data, Double Float Pixel Data, Pixel Data
+
+
+def parse_path(path):
+    """Returns (operation, QueryRetrieveLevel, {keyword: UID}) of a request path, None if it is unknown"""
+    match [segment for segment in path.split("/") if segment]:
+        case ["studies"]:
+            return "qido", "STUDY", {}
+        case ["series"]:
+            return "qido", "SERIES", {}
+        case ["instances"]:
+            return "qido", "IMAGE", {}
+        case ["studies", study, "series"]:
+            return "qido", "SERIES", {"StudyInstanceUID": study}
+        case ["studies", study, "instances"]:
+            return "qido", "IMAGE", {"StudyInstanceUID": study}
+        case ["studies", study, "series", series, "instances"]:
+            return "qido", "IMAGE", {"StudyInstanceUID": study, "SeriesInstanceUID": series}
+        case ["studies", study, *rest]:
+            operation = "wado"
+            if rest and rest[-1] == "metadata":
+                operation = "metadata"
+                rest = rest[:-1]
+            match rest:
+                case []:
+                    return operation, "STUDY", {"StudyInstanceUID": study}
+                case ["series", series]:
+                    return operation, "SERIES", {"StudyInstanceUID": study, "SeriesInstanceUID": series}
+                case ["series", series, "instances", instance]:
+                    return operation, "IMAGE", {"StudyInstanceUID": study, "SeriesInstanceUID": series,
+                                                "SOPInstanceUID": instance}
+    return None
+
+
+def _tag(key):
+    if re.fullmatch("[0-9A-Fa-f]{8}", key):
+        return Tag(int(key, 16))
+    tag = tag_for_keyword(key)
+    if tag is None:
+        raise ValueError(f"Unknown attribute {key}")
+    return Tag(tag)
+
+
+def _add(identifier: Dataset, key, value=None):
+    tag = _tag(key)
+    try:
+        vr = dictionary_VR(tag)
+    except KeyError:
+        raise ValueError(f"Unknown attribute {key}")
+    if vr in ("US", "UL", "SS", "SL", "FL", "FD"):
+        value = (float if vr in ("FL", "FD") else int)(value) if value else None
+    elif vr == "UI" and value and "," in value:
+        value = value.split(",")  # UID list matching
+    identifier.add_new(tag, vr, value or "")
+
+
+def parse_query(query, level, uids):
+    """C-FIND identifier of a QIDO-RS request, with the limit and offset of the results"""
+    identifier = Dataset()
+    identifier.QueryRetrieveLevel = level
+    for keyword in RETURN_KEYS[level]:
+        _add(identifier, keyword)
+    limit, offset = None, 0
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        match key:
+            case "includefield":
+                for field in value.split(","):
+                    if field and field != "all":
+                        _add(identifier, field)
+            case "limit":
+                limit = int(value)
+            case "offset":
+                offset = int(value)
+            case "fuzzymatching":
+                pass  # not supported by C-FIND
+            case _:
+                _add(identifier, key, value)
+    for keyword, uid in uids.items():
+        setattr(identifier, keyword, uid)
+    if (limit is not None and limit < 0) or offset < 0:
+        raise ValueError("limit and offset must not be negative")
+    return identifier, limit, offset
+
+
+def accepted_transfer_syntax(accept):
+    """Transfer syntax of the instances the Accept header asks for ("*" for any), None if it asks for no DICOM"""
+    if not accept:
+        return ExplicitVRLittleEndian
+    for media_range in accept.split(","):
+        media_type, *parameters = [part.strip() for part in media_range.split(";")]
+        parameters = dict(parameter.split("=", 1) for parameter in parameters if "=" in parameter)
+        parameters = {key.strip().lower(): value.strip().strip('"') for key, value in parameters.items()}
+        part_type = parameters.get("type", "application/dicom")
+        if media_type in ("*/*", "multipart/*", "application/dicom") or (
+                media_type == "multipart/related" and part_type == "application/dicom"):
+            return parameters.get("transfer-syntax", ExplicitVRLittleEndian)
+    return None
+
+
+def encode(ds: Dataset, transfer_syntax):
+    """Part 10 bytes of `ds` in `transfer_syntax`; "*" keeps the transfer syntax of the PACS, unknown compressed
+    syntaxes are answered uncompressed"""
+    current = ds.file_meta.TransferSyntaxUID
+    if transfer_syntax != "*" and current != transfer_syntax:
+        if current.is_compressed:
+            decompress(ds)
+        elif current != ExplicitVRLittleEndian:
+            ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds.is_implicit_VR, ds.is_little_endian = False, True
+    buffer = BytesIO()
+    dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
+
+
+class DICOMwebRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # for chunked responses
+
+    def do_GET(self):
+        if self.client_address[0] not in ALLOWED_IPS:
+            self.send_error(403)
+            return
+
+        url = urlsplit(self.path)
+        route = parse_path(url.path[len(PREFIX):]) if url.path.startswith(PREFIX) else None
+        if route is None:
+            self.send_error(404)
+            return
+        operation, level, uids = route
+
+        metrics.REQUESTS_TOTAL.inc(operation=operation)
+        with tracing.span("QIDO-RS" if operation == "qido" else "WADO-RS", kind="server", path=url.path):
+            try:
+                if operation == "qido":
+                    self.search(level, uids, url.query)
+                else:
+                    self.retrieve(level, uids, metadata=operation == "metadata")
+            except UnknownPseudonym as e:
+                logging.info(f"DICOMweb request for an unknown pseudonym: {e}")
+                self.send_error(404)
+            except PseudonymizationError as e:
+                logging.error(f"DICOMweb request rejected: {e}")
+                self.send_error(503, "Pseudonymization failed")
+
+    def search(self, level, uids, query):
+        try:
+            identifier, limit, offset = parse_query(query, level, uids)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        identifiers = shield_anonymizer.shield_find(identifier)
+        if not identifiers:
+            self.send_body(204)  # No pseudonym matches
+            return
+
+        matches = []
+        complete = True
+        tally = audit.Tally()
+        with Cancellation() as cancellation:
+            results = fan_out_find(identifiers, FIND_CONTEXT, cancellation)
+            for ds in pseudonymized_results(results, level, cancellation):
+                if "QueryRetrieveLevel" in ds:
+                    del ds.QueryRetrieveLevel
+                if len(matches) >= offset:
+                    tally.add(ds)
+                matches.append(ds.to_json_dict())
+                if limit is not None and len(matches) >= offset + limit:
+                    results.close()
+                    complete = False
+                    break
+        matches = matches[offset:]
+        audit.record(self.client_address[0], "qido", tally)
+
+        if matches:
+            self.send_body(200, json.dumps(matches).encode(), "application/dicom+json")
+        elif complete and not results.succeeded:
+            self.send_error(502, "No upstream answered the query")
+        else:
+            self.send_body(204)
+
+    def retrieve(self, level, uids, metadata=False):
+        transfer_syntax = None if metadata else accepted_transfer_syntax(self.headers.get("Accept"))
+        if not metadata and transfer_syntax is None:
+            self.send_error(406)
+            return
+        identifier = Dataset()
+        identifier.QueryRetrieveLevel = level
+        for keyword, uid in uids.items():
+            setattr(identifier, keyword, uid)
+        identifier = shield_anonymizer.shield_query(identifier)
+
+        with Cancellation() as cancellation:
+            upstream = locate(identifier, GET_CONTEXT, cancellation)
+            found = find_instances(identifier, GET_CONTEXT, cancellation, upstream)
+            instances = retrieve_via_get(identifier, GET_CONTEXT, found, cancellation, upstream)
+            if not next(instances):
+                instances.close()
+                self.send_error(404)
+                return
+
+            tally = audit.Tally()
+            try:
+                if metadata:
+                    self.stream_metadata(audit.counted(instances, tally))
+                else:
+                    self.stream_instances(audit.counted(instances, tally), transfer_syntax)
+            except OSError as e:
+                logging.info(f"DICOMweb client disconnected: {e}")
+                cancellation.cancel()
+                instances.close()
+                self.close_connection = True
+            finally:
+                audit.record(self.client_address[0], "wado", tally)
+
+    def stream_instances(self, instances, transfer_syntax):
+        boundary = uuid.uuid4().hex
+        self.start_chunked(f'multipart/related; type="application/dicom"; boundary={boundary}')
+        for ds in instances:
+            data = encode(ds, transfer_syntax)
+            header = (f"--{boundary}\r\nContent-Type: application/dicom; "
+                      f"transfer-syntax={ds.file_meta.TransferSyntaxUID}\r\n\r\n")
+            self.write_chunk(header.encode() + data + b"\r\n")
+            metrics.INSTANCES_TOTAL.inc(direction="forwarded")
+        self.write_chunk(f"--{boundary}--\r\n".encode())
+        self.end_chunked()
+
+    def stream_metadata(self, instances):
+        self.start_chunked("application/dicom+json")
+        separator = b"["
+        for ds in instances:
+            for tag in BULK_DATA_TAGS:
+                if tag in ds:
+                    del ds[tag]
+            self.write_chunk(separator + json.dumps(ds.to_json_dict()).encode())
+            separator = b","
+        self.write_chunk(b"]" if separator == b"," else b"[]")
+        self.end_chunked()
+
+    def send_body(self, status, body=b"", content_type=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+
+    def end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        logging.info(f"DICOMweb {self.address_string()}: {format % args}")
+
+
+class DICOMwebServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        workers.share_port(self.socket)
+        super().server_bind()
+
+
+def start_server(port, host="0.0.0.0"):
+    server = DICOMwebServer((host, port), DICOMwebRequestHandler)
+    threading.Thread(target=server.serve_forever, name="dicomweb-server", daemon=True).start()
+    logging.info(f"Serving DICOMweb at http://{host}:{port}{PREFIX}")
+    return server
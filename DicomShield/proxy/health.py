@@ -0,0 +1,80 @@
+"""Startup checks of the upstream PACS and the pseudonymization server, and the readiness state they result in.
+
+DicomShield opens its listeners right away and runs the checks in parallel in the background, each bounded by
+STARTUP.TIMEOUT seconds. It is ready once at least one upstream answers a C-ECHO and the pseudonymization server
+responds; until then the checks are repeated every STARTUP.RETRY_INTERVAL seconds. The state is served at /ready on
+the metrics port.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+
+import metrics
+import upstreams
+from settings import config
+
+startup_config = config.get("STARTUP", {})
+TIMEOUT = startup_config.get("TIMEOUT", 10)
+RETRY_INTERVAL = startup_config.get("RETRY_INTERVAL", 10)
+
+ready = threading.Event()
+checks = {}  # check -> "ok" or what failed
+
+
+def echo(upstream, timeout):
+    ae = AE(ae_title="DICOMSHIELD")
+    ae.add_requested_context(Verification)
+    ae.connection_timeout = ae.acse_timeout = ae.dimse_timeout = ae.network_timeout = timeout
+    assoc = ae.associate(upstream.ip, upstream.port, ae_title=upstream.aet)
+    if not assoc.is_established:
+        raise ConnectionError(f"association to {upstream.ip}:{upstream.port} could not be established")
+    try:
+        status = assoc.send_c_echo()
+    finally:
+        assoc.release()
+    if not status or status.Status != 0x0000:
+        raise ConnectionError(f"C-ECHO failed with status {hex(status.Status) if status else 'none'}")
+
+
+def check(pseudonym_client, timeout=TIMEOUT):
+    """Runs all checks in parallel for at most `timeout` seconds, returns whether DicomShield is ready"""
+    tasks = {f"upstream '{upstream.name}'": (echo, upstream, timeout) for upstream in upstreams.upstreams}
+    tasks["pseudonymization server"] = (pseudonym_client.test_connection,)
+    executor = ThreadPoolExecutor(len(tasks), thread_name_prefix="startup-check")
+    futures = {executor.submit(*task): name for name, task in tasks.items()}
+    _, pending = wait(futures, timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future, name in futures.items():
+        if future in pending:
+            checks[name] = f"no answer within {timeout}s"
+        elif future.exception() is not None:
+            checks[name] = str(future.exception()) or type(future.exception()).__name__
+        else:
+            checks[name] = "ok"
+        if checks[name] == "ok":
+            logging.info(f"Startup check of {name}: ok")
+        else:
+            logging.warning(f"Startup check of {name} failed: {checks[name]}")
+
+    # With several upstreams, the reachable ones are served
+    upstream_ok = any(result == "ok" for name, result in checks.items() if name.startswith("upstream"))
+    return upstream_ok and checks["pseudonymization server"] == "ok"
+
+
+def watch(pseudonym_client):
+    """Checks in a background thread until DicomShield is ready"""
+    def run():
+        started = time.monotonic()
+        while not check(pseudonym_client):
+            time.sleep(RETRY_INTERVAL)
+        ready.set()
+        logging.info(f"DicomShield is ready after {time.monotonic() - started:.1f}s")
+
+    metrics.READY.set_function(lambda: 1 if ready.is_set() else 0)
+    metrics.set_readiness(lambda: (ready.is_set(), dict(checks)))
+    threading.Thread(target=run, name="startup-checks", daemon=True).start()
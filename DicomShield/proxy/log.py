@@ -0,0 +1,168 @@
+"""Logging setup of DicomShield and structured events for the DIMSE hot path.
+
+    log.event("find.done", calling_aet="WEASIS", results=12, seconds=0.41)
+
+logs `find.done calling_aet=WEASIS results=12 seconds=0.410` (or a JSON object with FORMAT: json). The message is
+only formatted if a handler writes it. Events can be sampled per operation (the part of the name before the dot)
+and are rate limited per name; the number of suppressed events is added to the next one that is written.
+Complete datasets are only logged with DUMP_DATASETS and the DEBUG level; pynetdicom, which logs every identifier
+at INFO, is set to WARNING unless LOGGERS says otherwise.
+"""
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+import settings
+from settings import config
+
+PENDING = (0xFF00, 0xFF01)
+TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Events go to the root logger like all other messages of DicomShield, so LEVEL and the handler apply to both
+_root = logging.getLogger()
+
+_sample = {}
+_rate_limit = 50  # events per second and name, 0 for unlimited
+_dump_datasets = False
+_buckets = {}  # name -> [tokens, last refill, suppressed]
+_lock = threading.Lock()
+
+
+class Event:
+    """Log message of an event, formatted on first use"""
+    __slots__ = ("name", "fields")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return self.name + "".join(f" {key}={_format_value(value)}" for key, value in self.fields.items())
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    value = str(value)
+    return repr(value) if not value or " " in value else value
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": self.formatTime(record, DATE_FORMAT), "level": record.levelname, "logger": record.name}
+        if isinstance(record.msg, Event) and not record.args:
+            entry["event"] = record.msg.name
+            entry.update({key: value if isinstance(value, (int, float, bool)) else str(value)
+                          for key, value in record.msg.fields.items()})
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def configure(entry=None):
+    """Configures the root logger once, from LOGGING in config.yml"""
+    global _sample, _rate_limit, _dump_datasets
+    entry = entry if entry is not None else config.get("LOGGING", {})
+    handler = logging.StreamHandler()
+    if entry.get("FORMAT", "text") == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    logging.basicConfig(level=entry.get("LEVEL", "INFO"), handlers=[handler], force=True)
+    # pynetdicom logs every request identifier and response at INFO
+    for name, level in {"pynetdicom": "WARNING", **entry.get("LOGGERS", {})}.items():
+        logging.getLogger(name).setLevel(level)
+
+    _sample = {operation: float(rate) for operation, rate in entry.get("SAMPLE", {}).items()}
+    _rate_limit = entry.get("RATE_LIMIT", 50)
+    _dump_datasets = entry.get("DUMP_DATASETS", False)
+
+
+def _reconfigure(changed):
+    if "LOGGING" in changed:
+        configure()
+
+
+settings.on_reload(_reconfigure)
+
+
+def _admit(name):
+    """Applies sampling and rate limiting, returns the number of suppressed events or None to drop this one"""
+    rate = _sample.get(name, _sample.get(name.split(".", 1)[0]))
+    if rate is not None and random.random() >= rate:
+        return None
+    if not _rate_limit:
+        return 0
+    now = time.monotonic()
+    with _lock:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            bucket = _buckets[name] = [_rate_limit, now, 0]
+        bucket[0] = min(_rate_limit, bucket[0] + (now - bucket[1]) * _rate_limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return None
+        bucket[0] -= 1
+        suppressed, bucket[2] = bucket[2], 0
+        return suppressed
+
+
+def event(name, level=logging.INFO, **fields):
+    if not _root.isEnabledFor(level):
+        return
+    suppressed = _admit(name)
+    if suppressed is None:
+        return
+    if suppressed:
+        fields["suppressed"] = suppressed
+    _root.log(level, Event(name, fields))
+
+
+def dataset(label, ds):
+    """Logs `ds` completely, only with DUMP_DATASETS and the DEBUG level"""
+    if _dump_datasets and _root.isEnabledFor(logging.DEBUG):
+        _root.debug("%s:\n%s", label, ds)
+
+
+def summarized(operation):
+    """Decorator for pynetdicom handlers that logs one `<operation>.done` event per request, with the calling AE
+    title, query level and UID, number of results, final status and duration"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(request, *args, **kwargs):
+            if not _root.isEnabledFor(logging.INFO):
+                yield from function(request, *args, **kwargs)
+                return
+            started = time.perf_counter()
+            identifier = request.identifier
+            fields = {"calling_aet": request.assoc.requestor.ae_title,
+                      "query_level": identifier.get("QueryRetrieveLevel", ""),
+                      "study_uid": identifier.get("StudyInstanceUID", "")}
+            results, status = 0, "closed"
+            handler = function(request, *args, **kwargs)
+            try:
+                for item in handler:
+                    if type(item) is tuple and len(item) == 2:
+                        if item[0] in PENDING:
+                            results += 1
+                        else:
+                            status = f"0x{item[0]:04X}"
+                    yield item
+                if status == "closed":
+                    status = "0x0000"
+            except Exception as e:
+                status = type(e).__name__
+                raise
+            finally:
+                handler.close()
+                event(f"{operation}.done", **fields, results=results, status=status,
+                      seconds=time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -0,0 +1,276 @@
+"""Prometheus-compatible metrics of DicomShield, exposed over a local HTTP port."""
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import profiler
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATIO_BUCKETS = (1, 1.25, 1.5, 2, 2.5, 3, 4, 6, 8)
+
+REGISTRY = []
+
+_readiness = None  # () -> (ready, {check: result}), see health.py
+
+
+def _format_labels(labels: tuple, extra: str = ""):
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+    @abstractmethod
+    def _samples(self):
+        """The sample lines of the metric in the text exposition format"""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Gauge(Metric):
+    """A gauge that is either set directly or read from a callback at scrape time."""
+    type = "gauge"
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        with self._lock:
+            self._functions[tuple(sorted(labels.items()))] = function
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:
+                logging.warning(f"Could not read gauge {self.name}: {e}")
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # labels -> [bucket counts..., sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the `with` block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def time_iter(self, iterable, **labels):
+        """Yields from `iterable` and observes the time spent waiting for its items only"""
+        elapsed = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - started
+                    return
+                elapsed += time.perf_counter() - started
+                yield item
+        finally:
+            self.observe(elapsed, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        lines = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+UPSTREAM_ASSOCIATION_SECONDS = Histogram(
+    "dicomshield_upstream_association_seconds", "Time to establish an association with the upstream PACS")
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "dicomshield_upstream_request_seconds", "Time spent waiting for upstream C-FIND/C-MOVE/C-GET responses")
+PSEUDONYM_REQUEST_SECONDS = Histogram(
+    "dicomshield_pseudonym_request_seconds", "Duration of calls to the pseudonymization server")
+ANONYMIZATION_SECONDS = Histogram(
+    "dicomshield_anonymization_seconds", "Time to anonymize and (de)pseudonymize a dataset")
+OUTBOUND_STORE_SECONDS = Histogram(
+    "dicomshield_outbound_store_seconds", "Duration of C-STORE operations to the client")
+TRANSCODE_SECONDS = Histogram(
+    "dicomshield_transcode_seconds", "Time to compress an instance for a move destination, in an encoder process")
+COMPRESSION_RATIO = Histogram(
+    "dicomshield_compression_ratio", "Uncompressed to compressed pixel data size of instances compressed for move "
+    "destinations", RATIO_BUCKETS)
+
+INSTANCES_TOTAL = Counter("dicomshield_instances_total", "Instances received from upstream and forwarded to clients")
+RECEIVED_BYTES_TOTAL = Counter("dicomshield_received_bytes_total", "Encoded bytes of instances received from upstream")
+PSEUDONYM_CACHE_TOTAL = Counter("dicomshield_pseudonym_cache_total", "Pseudonym cache lookups by result")
+PSEUDONYM_CACHE_EVICTIONS_TOTAL = Counter("dicomshield_pseudonym_cache_evictions_total",
+                                          "Entries of the shared pseudonym cache replaced by newer ones")
+DESTINATION_ASSOCIATIONS_TOTAL = Counter("dicomshield_destination_associations_total",
+                                         "Associations to move destinations by result (new or reused from the pool)")
+AUDIT_WRITTEN_TOTAL = Counter("dicomshield_audit_written_total", "Events written to the audit log")
+AUDIT_DROPPED_TOTAL = Counter("dicomshield_audit_dropped_total",
+                              "Audit events dropped because the buffer was full or the file could not be written")
+REQUESTS_TOTAL = Counter("dicomshield_requests_total", "DIMSE requests received from clients")
+DECOMPRESSED_TOTAL = Counter("dicomshield_decompressed_total",
+                             "Instances decompressed because the destination did not accept their transfer syntax")
+
+QUEUE_DEPTH = Gauge("dicomshield_queue_depth", "Instances waiting to be forwarded to a client")
+ACTIVE_ASSOCIATIONS = Gauge("dicomshield_active_associations", "Currently open associations")
+DESTINATION_POOL_ASSOCIATIONS = Gauge("dicomshield_destination_pool_associations",
+                                      "Pooled associations to move destinations by state")
+AUDIT_PENDING = Gauge("dicomshield_audit_pending", "Audit events waiting to be written")
+READY = Gauge("dicomshield_ready", "1 once the startup checks of upstreams and pseudonymization server passed")
+CIRCUIT_OPEN = Gauge("dicomshield_pseudonym_circuit_open", "1 while the pseudonymization circuit breaker is open")
+
+
+def set_readiness(function):
+    global _readiness
+    _readiness = function
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    profiling = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            self.send_text(render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/ready":
+            ready, checks = _readiness() if _readiness else (True, {})
+            text = "ready\n" if ready else "not ready\n"
+            self.send_text(text + "".join(f"{name}: {result}\n" for name, result in checks.items()),
+                           status=200 if ready else 503)
+        elif self.profiling and url.path in ("/debug/profile", "/debug/memory"):
+            self.debug(url.path, parse_qs(url.query))
+        else:
+            self.send_error(404)
+
+    def debug(self, path, query):
+        try:
+            seconds = float(query["seconds"][0]) if "seconds" in query else None
+            limit = int(query.get("limit", ["20"])[0])
+        except ValueError:
+            self.send_error(400, "seconds and limit must be numbers")
+            return
+        if seconds is not None and not 0 < seconds <= profiler.MAX_SECONDS:
+            self.send_error(400, f"seconds must be between 0 and {profiler.MAX_SECONDS}")
+            return
+
+        if path == "/debug/profile":
+            try:
+                stacks = profiler.profile(seconds or 10, idle=query.get("idle") == ["1"])
+            except profiler.ProfilerBusy as e:
+                self.send_error(409, str(e))
+                return
+            self.send_text(profiler.folded(stacks))
+        elif query.get("stop") == ["1"]:
+            profiler.stop_memory()
+            self.send_text("tracemalloc stopped\n")
+        else:
+            self.send_text(profiler.memory(seconds, limit))
+
+    def send_text(self, text, content_type="text/plain; charset=utf-8", status=200):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the log
+
+
+def start_server(port, host="0.0.0.0", profiling=False):
+    """Serves /metrics, and the /debug endpoints of profiler.py with `profiling`"""
+    MetricsRequestHandler.profiling = profiling
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,133 @@
+"""On-demand sampling profiler and memory snapshots, served on the metrics port with METRICS.PROFILING.
+
+    curl 'localhost:9100/debug/profile?seconds=30' > dicomshield.folded
+    flamegraph.pl dicomshield.folded > dicomshield.svg   # or load the file into speedscope
+
+samples the Python stacks of all threads every INTERVAL seconds and returns them in the folded format of flame
+graphs ("thread;module:function;... count" per line). Threads waiting for work (in Condition.wait, select, ...) are
+left out unless `idle=1` is given.
+
+    curl 'localhost:9100/debug/memory'               # starts tracemalloc, later calls diff against the previous one
+    curl 'localhost:9100/debug/memory?seconds=60'    # allocations of the next 60 seconds that are still held
+
+lists the allocation sites (with tracebacks) whose held memory grew the most, e.g. the pseudonymized datasets
+buffered in pending_moves, and the number of live pydicom Datasets.
+"""
+import gc
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from pydicom import Dataset
+
+INTERVAL = 0.005
+MAX_SECONDS = 60  # of a profile or a memory diff, the request thread is busy until then
+TRACEMALLOC_FRAMES = 16
+
+# Python frames in which a thread waits instead of working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+    ("socketserver.py", "serve_forever"),
+    ("dul.py", "run_reactor"),  # pynetdicom polls its sockets with short sleeps
+    ("association.py", "_run_reactor"),
+    ("transport.py", "ready"),
+    ("destinations.py", "_expire"),
+}
+
+_profiling = threading.Lock()
+_memory_lock = threading.Lock()
+_baseline = None
+
+
+class ProfilerBusy(Exception):
+    """Another profile is being taken"""
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    # Spaces and semicolons separate the folded format, e.g. "<frozen importlib._bootstrap>"
+    return f"{module}:{code.co_name}".replace(" ", "_").replace(";", "_")
+
+
+def profile(seconds, interval=INTERVAL, idle=False):
+    """Samples the stacks of all other threads for `seconds`, returns {folded stack: samples}"""
+    if not _profiling.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already being taken")
+    try:
+        own = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(_frame_name(frame))
+                    frame = frame.f_back
+                # Numbered threads of the same kind are merged into one root
+                thread = re.split(r"[ @(]", names.get(ident, ""))[0].rstrip("0123456789-_")
+                stacks[";".join([thread or "thread"] + frames[::-1])] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profiling.release()
+
+
+def folded(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+
+
+def memory(seconds=None, limit=20):
+    """Text report of the allocation sites whose held memory grew the most since the previous call (or during the
+    next `seconds`). The first call only starts tracemalloc."""
+    global _baseline
+    with _memory_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _baseline = _snapshot()
+            if seconds is None:
+                return "tracemalloc started, call again for the allocations held since now\n"
+        if seconds is not None:
+            _baseline = _snapshot()
+            time.sleep(seconds)
+        current = _snapshot()
+        differences = current.compare_to(_baseline, "traceback")
+        _baseline = current
+
+    datasets = sum(1 for obj in gc.get_objects() if isinstance(obj, Dataset))
+    traced, peak = tracemalloc.get_traced_memory()
+    lines = [f"Traced memory {traced / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB), {datasets} live Datasets", ""]
+    for difference in differences[:limit]:
+        lines.append(f"{difference.size_diff / 1e6:+.2f} MB ({difference.count_diff:+d} blocks), "
+                     f"{difference.size / 1e6:.2f} MB held")
+        lines.extend(f"    {line}" for line in difference.traceback.format(most_recent_first=True))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def stop_memory():
+    global _baseline
+    with _memory_lock:
+        tracemalloc.stop()
+        _baseline = None
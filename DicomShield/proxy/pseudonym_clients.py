@@ -1,13 +1,120 @@
 import logging
+import threading
+import time
+from collections import OrderedDict
+
 import requests
 from requests.auth import HTTPBasicAuth
-import yaml
 
 from xml.etree import ElementTree
 import xmltodict
 
-with open("configs/config.yml") as f:
-    pseudonym_config = yaml.safe_load(f)["PSEUDONYMIZATION_SERVER"]
+import metrics
+import tracing
+import workers
+from settings import config
+from shared_cache import SharedPseudonymCache, read_mappings
+
+pseudonym_config = config["PSEUDONYMIZATION_SERVER"]
+
+
+class PseudonymizationError(Exception):
+    """Raised when a value cannot be (de)pseudonymized."""
+
+
+class UnknownPseudonym(PseudonymizationError):
+    """Raised when the pseudonymization server has no original value for a pseudonym."""
+
+
+class PseudonymServerUnavailable(PseudonymizationError):
+    """Raised when the pseudonymization server is down and the local cache cannot resolve a value."""
+
+
+class CircuitBreaker:
+    """Stops calling the pseudonymization server after consecutive failures.
+
+    CLOSED: all calls go through. OPEN: no calls go through until `reset_timeout` has passed.
+    HALF_OPEN: a single probe call decides whether to close or to open again.
+    """
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.warning("PSEUDONYMIZATION_SERVER is reachable again, closing circuit breaker")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning(f"PSEUDONYMIZATION_SERVER failed {self.failures} times, "
+                                    f"serving from local cache for {self.reset_timeout}s")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class PseudonymCache:
+    """Bounded LRU cache of resolved {original: pseudonym} pairs, searchable in both directions."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._pseudonyms = OrderedDict()  # original -> pseudonym
+        self._originals = {}  # pseudonym -> original
+        self._lock = threading.Lock()
+
+    def add(self, mapping: dict):
+        with self._lock:
+            for original, pseudonym in mapping.items():
+                self._pseudonyms[original] = pseudonym
+                self._pseudonyms.move_to_end(original)
+                self._originals[pseudonym] = original
+
+            while len(self._pseudonyms) > self.max_size:
+                _, pseudonym = self._pseudonyms.popitem(last=False)
+                self._originals.pop(pseudonym, None)
+
+    def get_pseudonyms(self, originals):
+        """Returns ({original: pseudonym} for all cached values, [uncached originals])"""
+        with self._lock:
+            found = {}
+            for original in originals:
+                if original in self._pseudonyms:
+                    self._pseudonyms.move_to_end(original)
+                    found[original] = self._pseudonyms[original]
+        return found, [value for value in originals if value not in found]
+
+    def get_originals(self, pseudonyms):
+        """Returns ({pseudonym: original} for all cached values, [uncached pseudonyms])"""
+        with self._lock:
+            found = {}
+            for pseudonym in pseudonyms:
+                original = self._originals.get(pseudonym)
+                if original is not None:
+                    self._pseudonyms.move_to_end(original)
+                    found[pseudonym] = original
+        return found, [value for value in pseudonyms if value not in found]
 
 
 class PseudonymClient:
@@ -18,6 +125,46 @@ class PseudonymClient:
         self.auth = None if pseudonym_config["USER"] is None else (pseudonym_config["USER"],
                                                                    pseudonym_config["PASSWORD"])
 
+        # Every call to the server is bounded, so a slow server cannot stall the DIMSE handler threads
+        self.timeout = pseudonym_config.get("TIMEOUT", 5)
+        self.breaker = CircuitBreaker(pseudonym_config.get("FAILURE_THRESHOLD", 5),
+                                      pseudonym_config.get("RESET_TIMEOUT", 30))
+        self.cache, warm_start = self._create_cache()
+        if warm_start and pseudonym_config.get("CACHE_WARM_START"):
+            self.warm_start(pseudonym_config["CACHE_WARM_START"])
+        self.session = requests.Session()
+
+        metrics.CIRCUIT_OPEN.set_function(lambda: int(self.breaker.state == CircuitBreaker.OPEN))
+
+    @staticmethod
+    def _create_cache():
+        """Returns the cache and whether it is new, i.e. should be warmed up"""
+        size = pseudonym_config.get("CACHE_SIZE", 100000)
+        if pseudonym_config.get("SHARED_CACHE") or workers.count > 1:
+            # Created before the workers are forked, so they all share it
+            # Pairs of another server or domain in a persistent file must not be handed out
+            namespace = "\0".join(str(pseudonym_config.get(key)) for key in ("CLIENT_TYPE", "ENDPOINT_URL", "DOMAIN"))
+            cache = SharedPseudonymCache(pseudonym_config.get("SHARED_CACHE"), size, namespace)
+            return cache, cache.created
+        return PseudonymCache(size), True
+
+    def warm_start(self, path):
+        """Fills the cache with the {original: pseudonym} pairs of a CSV file"""
+        loaded = 0
+        batch = {}
+        try:
+            for original, pseudonym in read_mappings(path):
+                batch[original] = pseudonym
+                if len(batch) == 1000:
+                    self.cache.add(batch)
+                    loaded += len(batch)
+                    batch = {}
+        except OSError as e:
+            logging.warning(f"Could not warm up the pseudonym cache from {path}: {e}")
+        self.cache.add(batch)
+        loaded += len(batch)
+        logging.info(f"Loaded {loaded} pseudonyms from {path} into the cache")
+
     class PseudonymMapper:
         def __init__(self, xml):
             self.ns = {"f": "http://hl7.org/fhir"}
@@ -26,6 +173,8 @@ class PseudonymClient:
 
         def _extract_mappings(self):
             result = []
+            if self.tree is None:
+                return result
             for param in self.tree.findall('f:parameter', self.ns):
                 orig = None
                 pseudonym = None
@@ -51,7 +200,7 @@ class PseudonymClient:
         url = f"{self.base_url}/{endpoint}"
 
         try:
-            response = requests.get(url, auth=self.auth)
+            response = self.session.get(url, auth=self.auth, timeout=self.timeout)
             response.raise_for_status()
             return xmltodict.parse(ElementTree.fromstring(response.content))
         except Exception as e:
@@ -61,31 +210,80 @@ class PseudonymClient:
     def test_connection(self):
         logging.info(f"Testing connection to PSEUDONYMIZATION_SERVER='{self.base_url}'")
         url = f"{self.base_url}/metadata"
-        response = requests.get(url, auth=self.auth)
+        response = self.session.get(url, auth=self.auth, timeout=self.timeout)
         response.raise_for_status()
 
     def post(self, endpoint, data=None):
+        """Posts to the server through the circuit breaker.
+
+        Returns the parsed response, or None if the server rejected the request (4xx).
+        Raises PseudonymServerUnavailable if the server is down, slow or the breaker is open.
+        """
+        if not self.breaker.allow_request():
+            raise PseudonymServerUnavailable("Circuit breaker is open")
+
         url = f"{self.base_url}/{endpoint}"
 
         try:
-            response = requests.post(url, data=data, headers={'Content-Type': 'application/fhir+xml'}, auth=self.auth)
-            response.raise_for_status()
-            return ElementTree.fromstring(response.content)
-        except Exception as e:
-            logging.exception(f"An error occurred: {e}")
+            response = self.session.post(url, data=data, headers={'Content-Type': 'application/fhir+xml'},
+                                         auth=self.auth, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise PseudonymServerUnavailable(f"Request to {url} failed: {e}") from e
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise PseudonymServerUnavailable(f"Request to {url} failed with HTTP {response.status_code}")
+
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            logging.warning(f"Request to {url} was rejected with HTTP {response.status_code}")
             return None
 
-
-class MIIClient(PseudonymClient):
-    def __init__(self):
-        super().__init__()
+        return ElementTree.fromstring(response.content)
 
     def pseudonomize(self, identifier: dict):
+        """Returns {original: pseudonym}, served from the cache where possible"""
+        if identifier == {} or identifier is None:
+            return {}
+
+        originals = [str(value) for value in identifier.values()]
+        pseudonyms, missing = self.cache.get_pseudonyms(originals)
+        metrics.PSEUDONYM_CACHE_TOTAL.inc(len(originals) - len(missing), result="hit")
+        if missing:
+            metrics.PSEUDONYM_CACHE_TOTAL.inc(len(missing), result="miss")
+            with metrics.PSEUDONYM_REQUEST_SECONDS.time(operation="pseudonymize"), \
+                    tracing.span("pseudonymize", kind="client", values=len(missing)):
+                resolved = self._pseudonomize(missing)
+            self.cache.add(resolved)
+            pseudonyms.update(resolved)
+        return pseudonyms
+
+    def depseudonomize(self, identifier: dict):
+        """Returns {pseudonym: original}, served from the cache where possible"""
         if identifier == {} or identifier is None:
             return {}
 
+        pseudonyms = [str(value) for value in identifier.values()]
+        originals, missing = self.cache.get_originals(pseudonyms)
+        metrics.PSEUDONYM_CACHE_TOTAL.inc(len(pseudonyms) - len(missing), result="hit")
+        if missing:
+            metrics.PSEUDONYM_CACHE_TOTAL.inc(len(missing), result="miss")
+            with metrics.PSEUDONYM_REQUEST_SECONDS.time(operation="depseudonymize"), \
+                    tracing.span("depseudonymize", kind="client", values=len(missing)):
+                resolved = self._depseudonomize(missing)
+            self.cache.add({original: pseudonym for pseudonym, original in resolved.items()})
+            originals.update(resolved)
+        return originals
+
+
+class MIIClient(PseudonymClient):
+    def __init__(self):
+        super().__init__()
+
+    def _pseudonomize(self, values: list):
         fhir_body_parameters = []
-        for value in identifier.values():
+        for value in values:
             fhir_body_parameters.append(
                 f"""
                 <parameter>
@@ -114,12 +312,9 @@ class MIIClient(PseudonymClient):
         pseudonyms = self.PseudonymMapper(values).make_pseudonym_map()
         return pseudonyms
 
-    def depseudonomize(self, identifier: dict):
-        if identifier == {} or identifier is None:
-            return {}
-
+    def _depseudonomize(self, values: list):
         fhir_body_parameters = []
-        for value in identifier.values():
+        for value in values:
             fhir_body_parameters.append(
                 f"""
                 <parameter>
@@ -149,12 +344,9 @@ class gPASClient(PseudonymClient):
     def __init__(self):
         super().__init__()
 
-    def pseudonomize(self, identifier: dict):
-        if identifier == {} or identifier is None:
-            return {}
-
+    def _pseudonomize(self, values: list):
         fhir_body_parameters = []
-        for value in identifier.values():
+        for value in values:
             fhir_body_parameters.append(
                 f"""
                 <parameter>
@@ -179,12 +371,9 @@ class gPASClient(PseudonymClient):
         pseudonyms = self.PseudonymMapper(values).make_pseudonym_map()
         return pseudonyms
 
-    def depseudonomize(self, identifier: dict):
-        if identifier == {} or identifier is None:
-            return {}
-
+    def _depseudonomize(self, values: list):
         fhir_body_parameters = []
-        for value in identifier.values():
+        for value in values:
             fhir_body_parameters.append(
                 f"""
                 <parameter>
@@ -0,0 +1,68 @@
+"""Sorted index of the pseudonyms DicomShield handed out, to resolve wildcard queries on pseudonyms locally.
+
+The pseudonymization server can only translate exact values, so a C-FIND for `PatientID=PSN12*` cannot be
+depseudonymized. Every pseudonym DicomShield returns or resolves is therefore recorded with its original value, per
+attribute, in a sorted list. A pattern is matched by bisecting to its literal prefix and scanning the pseudonyms
+sharing it.
+"""
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import deque
+
+
+def is_wildcard(value: str):
+    return "*" in value or "?" in value
+
+
+def _pattern(value: str):
+    return re.compile("".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in value), re.DOTALL)
+
+
+class PseudonymIndex:
+    """{pseudonym: original} per attribute, bounded to `max_size` entries (oldest first out).
+
+    Entries added without an attribute (e.g. from CACHE_WARM_START) match for every attribute.
+    """
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self._sorted = {}  # attribute -> sorted [pseudonym]
+        self._originals = {}  # (attribute, pseudonym) -> original
+        self._order = deque()  # (attribute, pseudonym), oldest first
+        self._lock = threading.Lock()
+
+    def add(self, attribute, pseudonym, original):
+        if not self.max_size:
+            return
+        key = (attribute, pseudonym)
+        with self._lock:
+            if key in self._originals:
+                return
+            self._originals[key] = original
+            insort(self._sorted.setdefault(attribute, []), pseudonym)
+            self._order.append(key)
+            while len(self._order) > self.max_size:
+                old_attribute, old_pseudonym = old = self._order.popleft()
+                del self._originals[old]
+                pseudonyms = self._sorted[old_attribute]
+                del pseudonyms[bisect_left(pseudonyms, old_pseudonym)]
+
+    def match(self, attribute, pattern):
+        """{pseudonym: original} of the indexed pseudonyms of `attribute` matching the C-FIND wildcard `pattern`"""
+        prefix = re.split(r"[*?]", pattern, maxsplit=1)[0]
+        regex = _pattern(pattern)
+        matches = {}
+        with self._lock:
+            for indexed in (attribute, None):
+                pseudonyms = self._sorted.get(indexed, [])
+                for i in range(bisect_left(pseudonyms, prefix), len(pseudonyms)):
+                    pseudonym = pseudonyms[i]
+                    if not pseudonym.startswith(prefix):
+                        break
+                    if regex.fullmatch(pseudonym):
+                        matches.setdefault(pseudonym, self._originals[(indexed, pseudonym)])
+        return matches
+
+    def __len__(self):
+        return len(self._originals)
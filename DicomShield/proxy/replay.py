@@ -0,0 +1,131 @@
+"""Replays a capture recorded by DicomShield (see CAPTURE in config.yml) against a DicomShield instance.
+
+    python replay.py capture.jsonl.gz --host test-box --port 11112 --speed 4 --concurrency 16
+
+Requests are sent at their recorded offsets divided by --speed (0 sends them as fast as possible), each on its own
+association. C-GET instances are received and discarded; C-MOVE requests keep their recorded destination unless
+--move-destination is given.
+"""
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pydicom import Dataset
+from pynetdicom import AE, evt, StoragePresentationContexts, build_role
+from pynetdicom.sop_class import (
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelMove,
+)
+
+from capture import read
+
+# Leaves room for the query/retrieve contexts within the 128 presentation context limit
+GET_STORAGE_CONTEXTS = StoragePresentationContexts[:120]
+
+
+class Replayer:
+    def __init__(self, host, port, ae_title, calling_aet=None, move_destination=None):
+        self.host = host
+        self.port = port
+        self.ae_title = ae_title
+        self.calling_aet = calling_aet
+        self.move_destination = move_destination
+        self.results = []  # (operation, latency, ok, lag)
+        self._lock = threading.Lock()
+
+    def _associate(self, entry):
+        ae = AE(ae_title=self.calling_aet or entry["calling_aet"])
+        for model in (StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove,
+                      StudyRootQueryRetrieveInformationModelGet, PatientRootQueryRetrieveInformationModelFind,
+                      PatientRootQueryRetrieveInformationModelMove):
+            ae.add_requested_context(model)
+
+        if entry["op"] != "get":
+            return ae.associate(self.host, self.port, ae_title=self.ae_title)
+
+        for context in GET_STORAGE_CONTEXTS:
+            ae.add_requested_context(context.abstract_syntax)
+        return ae.associate(self.host, self.port, ae_title=self.ae_title,
+                            ext_neg=[build_role(cx.abstract_syntax, scp_role=True) for cx in GET_STORAGE_CONTEXTS],
+                            evt_handlers=[(evt.EVT_C_STORE, lambda event: 0x0000)])
+
+    def send(self, entry, lag):
+        started = time.perf_counter()
+        ok = False
+        try:
+            assoc = self._associate(entry)
+            if assoc.is_established:
+                identifier = Dataset.from_json(entry["identifier"])
+                match entry["op"]:
+                    case "find":
+                        responses = assoc.send_c_find(identifier, entry["model"])
+                    case "get":
+                        responses = assoc.send_c_get(identifier, entry["model"])
+                    case "move":
+                        destination = self.move_destination or entry["move_destination"]
+                        responses = assoc.send_c_move(identifier, destination, entry["model"])
+                final = None
+                for status, _ in responses:
+                    if status:
+                        final = status.Status
+                ok = final in (0x0000, 0xB000)
+                assoc.release()
+        except Exception as e:
+            logging.warning(f"Replaying {entry['op']} failed: {e}")
+
+        with self._lock:
+            self.results.append((entry["op"], time.perf_counter() - started, ok, lag))
+
+    def replay(self, entries, speed=1.0, concurrency=8):
+        started = time.monotonic()
+        with ThreadPoolExecutor(concurrency) as pool:
+            for entry in entries:
+                if speed > 0:
+                    delay = entry["t"] / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                lag = max(0.0, (time.monotonic() - started) - (entry["t"] / speed if speed > 0 else 0))
+                pool.submit(self.send, entry, lag)
+        return time.monotonic() - started
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def print_report(results, elapsed):
+    print(f"replayed {len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.1f} requests/s), "
+          f"max dispatch lag {max((lag for *_, lag in results), default=0) * 1000:.0f} ms")
+    print(f"{'operation':<10}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operation in sorted({result[0] for result in results}):
+        samples = [result for result in results if result[0] == operation]
+        latencies = [latency for _, latency, _, _ in samples]
+        print(f"{operation:<10}{len(samples):>10}{sum(1 for _, _, ok, _ in samples if not ok):>8}"
+              f"{percentile(latencies, 50) * 1000:>10.1f}{percentile(latencies, 95) * 1000:>10.1f}"
+              f"{percentile(latencies, 99) * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file written by DicomShield")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=11112)
+    parser.add_argument("--aet", default="DICOMSHIELD", help="AE title of DicomShield")
+    parser.add_argument("--calling-aet", help="calling AE title (default: the recorded one)")
+    parser.add_argument("--move-destination", help="C-MOVE destination (default: the recorded one)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum number of requests in flight")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    replayer = Replayer(args.host, args.port, args.aet, args.calling_aet, args.move_destination)
+    elapsed = replayer.replay(read(args.capture), args.speed, args.concurrency)
+    print_report(replayer.results, elapsed)
@@ -0,0 +1,66 @@
+"""The configuration of DicomShield, read once from configs/config.yml and shared by all modules.
+
+On SIGHUP (forwarded to the workers by the supervisor), reload() reads the file again and applies the RELOADABLE
+entries to `config` in place. Handlers look them up per request, so new values apply to the next request; running
+associations, pools and caches are kept. Other changed entries are logged and need a restart.
+"""
+import logging
+import signal
+import threading
+
+import yaml
+
+PATH = "configs/config.yml"
+
+# Move destinations, pseudonymized/removed fields and limits
+RELOADABLE = ("ALLOWED_AET", "FIELDS_FOR_PSEUDO", "FIELDS_FOR_REMOVAL", "MAX_QUERY_EXPANSION", "MAX_PARALLEL_GETS",
+              "MAX_PARALLEL_FINDS", "DESTINATION_POOL", "LOGGING")
+
+
+def _load():
+    with open(PATH) as f:
+        return yaml.safe_load(f) or {}
+
+
+config = _load()
+
+_listeners = []
+_lock = threading.Lock()
+
+
+def on_reload(listener):
+    """Calls `listener(changed keys)` after a reload changed RELOADABLE entries"""
+    _listeners.append(listener)
+
+
+def reload():
+    """Applies the RELOADABLE entries of the config file, returns the keys that changed"""
+    with _lock:
+        try:
+            new = _load()
+        except (OSError, yaml.YAMLError) as e:
+            logging.error(f"Could not reload {PATH}, keeping the current config: {e}")
+            return []
+
+        changed = [key for key in RELOADABLE if new.get(key) != config.get(key)]
+        for key in changed:
+            if key in new:
+                config[key] = new[key]
+            else:
+                del config[key]
+        ignored = [key for key in new.keys() | config.keys()
+                   if key not in RELOADABLE and new.get(key) != config.get(key)]
+
+        for listener in _listeners:
+            try:
+                listener(changed)
+            except Exception as e:
+                logging.error(f"Could not apply the reloaded config: {e}")
+    logging.warning(f"Reloaded {PATH}, changed: {', '.join(changed) or 'nothing'}")
+    if ignored:
+        logging.warning(f"Changes to {', '.join(sorted(ignored))} need a restart")
+    return changed
+
+
+def reload_on_sighup():
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload, name="reload").start())
@@ -0,0 +1,200 @@
+"""Pseudonym cache in shared memory, used by all worker processes (and by containers that share the file).
+
+The cache consists of two fixed-size hash tables (original -> pseudonym, pseudonym -> original) in an mmap'd file.
+A table is split into buckets of BUCKET_SLOTS slots. An entry can only be stored in the bucket of its hash and a full
+bucket replaces its least recently used slot, so memory and eviction cost are bounded.
+
+Reads take no lock. Every slot carries a sequence number that a writer makes odd while it changes the slot (seqlock);
+readers retry if the number changed while they copied the slot. Writers lock the bucket with a byte-range lock on the
+file, which also works between processes that did not fork from each other.
+
+The header records a hash of the pseudonymization server and domain the pairs were resolved with; a file written
+for another domain is cleared instead of handing out its pseudonyms.
+"""
+import csv
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import metrics
+
+MAGIC = b"DSPC0002"
+HEADER = struct.Struct("<8sII16s")  # magic, slots per table, slots per bucket, namespace hash
+HEADER_SIZE = 64
+
+SLOT = struct.Struct("<IQQBB")  # sequence, key hash (0 = empty), last use in ms, key length, value length
+SEQUENCE = struct.Struct("<I")
+LAST_USE = struct.Struct("<Q")
+LAST_USE_OFFSET = 12
+MAX_LENGTH = 64  # bytes of a key or value, longer ones are not cached (DICOM LO and UI values have at most 64)
+SLOT_SIZE = 160
+BUCKET_SLOTS = 8
+READ_RETRIES = 16
+
+FORWARD = 0  # original -> pseudonym
+REVERSE = 1  # pseudonym -> original
+
+
+def _hash(value: bytes):
+    # Unlike hash(), the same in every process; 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "little") or 1
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+class SharedPseudonymCache:
+    """Bounded cache of resolved {original: pseudonym} pairs in shared memory, searchable in both directions.
+
+    Without `path`, the memory is shared with the worker processes forked after its creation only. All processes
+    that use the same `path` must be configured with the same `max_size`. `namespace` identifies where the pairs
+    come from, e.g. the server and domain; a file created with another one is cleared.
+    """
+
+    def __init__(self, path=None, max_size=100000, namespace=""):
+        self.buckets = max(1, -(-max_size // BUCKET_SLOTS))
+        self.slots = self.buckets * BUCKET_SLOTS
+        self._table_size = self.slots * SLOT_SIZE
+        size = HEADER_SIZE + 2 * self._table_size
+
+        if path is None:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            self._fd, temporary = tempfile.mkstemp(prefix="dicomshield-pseudonyms-", dir=directory)
+            os.unlink(temporary)
+        else:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # Whoever comes first initializes the file, others reuse its entries
+        self.created = False
+        namespace_hash = hashlib.blake2b(namespace.encode(), digest_size=16).digest()
+        expected = HEADER.pack(MAGIC, self.slots, BUCKET_SLOTS, namespace_hash)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            header = os.pread(self._fd, HEADER.size, 0)
+            if header != expected:
+                if header[:HEADER.size - 16] == expected[:HEADER.size - 16]:
+                    logging.warning(f"Pseudonym cache {path} belongs to another pseudonymization domain, clearing it")
+                elif any(header):
+                    logging.warning(f"Pseudonym cache {path} has a different layout, clearing it")
+                self._clear(size)
+                os.pwrite(self._fd, expected, 0)
+                self.created = True
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+
+        self._mm = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()  # byte-range locks don't exclude the threads of a process
+
+    def _clear(self, size):
+        # Other processes may still have the file mapped: truncating it would make their next access a SIGBUS,
+        # so it only ever grows and the slots are zeroed in place
+        current = os.fstat(self._fd).st_size
+        if current < size:
+            os.ftruncate(self._fd, size)
+        end = max(current, size)
+        zeros = bytes(1 << 20)
+        for offset in range(0, end, len(zeros)):
+            os.pwrite(self._fd, zeros[:end - offset], offset)
+
+    def _bucket(self, table, key_hash):
+        return HEADER_SIZE + table * self._table_size + key_hash % self.buckets * BUCKET_SLOTS * SLOT_SIZE
+
+    def _get(self, table, key):
+        key = key.encode()
+        if len(key) > MAX_LENGTH:
+            return None
+        key_hash = _hash(key)
+        bucket = self._bucket(table, key_hash)
+        mm = self._mm
+        for offset in range(bucket, bucket + BUCKET_SLOTS * SLOT_SIZE, SLOT_SIZE):
+            for _ in range(READ_RETRIES):
+                sequence = SEQUENCE.unpack_from(mm, offset)[0]
+                data = mm[offset:offset + SLOT_SIZE]
+                if sequence & 1 or SEQUENCE.unpack_from(mm, offset)[0] != sequence:
+                    continue  # written right now
+                _, slot_hash, _, key_length, value_length = SLOT.unpack_from(data)
+                if slot_hash != key_hash or data[SLOT.size:SLOT.size + key_length] != key:
+                    break
+                # Unlocked, a lost update only makes the eviction less exact
+                LAST_USE.pack_into(mm, offset + LAST_USE_OFFSET, _now())
+                start = SLOT.size + MAX_LENGTH
+                return data[start:start + value_length].decode()
+        return None
+
+    def _put(self, table, key, value):
+        key, value = key.encode(), value.encode()
+        if len(key) > MAX_LENGTH or len(value) > MAX_LENGTH:
+            return
+        key_hash = _hash(key)
+        bucket = self._bucket(table, key_hash)
+        mm = self._mm
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, BUCKET_SLOTS * SLOT_SIZE, bucket)
+            try:
+                target = empty = oldest = None
+                oldest_use = None
+                for offset in range(bucket, bucket + BUCKET_SLOTS * SLOT_SIZE, SLOT_SIZE):
+                    _, slot_hash, last_use, key_length, _ = SLOT.unpack_from(mm, offset)
+                    if slot_hash == 0:
+                        empty = empty or offset
+                    elif slot_hash == key_hash and mm[offset + SLOT.size:offset + SLOT.size + key_length] == key:
+                        target = offset
+                        break
+                    elif oldest_use is None or last_use < oldest_use:
+                        oldest, oldest_use = offset, last_use
+                if target is None:
+                    target = empty or oldest
+                    if empty is None:
+                        metrics.PSEUDONYM_CACHE_EVICTIONS_TOTAL.inc()
+
+                sequence = SEQUENCE.unpack_from(mm, target)[0]
+                SEQUENCE.pack_into(mm, target, (sequence + 1) & 0xFFFFFFFF)
+                slot = (SLOT.pack(0, key_hash, _now(), len(key), len(value))
+                        + key.ljust(MAX_LENGTH, b"\0") + value.ljust(MAX_LENGTH, b"\0"))
+                mm[target + SEQUENCE.size:target + len(slot)] = slot[SEQUENCE.size:]
+                SEQUENCE.pack_into(mm, target, (sequence + 2) & 0xFFFFFFFF)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, BUCKET_SLOTS * SLOT_SIZE, bucket)
+
+    def add(self, mapping: dict):
+        for original, pseudonym in mapping.items():
+            self._put(FORWARD, original, pseudonym)
+            self._put(REVERSE, pseudonym, original)
+
+    def get_pseudonyms(self, originals):
+        """Returns ({original: pseudonym} for all cached values, [uncached originals])"""
+        found = {}
+        for original in originals:
+            pseudonym = self._get(FORWARD, original)
+            if pseudonym is not None:
+                found[original] = pseudonym
+        return found, [value for value in originals if value not in found]
+
+    def get_originals(self, pseudonyms):
+        """Returns ({pseudonym: original} for all cached values, [uncached pseudonyms])"""
+        found = {}
+        for pseudonym in pseudonyms:
+            original = self._get(REVERSE, pseudonym)
+            if original is not None:
+                found[pseudonym] = original
+        return found, [value for value in pseudonyms if value not in found]
+
+
+def read_mappings(path):
+    """Yields the (original, pseudonym) pairs of a CSV file, e.g. an export of the gPAS domain"""
+    with open(path, newline="") as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        for row in csv.reader(f, dialect):
+            if len(row) >= 2 and row[0] and row[1] and row[0].lower() != "original":
+                yield row[0].strip(), row[1].strip()
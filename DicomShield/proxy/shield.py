@@ -14,11 +14,22 @@ from pynetdicom.sop_class import (
     Verification
 )
 
+import audit
+import capture
+import destinations
+import dicomweb
+import health
+import log
+import metrics
+import settings
+import tracing
+import transcoding
+import workers
 from c_handlers import *
-from utils import shared_queue, shield_anonymizer
+from pseudonym_clients import PseudonymizationError
+from utils import pending_moves, shield_anonymizer
 
-# Configure logging
-logging.basicConfig(level=logging.WARNING)
+log.configure()
 
 
 def run_ae_server():
@@ -27,12 +38,12 @@ def run_ae_server():
     ae_title = config["INGRESS"]["AET"]
     logging.info(f"Starting DicomShield with AE Title='{ae_title}' at port {local_port}...")
 
-    ae = AE(ae_title=ae_title)
+    ae = destinations.PooledAE(ae_title=ae_title)
 
     # Add all necessary SOP Classes (associations this SCU/SCP will accept)
 
     for context in AllStoragePresentationContexts:
-        ae.add_supported_context(context.abstract_syntax, scu_role=True, scp_role=True)
+        ae.add_supported_context(context.abstract_syntax, ingressTransferSyntaxes, scu_role=True, scp_role=True)
 
     ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
     ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
@@ -52,7 +63,23 @@ def run_ae_server():
         (evt.EVT_C_ECHO, handle_echo),
     ]
 
-    ae.start_server(('0.0.0.0', local_port), evt_handlers=handlers, block=True)
+    metrics.ACTIVE_ASSOCIATIONS.set_function(lambda: len(ae.active_associations), server="ingress")
+    serve(ae, ('0.0.0.0', local_port), handlers, block=True)
+
+
+def serve(ae, address, handlers, block):
+    """Like AE.start_server, but the port can be shared by the worker processes (see workers.py).
+
+    AE.start_server takes no server class, so the server is made here and its thread is watched by the worker
+    health checks. Returns the server, once it is shut down if `block`.
+    """
+    server = ae.make_server(address, evt_handlers=handlers, server_class=workers.ReusePortServer)
+    thread = threading.Thread(target=server.serve_forever, name="AcceptorServer", daemon=True)
+    thread.start()
+    workers.listening(f"{ae.ae_title} at port {address[1]}", thread)
+    if block:
+        thread.join()
+    return server
 
 
 def handle_established(evt):
@@ -68,47 +95,94 @@ def run_internal_server():
 
     # 1. Define the C-STORE SCP callback that anonymizes and forwards
     def proxy_store(internal_event):
-        logging.info(f"proxy-store(...) was called: {internal_event}")
+        log.event("store.received", logging.DEBUG, sop_instance_uid=internal_event.request.AffectedSOPInstanceUID)
+        metrics.INSTANCES_TOTAL.inc(direction="received")
+        metrics.RECEIVED_BYTES_TOTAL.inc(len(internal_event.request.DataSet.getvalue()))
+        request = internal_event.request
+        msg_id = request.MoveOriginatorMessageID
+        if msg_id is not None and workers.owner(msg_id) != workers.index:
+            # The C-MOVE was issued by another worker process
+            return workers.hand_over(msg_id, internal_event)
+
+        if not pending_moves.is_open(msg_id):
+            # The C-MOVE has been cancelled, don't spend a pseudonymization request on it
+            logging.info(f"Dropping instance {request.AffectedSOPInstanceUID} of a cancelled C-MOVE")
+            return 0xA700  # Out of resources
+
         ds = internal_event.dataset
         ds.file_meta = internal_event.file_meta
-
-        # Anonymize
-        ds = shield_anonymizer.shield_retrieve(ds)
-
-        shared_queue.put(ds)
-        logging.info(f"dataset was put in the queue {internal_event}")
-        return 0x0000
+        return store_moved_instance(msg_id, ds)
 
     handlers = [(evt.EVT_C_STORE, proxy_store), (evt.EVT_C_ECHO, handle_echo)]
     ae = AE(ae_title=local_ae)
 
     for context in AllStoragePresentationContexts:
-        ae.add_supported_context(context.abstract_syntax)
+        ae.add_supported_context(context.abstract_syntax, internalTransferSyntaxes)
 
     ae.add_supported_context(Verification)
 
-    ae = ae.start_server(('0.0.0.0', local_port), block=False, evt_handlers=handlers)
+    server = serve(ae, ('0.0.0.0', local_port), handlers, block=False)
+    metrics.ACTIVE_ASSOCIATIONS.set_function(lambda: len(server.active_associations), server="internal")
 
     # server = threading.Thread(target=ae.start_server, args=(('0.0.0.0', local_port),), kwargs={'block': True, 'evt_handlers': handlers})
     # server.start()
     logging.info(f"Started C-STORE SCP server on AE title '{local_ae}' at port {local_port}")
-    return ae
-
-
-def verify_proxy_connection():
-    ip, port = config["UPSTREAM"]["IP"], config["UPSTREAM"]["PORT"]
-    logging.info(f"Testing proxy target ({ip}:{port}) using C-ECHO...")
-    ae = AE(ae_title="DICOMSHIELD")
-    ae.add_requested_context(Verification)
-    assoc = ae.associate(ip, port, ae_title=config["UPSTREAM"].get("AET", "ANY-SCP"))
-    if assoc.is_established:
-        status = assoc.send_c_echo()
-        logging.info(f"C-ECHO response status: {hex(status.Status)}")
-        assert status.Status == 0x0000, f"C-ECHO failed with status: {hex(status.Status)}"
-        assoc.release()
-    else:
-        logging.info(f"Association to target could not be established.")
-        exit(1)
+    return server
+
+
+def store_moved_instance(msg_id, ds):
+    """Pseudonymizes an instance of the upstream C-MOVE `msg_id` and buffers it for forwarding"""
+    with tracing.span("internal.C-STORE", parent=tracing.bound(("move", msg_id)), kind="server",
+                      sop_instance_uid=ds.get("SOPInstanceUID", "")):
+        if not pending_moves.is_open(msg_id):
+            logging.info(f"Dropping instance {ds.get('SOPInstanceUID')} of a cancelled C-MOVE")
+            return 0xA700  # Out of resources
+
+        # Anonymize
+        try:
+            ds = shield_anonymizer.shield_retrieve(ds)
+        except PseudonymizationError as e:
+            logging.error(f"Dropping instance {ds.get('SOPInstanceUID')}: {e}")
+            return 0xA700  # Out of resources
+
+        if not pending_moves.add(msg_id, ds):
+            logging.info(f"Dropping instance {ds.get('SOPInstanceUID')} of a cancelled C-MOVE")
+            return 0xA700  # Out of resources
+    return 0x0000
+
+
+def run_worker():
+    # Forks the encoder processes, before the threads below are started
+    transcoding.start()
+    settings.reload_on_sighup()
+
+    if "METRICS" in config:
+        # Every worker process serves its own metrics, on consecutive ports
+        metrics.QUEUE_DEPTH.set_function(pending_moves.qsize)
+        metrics.start_server(config["METRICS"]["PORT"] + workers.index, config["METRICS"].get("HOST", "0.0.0.0"),
+                             config["METRICS"].get("PROFILING", False))
+
+    if "TRACING" in config:
+        tracing.configure(workers.per_worker(config["TRACING"].get("FILE")), config["TRACING"].get("ENDPOINT"),
+                          config["TRACING"].get("SERVICE_NAME", "dicomshield"))
+
+    if "CAPTURE" in config:
+        capture.configure(workers.per_worker(config["CAPTURE"]["FILE"]), shield_anonymizer)
+
+    if "AUDIT" in config:
+        audit.configure(config["AUDIT"], workers.per_worker(config["AUDIT"]["FILE"]))
+
+    if workers.count > 1:
+        workers.serve_hand_overs(store_moved_instance)
+
+    if "DICOMWEB" in config:
+        dicomweb.start_server(config["DICOMWEB"]["PORT"], config["DICOMWEB"].get("HOST", "0.0.0.0"))
+
+    # Upstreams and pseudonymization server are checked while the listeners already accept associations
+    health.watch(shield_anonymizer.pseudonym_client)
+
+    internal_server = run_internal_server()
+    run_ae_server()
 
 
 if __name__ == '__main__':
@@ -117,11 +191,7 @@ if __name__ == '__main__':
 | . | |  _| . |     |_ -|   | | -_| | . |
 |___|_|___|___|_|_|_|___|_|_|_|___|_|___|""")
 
-    # test upstream connection
-    verify_proxy_connection()
-
-    # test gPAS-connection
-    shield_anonymizer.pseudonym_client.test_connection()
-
-    forward_ae = run_internal_server()
-    run_ae_server()
+    if workers.count > 1:
+        workers.supervise(run_worker)
+    else:
+        run_worker()
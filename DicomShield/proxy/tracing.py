@@ -0,0 +1,206 @@
+"""Per-request tracing of the DIMSE and pseudonymization hops, exported as OpenTelemetry (OTLP/JSON) spans."""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from queue import Queue, Empty, Full
+
+import requests
+
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+_exporter = None
+_local = threading.local()
+
+# Spans that are continued in another thread, e.g. the C-STORE sub-operations of an upstream C-MOVE
+_bound_spans = {}
+_bound_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, parent=None, kind="internal", attributes=None):
+        parent = parent if isinstance(parent, Span) else None
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, message):
+        self.error = str(message)
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        if _exporter is not None:
+            _exporter.export(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoopSpan:
+    """Returned while tracing is disabled, so callers never have to check"""
+    trace_id = span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, message):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    stack = _stack()
+    return stack[-1] if stack else NOOP_SPAN
+
+
+@contextmanager
+def span(name, parent=None, kind="internal", **attributes):
+    """Creates a child span of `parent` (default: the current span of this thread) for the `with` block"""
+    if _exporter is None:
+        yield NOOP_SPAN
+        return
+
+    new_span = Span(name, parent if parent is not None else current_span(), kind, attributes)
+    stack = _stack()
+    stack.append(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            new_span.record_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        # Generators may be finalized out of order, so remove exactly this span
+        if new_span in stack:
+            stack.remove(new_span)
+        new_span.end()
+
+
+def traced(name, kind="internal"):
+    """Decorator that runs a generator function (e.g. a pynetdicom handler) inside a new span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, kind=kind):
+                yield from function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(key, bound_span):
+    """Makes `bound_span` available to other threads under `key`"""
+    if bound_span is NOOP_SPAN or bound_span is None:
+        return
+    with _bound_lock:
+        _bound_spans[key] = bound_span
+
+
+def unbind(key):
+    with _bound_lock:
+        _bound_spans.pop(key, None)
+
+
+def bound(key):
+    with _bound_lock:
+        return _bound_spans.get(key)
+
+
+class Exporter:
+    """Batches finished spans in a background thread and writes them to a file and/or an OTLP/HTTP collector"""
+
+    def __init__(self, file=None, endpoint=None, service_name="dicomshield", batch_size=512, interval=2):
+        self.file = file
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = Queue(maxsize=100000)
+        threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def export(self, finished_span):
+        try:
+            self.queue.put_nowait(finished_span)
+        except Full:
+            pass  # Never block a handler thread for tracing
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        body = {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "dicomshield"}, "spans": [s.to_otlp() for s in batch]}],
+        }]}
+
+        if self.file:
+            try:
+                with open(self.file, "a") as f:
+                    f.write(json.dumps(body, separators=(",", ":")) + "\n")
+            except OSError as e:
+                logging.warning(f"Could not write traces to {self.file}: {e}")
+
+        if self.endpoint:
+            try:
+                requests.post(self.endpoint, json=body, timeout=5).raise_for_status()
+            except requests.RequestException as e:
+                logging.warning(f"Could not export traces to {self.endpoint}: {e}")
+
+
+def configure(file=None, endpoint=None, service_name="dicomshield"):
+    global _exporter
+    _exporter = Exporter(file, endpoint, service_name)
+    logging.info(f"Tracing enabled (file={file}, endpoint={endpoint})")
@@ -0,0 +1,142 @@
+"""Lossless compression of the instances sent to move destinations behind slow links.
+
+An ALLOWED_AET entry given as a mapping can set a COMPRESS policy for the destination:
+
+    ALLOWED_AET:
+      RESEARCH: {IP: 10.8.0.12, PORT: 104, COMPRESS: rle}
+
+"rle" encodes the pixel data of uncompressed instances with RLE Lossless. The encoding runs in a pool of
+TRANSCODING.PROCESSES processes per worker, up to TRANSCODING.QUEUE instances ahead of the C-STORE sub-operation
+that is being sent, so the CPU works while the link is busy. "deflate" sends Deflated Explicit VR Little Endian,
+which pynetdicom applies to the whole dataset while sending. Instances are only compressed if the destination
+accepted the transfer syntax for their SOP class; otherwise, or if encoding fails, they are sent as they are.
+"""
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+
+from pydicom.uid import DeflatedExplicitVRLittleEndian, RLELossless
+
+import metrics
+from settings import config
+
+POLICIES = {
+    "rle": RLELossless,
+    "deflate": DeflatedExplicitVRLittleEndian,
+}
+
+transcoding_config = config.get("TRANSCODING", {})
+PROCESSES = transcoding_config.get("PROCESSES", 2)
+QUEUE = transcoding_config.get("QUEUE", 8)
+
+_executor = None
+_warned = set()
+
+
+def transfer_syntax(target):
+    """Transfer syntax of the COMPRESS policy of an ALLOWED_AET entry, None without one"""
+    policy = target.get("COMPRESS") if isinstance(target, dict) else None
+    if not policy:
+        return None
+    if str(policy).lower() not in POLICIES:
+        _warn_once(f"policy {policy}", f"Unknown COMPRESS policy '{policy}', instances are sent as they are")
+        return None
+    return POLICIES[str(policy).lower()]
+
+
+def _warn_once(key, message):
+    if key not in _warned:
+        _warned.add(key)
+        logging.warning(message)
+
+
+def _init_encoder(parent):
+    # The worker handles reloads and shutdown, the encoders end with it, also if it is killed
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_exit_with, args=(parent,), daemon=True).start()
+
+
+def _exit_with(parent):
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+
+def start():
+    """Starts the encoder processes if a destination has a COMPRESS policy or TRANSCODING is configured.
+
+    The processes are forked right away, before the worker starts its threads.
+    """
+    global _executor
+    needed = "TRANSCODING" in config or any(transfer_syntax(target) == RLELossless
+                                            for target in config.get("ALLOWED_AET", {}).values())
+    if not needed or PROCESSES < 1:
+        return
+    _executor = ProcessPoolExecutor(PROCESSES, mp_context=get_context("fork"), initializer=_init_encoder,
+                                    initargs=(os.getpid(),))
+    _executor.submit(os.getpid).result()
+    logging.info(f"Started {PROCESSES} encoder processes for compressed move destinations")
+
+
+def _encode(ds, transfer_syntax):
+    """Runs in the encoder processes, returns the compressed dataset and the encoding time"""
+    started = time.perf_counter()
+    ds.compress(transfer_syntax)
+    return ds, time.perf_counter() - started
+
+
+def _submit(ds, transfer_syntax, accepted):
+    """`ds` itself if it is sent as it is, else the Future of its encoding"""
+    if ds.file_meta.TransferSyntaxUID.is_compressed or "PixelData" not in ds or not accepted(ds):
+        return ds
+    if transfer_syntax.is_deflated:
+        ds.file_meta.TransferSyntaxUID = transfer_syntax
+        if ds.is_implicit_VR:
+            ds.is_implicit_VR = False
+        return ds
+    if _executor is None:
+        _warn_once("executor", "Encoder processes are only started at startup, restart DicomShield to compress "
+                               "instances for the destinations added by the reload")
+        return ds
+    return _executor.submit(_encode, ds, transfer_syntax)
+
+
+def _result(ds, encoding, transfer_syntax):
+    if not isinstance(encoding, Future):
+        return encoding
+    try:
+        encoded, seconds = encoding.result()
+    except Exception as e:
+        # Unsupported pixel data, no encoder installed or a crashed encoder process
+        logging.error(f"Failed to encode {ds.SOPInstanceUID} as {transfer_syntax.name}: {e!r}")
+        return ds
+
+    ratio = len(ds.PixelData) / max(len(encoded.PixelData), 1)
+    metrics.TRANSCODE_SECONDS.observe(seconds, transfer_syntax=transfer_syntax.keyword)
+    metrics.COMPRESSION_RATIO.observe(ratio, transfer_syntax=transfer_syntax.keyword)
+    # Noise does not compress, the original is smaller then
+    return encoded if ratio > 1 else ds
+
+
+def compressed(datasets, transfer_syntax, accepted=lambda ds: True):
+    """Yields `datasets` in their order, compressed with `transfer_syntax` where `accepted(ds)`, encoding up to QUEUE
+    instances ahead of the one the caller is sending"""
+    window = deque()
+    try:
+        for ds in datasets:
+            window.append((ds, _submit(ds, transfer_syntax, accepted)))
+            if len(window) > QUEUE:
+                yield _result(*window.popleft(), transfer_syntax)
+        while window:
+            yield _result(*window.popleft(), transfer_syntax)
+    finally:
+        # Cancelled move, the queued instances are not sent
+        for _, encoding in window:
+            if isinstance(encoding, Future):
+                encoding.cancel()
@@ -0,0 +1,120 @@
+"""The PACS DicomShield forwards to.
+
+Besides the single `UPSTREAM`, several PACS can be configured in `UPSTREAMS`. C-FIND fans out to all of them,
+C-MOVE/C-GET go to the PACS known to hold the study, as learned from earlier C-FIND results.
+"""
+import threading
+from collections import OrderedDict
+
+from pynetdicom import evt
+
+from settings import config
+
+# Attributes a retrieve can be routed by, most specific first
+LOCATION_KEYS = ("SOPInstanceUID", "SeriesInstanceUID", "StudyInstanceUID", "PatientID")
+
+
+class UpstreamBusy(Exception):
+    """No association slot became free within the timeout"""
+
+
+class Upstream:
+    def __init__(self, name, ip, port, aet="ANY-SCP", max_associations=None, timeout=60):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.aet = aet
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_associations) if max_associations else None
+
+    @classmethod
+    def from_config(cls, entry, name=None):
+        return cls(entry.get("NAME", name), entry["IP"], entry["PORT"], entry.get("AET", "ANY-SCP"),
+                   entry.get("MAX_ASSOCIATIONS"), entry.get("QUEUE_TIMEOUT", 60))
+
+    def associate(self, ae, evt_handlers, ext_neg):
+        """Associates `ae` with this PACS, waiting for a free slot if MAX_ASSOCIATIONS is set.
+
+        The slot is freed when the connection closes, however the association ends.
+        """
+        if self._slots is None:
+            return ae.associate(self.ip, self.port, ae_title=self.aet, evt_handlers=evt_handlers, ext_neg=ext_neg)
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise UpstreamBusy(f"No free association to upstream '{self.name}' within {self.timeout}s")
+
+        released = []
+        lock = threading.Lock()
+
+        def free(*args):
+            with lock:
+                if not released:
+                    released.append(True)
+                    self._slots.release()
+
+        assoc = ae.associate(self.ip, self.port, ae_title=self.aet, ext_neg=ext_neg,
+                             evt_handlers=list(evt_handlers) + [(evt.EVT_CONN_CLOSE, free)])
+        if not assoc.is_established:
+            free()
+        return assoc
+
+    def __repr__(self):
+        return f"Upstream({self.name!r}, {self.ip}:{self.port})"
+
+
+class LocationIndex:
+    """Which upstreams hold a patient/study/series/instance, bounded to `max_size` entries (least recently used)"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._locations = OrderedDict()  # (keyword, value) -> [upstream names]
+        self._lock = threading.Lock()
+
+    def learn(self, name, ds):
+        """Records the UIDs of a C-FIND result `ds` of upstream `name`"""
+        with self._lock:
+            for keyword in LOCATION_KEYS:
+                value = ds.get(keyword)
+                if not value or not isinstance(value, str):
+                    continue
+                names = self._locations.setdefault((keyword, value), [])
+                if name not in names:
+                    names.append(name)
+                self._locations.move_to_end((keyword, value))
+            while len(self._locations) > self.max_size:
+                self._locations.popitem(last=False)
+
+    def lookup(self, identifier):
+        """Upstream names holding the most specific unique key of `identifier`, [] if unknown"""
+        with self._lock:
+            for keyword in LOCATION_KEYS:
+                value = identifier.get(keyword)
+                values = [value] if isinstance(value, str) else list(value or [])
+                names = []
+                for value in values:
+                    for name in self._locations.get((keyword, str(value)), []):
+                        if name not in names:
+                            names.append(name)
+                if names:
+                    return names
+        return []
+
+
+def load(config):
+    if "UPSTREAMS" in config:
+        return [Upstream.from_config(entry, f"upstream{i}") for i, entry in enumerate(config["UPSTREAMS"])]
+    return [Upstream.from_config(config["UPSTREAM"], "upstream")]
+
+
+upstreams = load(config)
+primary = upstreams[0]
+location_index = LocationIndex(config.get("LOCATION_INDEX_SIZE", 100000))
+
+
+def route(identifier):
+    """The upstream to retrieve `identifier` from: the first configured one known to hold it"""
+    names = location_index.lookup(identifier)
+    for upstream in upstreams:
+        if upstream.name in names:
+            return upstream
+    return None
@@ -1,6 +1,52 @@
-from queue import Queue
+import threading
 
 from anonymizer import Anonymizer
 
 shield_anonymizer = Anonymizer()
-shared_queue = Queue()
\ No newline at end of file
+
+
+class PendingMoves:
+    """Instances received by the internal Store SCP, buffered per upstream C-MOVE.
+
+    The PACS echoes the Message ID of our C-MOVE as MoveOriginatorMessageID in its C-STORE sub-operations. Closing a
+    move frees its instances, later sub-operations of it are dropped.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def open(self, msg_id):
+        with self._lock:
+            self._buffers[msg_id] = []
+
+    def _resolve(self, msg_id):
+        # MoveOriginatorMessageID is optional, without it the instance belongs to the oldest open move
+        if msg_id is None and self._buffers:
+            return next(iter(self._buffers))
+        return msg_id
+
+    def is_open(self, msg_id):
+        with self._lock:
+            return self._resolve(msg_id) in self._buffers
+
+    def add(self, msg_id, ds):
+        """Returns False if the move has been closed in the meantime"""
+        with self._lock:
+            buffer = self._buffers.get(self._resolve(msg_id))
+            if buffer is None:
+                return False
+            buffer.append(ds)
+            return True
+
+    def close(self, msg_id):
+        """Returns the instances received for the move"""
+        with self._lock:
+            return self._buffers.pop(msg_id, [])
+
+    def qsize(self):
+        with self._lock:
+            return sum(len(buffer) for buffer in self._buffers.values())
+
+
+pending_moves = PendingMoves()
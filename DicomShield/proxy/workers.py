@@ -0,0 +1,234 @@
+"""Runs DicomShield as several worker processes accepting on the same ports.
+
+With `WORKERS: N` the supervisor process forks N workers. Each binds the ingress and internal Store SCP ports with
+SO_REUSEPORT, so the kernel spreads incoming associations over them. The PACS may deliver the C-STORE sub-operations
+of a C-MOVE to any worker: the issuing worker is encoded in the Message ID of the upstream C-MOVE (echoed as
+MoveOriginatorMessageID), other workers hand the instance over to it through a Unix socket.
+
+The supervisor checks the health of every worker through its Unix socket: a worker answers only while all of its
+listeners are serving. Workers that exit or fail their health checks are restarted.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from pydicom import dcmread
+from pynetdicom.transport import ThreadedAssociationServer
+
+from settings import config
+
+count = config.get("WORKERS", 1)
+index = 0  # of this worker, set in the worker process
+
+HEALTH_CHECK_INTERVAL = 2
+HEALTH_TIMEOUT = config.get("WORKER_HEALTH_TIMEOUT", 30)
+socket_dir = config.get("WORKER_SOCKET_DIR")  # default: a directory per supervisor process
+
+_listeners = {}  # name -> thread serving a port of this worker
+
+
+def share_port(sock):
+    """Lets all worker processes bind `sock` to the same port"""
+    if count > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+class ReusePortServer(ThreadedAssociationServer):
+    """Association server whose port can be shared by the worker processes"""
+
+    def server_bind(self):
+        share_port(self.socket)
+        super().server_bind()
+
+
+def move_message_id(sequence):
+    """Message ID 1..65535 of the `sequence`-th upstream C-MOVE of this worker, see owner()"""
+    return sequence % (65535 // count) * count + index + 1
+
+
+def owner(msg_id):
+    """Index of the worker that issued the C-MOVE with `msg_id`"""
+    return (msg_id - 1) % count
+
+
+def per_worker(path):
+    """`path` with the worker index inserted, for files every worker writes on its own"""
+    if count == 1 or not path:
+        return path
+    base, ext = os.path.splitext(path)
+    if ext == ".gz":
+        base, inner = os.path.splitext(base)
+        ext = inner + ext
+    return f"{base}-{index}{ext}"
+
+
+def listening(name, thread):
+    """Registers the `thread` serving the listener `name`, the worker is healthy while all of them run"""
+    _listeners[name] = thread
+
+
+def stopped_listeners():
+    return [name for name, thread in _listeners.items() if not thread.is_alive()]
+
+
+# Hand-over of internal C-STORE sub-operations between workers. A request is
+#   [4 bytes length][2 bytes MoveOriginatorMessageID][encoded dataset with file meta]
+# answered by the 2 bytes C-STORE status of the owning worker. A request without dataset and Message ID 0 is a
+# health check of the supervisor, answered with 0x0000 while all listeners of the worker are serving.
+HEALTH_CHECK = struct.pack("!IH", 0, 0)
+
+def _socket_path(worker):
+    return os.path.join(socket_dir, f"worker-{worker}.sock")
+
+
+def _receive(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by worker")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def hand_over(msg_id, event):
+    """Forwards the C-STORE sub-operation `event` to the worker that issued the C-MOVE, returns its status"""
+    payload = event.encoded_dataset()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(_socket_path(owner(msg_id)))
+            sock.sendall(struct.pack("!IH", len(payload), msg_id) + payload)
+            return struct.unpack("!H", _receive(sock, 2))[0]
+    except OSError as e:
+        logging.error(f"Failed to hand over instance of C-MOVE {msg_id} to worker {owner(msg_id)}: {e}")
+        return 0xA700  # Out of resources
+
+
+def serve_hand_overs(store):
+    """Accepts instances handed over by other workers, `store(msg_id, ds)` returns the C-STORE status"""
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            size, msg_id = struct.unpack("!IH", _receive(self.request, 6))
+            if (size, msg_id) == (0, 0):
+                stopped = stopped_listeners()
+                if stopped:
+                    logging.error(f"Worker {index} is unhealthy, not serving: {', '.join(stopped)}")
+                self.request.sendall(struct.pack("!H", 0xC000 if stopped else 0x0000))
+                return
+            ds = dcmread(BytesIO(_receive(self.request, size)))
+            self.request.sendall(struct.pack("!H", store(msg_id, ds)))
+
+    path = _socket_path(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="hand-over", daemon=True)
+    thread.start()
+    listening("hand-over socket", thread)
+    return server
+
+
+# Supervisor
+
+def check_health(worker, timeout=HEALTH_CHECK_INTERVAL):
+    """Whether `worker` answers the health check on its Unix socket within `timeout` seconds"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(_socket_path(worker))
+            sock.sendall(HEALTH_CHECK)
+            return struct.unpack("!H", _receive(sock, 2))[0] == 0x0000
+    except OSError:
+        return False
+
+
+def _run_worker(worker, target):
+    global index
+    index = worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # until run_worker handles reloads
+    logging.info(f"Worker {worker} started (pid {os.getpid()})")
+    target()
+
+
+def supervise(target):
+    """Runs `target` in `count` worker processes and keeps them running and healthy.
+
+    `target` serves the hand-over socket of the worker (serve_hand_overs) and registers its listeners.
+    """
+    global socket_dir
+    own_socket_dir = socket_dir is None
+    socket_dir = socket_dir or os.path.join(tempfile.gettempdir(), f"dicomshield-{os.getpid()}")
+    os.makedirs(socket_dir, exist_ok=True)
+    context = multiprocessing.get_context("fork")
+    processes = [None] * count
+    started = [0.0] * count
+    healthy = [0.0] * count  # when the last health check succeeded
+    failures = [0] * count
+    restart_at = [None] * count
+    stopping = threading.Event()
+
+    def start(worker):
+        started[worker] = time.monotonic()
+        healthy[worker] = started[worker] + HEALTH_TIMEOUT  # Grace period for the startup
+        process = context.Process(target=_run_worker, args=(worker, target), name=f"dicomshield-worker-{worker}")
+        process.start()
+        processes[worker] = process
+
+    def stop(signum, frame):
+        stopping.set()
+
+    def forward(signum, frame):
+        # Every worker reloads its own copy of the config
+        for process in processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward)
+    for worker in range(count):
+        start(worker)
+    logging.info(f"Supervising {count} workers")
+
+    while not stopping.wait(HEALTH_CHECK_INTERVAL):
+        for worker, process in enumerate(processes):
+            now = time.monotonic()
+            if restart_at[worker] is not None:
+                if now >= restart_at[worker]:
+                    restart_at[worker] = None
+                    start(worker)
+                continue
+
+            if process.is_alive() and check_health(worker):
+                healthy[worker] = time.monotonic()
+            elif process.is_alive() and now - healthy[worker] > HEALTH_TIMEOUT:
+                logging.error(f"Worker {worker} (pid {process.pid}) failed its health checks for "
+                              f"{HEALTH_TIMEOUT}s, killing it")
+                process.kill()
+                process.join()
+            if not process.is_alive():
+                # Back off if it keeps crashing right after the start
+                failures[worker] = failures[worker] + 1 if now - started[worker] < 60 else 1
+                delay = min(2 ** (failures[worker] - 1), 30) if failures[worker] > 1 else 0
+                logging.error(f"Worker {worker} exited with {process.exitcode}, restarting in {delay}s")
+                restart_at[worker] = now + delay
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(10)
+    if own_socket_dir:
+        shutil.rmtree(socket_dir, ignore_errors=True)
@@ -0,0 +1,400 @@
+"""Self-contained benchmark of the DicomShield hot path.
+
+Starts a mock upstream PACS with synthetic studies, a mock FHIR pseudonymization server and a destination
+Store SCP in this process, launches DicomShield (proxy/shield.py) as a subprocess against them and drives it with
+concurrent C-FIND/C-MOVE/C-GET and QIDO-RS/WADO-RS requests. Reports throughput, latency percentiles and the peak RSS of DicomShield.
+
+    python benchmark.py --studies 10 --instances 50 --concurrency 4 --requests 40 --gpas-latency 0.01
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, DeflatedExplicitVRLittleEndian
+from pynetdicom import AE, evt, AllStoragePresentationContexts, build_role
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    Verification,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelGet,
+)
+
+from mock_gpas import MockGPAS
+from mock_pacs import MockPACS, TRANSFER_SYNTAXES, create_studies
+
+SHIELD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy")
+DESTINATION_AET = "BENCH-SCP"
+SCU_AET = "BENCH-SCU"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def peak_rss_mb(pid):
+    """Peak resident set size (VmHWM) of a process and its worker processes in MB"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    rss = int(line.split()[1]) / 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return float("nan")
+    return rss + sum(peak_rss_mb(child) for child in children)
+
+
+class Destination:
+    """Store SCP that receives the instances of C-MOVE requests"""
+
+    def __init__(self, port, transfer_syntaxes=TRANSFER_SYNTAXES, link_mbps=None):
+        self.port = port
+        self.transfer_syntaxes = transfer_syntaxes
+        self.link_mbps = link_mbps
+        self.instances = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def _handle_store(self, event):
+        size = len(event.request.DataSet.getvalue())
+        with self._lock:
+            self.instances += 1
+            self.bytes += size
+        if self.link_mbps:
+            # Slow link to the destination: the response is delayed by the transfer time of the encoded dataset
+            time.sleep(size * 8 / 1e6 / self.link_mbps)
+        return 0x0000
+
+    def start(self):
+        ae = AE(ae_title=DESTINATION_AET)
+        ae.maximum_associations = 64
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, self.transfer_syntaxes)
+        ae.add_supported_context(Verification)
+        return ae.start_server(("127.0.0.1", self.port), block=False,
+                               evt_handlers=[(evt.EVT_C_STORE, self._handle_store)])
+
+
+class Shield:
+    """DicomShield running as a subprocess with a generated config"""
+
+    def __init__(self, workdir, config):
+        self.workdir = workdir
+        self.config = config
+        self.process = None
+
+    def start(self, timeout=30):
+        os.makedirs(os.path.join(self.workdir, "configs"), exist_ok=True)
+        with open(os.path.join(self.workdir, "configs", "config.yml"), "w") as f:
+            yaml.safe_dump(self.config, f)
+
+        self.log = open(os.path.join(self.workdir, "shield.log"), "w")
+        self.process = subprocess.Popen([sys.executable, os.path.join(SHIELD_DIR, "shield.py")],
+                                        cwd=self.workdir, stdout=self.log, stderr=subprocess.STDOUT)
+
+        ae = AE(ae_title=SCU_AET)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"DicomShield exited, see {self.log.name}")
+            assoc = ae.associate("127.0.0.1", self.config["INGRESS"]["PORT"], ae_title=self.config["INGRESS"]["AET"])
+            if assoc.is_established:
+                assoc.release()
+                return
+            time.sleep(0.2)
+        raise RuntimeError(f"DicomShield did not start within {timeout}s, see {self.log.name}")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+            self.log.close()
+
+
+class LoadGenerator:
+    def __init__(self, host, port, ae_title, sop_classes=(CTImageStorage,), transfer_syntaxes=TRANSFER_SYNTAXES,
+                 dicomweb_port=None):
+        self.host = host
+        self.port = port
+        self.dicomweb_port = dicomweb_port
+        self.ae_title = ae_title
+        self.sop_classes = sop_classes
+        self.transfer_syntaxes = transfer_syntaxes
+        self.get_bytes = 0
+        self._lock = threading.Lock()
+
+    def _associate(self, get=False):
+        ae = AE(ae_title=SCU_AET)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
+        kwargs = {}
+        if get:
+            # Separate contexts, so the uncompressed and the compressed ones can be accepted at once
+            for sop_class in self.sop_classes:
+                for transfer_syntax in self.transfer_syntaxes:
+                    ae.add_requested_context(sop_class, transfer_syntax)
+            kwargs = {"ext_neg": [build_role(sop_class, scp_role=True) for sop_class in self.sop_classes],
+                      "evt_handlers": [(evt.EVT_C_STORE, self._handle_store)]}
+        return ae.associate(self.host, self.port, ae_title=self.ae_title, **kwargs)
+
+    def _handle_store(self, event):
+        with self._lock:
+            self.get_bytes += len(event.request.DataSet.getvalue())
+        return 0x0000
+
+    def find_studies(self):
+        assoc = self._associate()
+        ds = Dataset()
+        ds.QueryRetrieveLevel = "STUDY"
+        ds.StudyInstanceUID = ""
+        ds.PatientID = ""
+        uids = [identifier.StudyInstanceUID
+                for status, identifier in assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
+                if status and status.Status in (0xFF00, 0xFF01)]
+        assoc.release()
+        return uids
+
+    def run_dicomweb(self, operation, study_uid):
+        """Returns (ok, results) of a QIDO-RS series query or (ok, instances) of a WADO-RS study retrieve"""
+        connection = http.client.HTTPConnection(self.host, self.dicomweb_port, timeout=600)
+        try:
+            if operation == "qido":
+                connection.request("GET", f"/studies/{study_uid}/series")
+                response = connection.getresponse()
+                body = response.read()
+                return response.status == 200, len(json.loads(body)) if body else 0
+
+            transfer_syntax = "*" if len(self.transfer_syntaxes) > 2 else ExplicitVRLittleEndian
+            connection.request("GET", f"/studies/{study_uid}",
+                               headers={"Accept": f'multipart/related; type="application/dicom"; '
+                                                  f'transfer-syntax={transfer_syntax}'})
+            response = connection.getresponse()
+            body = response.read()
+            with self._lock:
+                self.get_bytes += len(body)
+            boundary = response.getheader("Content-Type", "").partition("boundary=")[2]
+            return response.status == 200, body.count(f"--{boundary}\r\n".encode()) if boundary else 0
+        finally:
+            connection.close()
+
+    def run(self, operation, study_uid):
+        """Returns (ok, instances) of a single request"""
+        if operation in ("qido", "wado"):
+            return self.run_dicomweb(operation, study_uid)
+        assoc = self._associate(get=operation == "get")
+        if not assoc.is_established:
+            return False, 0
+
+        ds = Dataset()
+        ds.StudyInstanceUID = study_uid
+        try:
+            if operation == "find":
+                ds.QueryRetrieveLevel = "SERIES"
+                ds.SeriesInstanceUID = ""
+                ds.Modality = ""
+                statuses = [status.Status for status, _ in
+                            assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind) if status]
+                return statuses[-1:] == [0x0000], sum(1 for status in statuses if status in (0xFF00, 0xFF01))
+
+            ds.QueryRetrieveLevel = "STUDY"
+            if operation == "move":
+                responses = assoc.send_c_move(ds, DESTINATION_AET, StudyRootQueryRetrieveInformationModelMove)
+            else:
+                responses = assoc.send_c_get(ds, StudyRootQueryRetrieveInformationModelGet)
+
+            final = None
+            for status, _ in responses:
+                if status:
+                    final = status
+            if final is None:
+                return False, 0
+            return final.Status == 0x0000, final.get("NumberOfCompletedSuboperations", 0)
+        finally:
+            if assoc.is_established:
+                assoc.release()
+
+
+def build_config(args, ports, gpas):
+    config = {
+        "INGRESS": {"AET": "DICOMSHIELD", "PORT": ports["ingress"]},
+        "C_STORE_ENDPOINT": {"AET": "DICOMSHIELD-PACS", "PORT": ports["internal"]},
+        "UPSTREAM": {"IP": "127.0.0.1", "PORT": ports["pacs"][0], "AET": "MOCK-PACS"},
+        "ALLOWED_AET": {DESTINATION_AET: {"IP": "127.0.0.1", "PORT": ports["destination"],
+                                          "COMPRESS": args.compress}},
+        "PSEUDONYMIZATION_SERVER": {
+            "CLIENT_TYPE": "gPAS", "ENDPOINT_URL": gpas.endpoint_url, "DOMAIN": "DicomShield",
+            "USER": None, "PASSWORD": None,
+        },
+        "FIELDS_FOR_PSEUDO": ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"],
+        "FIELDS_FOR_REMOVAL": ["PatientName", "PatientBirthDate"],
+        "DICOMWEB": {"PORT": ports["dicomweb"], "HOST": "127.0.0.1"},
+    }
+    if len(ports["pacs"]) > 1:
+        config["UPSTREAMS"] = [{"NAME": f"pacs{i}", "IP": "127.0.0.1", "PORT": port, "AET": "MOCK-PACS",
+                                "MAX_ASSOCIATIONS": args.max_associations}
+                               for i, port in enumerate(ports["pacs"])]
+    return config
+
+
+def run_benchmark(args):
+    ports = {name: free_port() for name in ("ingress", "internal", "destination", "gpas", "dicomweb")}
+    ports["pacs"] = [free_port() for _ in range(args.upstreams)]
+
+    sop_classes = [sop_class.strip() for sop_class in args.sop_classes.split(",")]
+    datasets = create_studies(args.studies, args.series, args.instances, args.rows, args.columns, sop_classes,
+                              args.transfer_syntax)
+    # Clients and destination accepting only uncompressed syntaxes exercise the decompression fallback
+    client_syntaxes = TRANSFER_SYNTAXES if args.client_compression else TRANSFER_SYNTAXES[:2]
+    # Studies are spread over the upstreams, the first one is held by all of them
+    study_index = {uid: i for i, uid in enumerate(dict.fromkeys(ds.StudyInstanceUID for ds in datasets))}
+    pacs = [MockPACS([ds for ds in datasets if study_index[ds.StudyInstanceUID] % args.upstreams == i
+                      or study_index[ds.StudyInstanceUID] == 0],
+                     port, move_destinations={"DICOMSHIELD-PACS": ("127.0.0.1", ports["internal"])})
+            for i, port in enumerate(ports["pacs"])]
+    for upstream in pacs:
+        upstream.start()
+    gpas = MockGPAS(ports["gpas"], args.gpas_latency)
+    gpas.start()
+    destination = Destination(ports["destination"], client_syntaxes + [DeflatedExplicitVRLittleEndian],
+                              args.link_mbps)
+    destination_server = destination.start()
+
+    config = build_config(args, ports, gpas)
+    for override in args.set or []:
+        key, value = override.split("=", 1)
+        config[key] = yaml.safe_load(value)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dicomshield-bench-")
+    shield = Shield(workdir, config)
+    shield.start()
+
+    try:
+        load = LoadGenerator("127.0.0.1", ports["ingress"], "DICOMSHIELD", sop_classes, client_syntaxes,
+                             ports["dicomweb"])
+        study_uids = load.find_studies()
+        if not study_uids:
+            raise RuntimeError(f"C-FIND through DicomShield returned no studies, see {workdir}/shield.log")
+
+        operations = args.operations.split(",")
+        jobs = list(zip(itertools.islice(itertools.cycle(operations), args.requests), itertools.cycle(study_uids)))
+        results = {operation: [] for operation in operations}
+
+        def run(job):
+            operation, study_uid = job
+            started = time.perf_counter()
+            try:
+                ok, instances = load.run(operation, study_uid)
+            except Exception as e:
+                logging.warning(f"{operation} failed: {e}")
+                ok, instances = False, 0
+            results[operation].append((time.perf_counter() - started, ok, instances))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(run, jobs))
+        elapsed = time.perf_counter() - started
+
+        instances_per_study = args.series * args.instances
+        retrieved = sum(instances for operation in ("move", "get", "wado") for _, _, instances in results.get(operation, []))
+        retrieved_bytes = destination.bytes + load.get_bytes
+        report = {
+            "elapsed_s": elapsed,
+            "instances_per_s": retrieved / elapsed,
+            "mb_per_s": retrieved_bytes / elapsed / 1e6,
+            "peak_rss_mb": peak_rss_mb(shield.process.pid),
+            "gpas_requests": gpas.requests,
+            "studies_found": len(study_uids),
+            "operations": {},
+        }
+        for operation, samples in results.items():
+            latencies = [latency for latency, _, _ in samples]
+            expected = instances_per_study if operation in ("move", "get", "wado") else args.series
+            report["operations"][operation] = {
+                "requests": len(samples),
+                "errors": sum(1 for _, ok, _ in samples if not ok),
+                "incomplete": sum(1 for _, ok, instances in samples if ok and instances != expected),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+            }
+        return report
+    finally:
+        shield.stop()
+        destination_server.shutdown()
+        for upstream in pacs:
+            upstream.stop()
+        gpas.stop()
+
+
+def print_report(report):
+    print(f"elapsed {report['elapsed_s']:.2f}s | {report['instances_per_s']:.1f} instances/s | "
+          f"{report['mb_per_s']:.1f} MB/s | peak RSS {report['peak_rss_mb']:.0f} MB | "
+          f"{report['gpas_requests']} gPAS requests | {report['studies_found']} studies found")
+    print(f"{'operation':<10}{'requests':>10}{'errors':>8}{'incomplete':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operation, stats in report["operations"].items():
+        print(f"{operation:<10}{stats['requests']:>10}{stats['errors']:>8}{stats['incomplete']:>12}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--studies", type=int, default=10)
+    parser.add_argument("--series", type=int, default=2, help="series per study")
+    parser.add_argument("--instances", type=int, default=20, help="instances per series")
+    parser.add_argument("--rows", type=int, default=512)
+    parser.add_argument("--columns", type=int, default=512)
+    parser.add_argument("--sop-classes", default=CTImageStorage,
+                        help="comma-separated SOP Class UIDs the series of a study cycle through")
+    parser.add_argument("--transfer-syntax", default=ExplicitVRLittleEndian,
+                        help="transfer syntax UID of the instances at the mock PACS")
+    parser.add_argument("--no-client-compression", dest="client_compression", action="store_false",
+                        help="clients and move destination accept uncompressed transfer syntaxes only")
+    parser.add_argument("--compress", choices=["rle", "deflate"], help="COMPRESS policy of the move destination")
+    parser.add_argument("--link-mbps", type=float, help="simulated bandwidth per association to the move destination")
+    parser.add_argument("--upstreams", type=int, default=1, help="number of mock PACS the studies are spread over")
+    parser.add_argument("--max-associations", type=int, help="MAX_ASSOCIATIONS per upstream")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--operations", default="find,move,get", help="comma-separated mix of find, move, get, qido, wado")
+    parser.add_argument("--gpas-latency", type=float, default=0.005, help="seconds per pseudonymization request")
+    parser.add_argument("--set", action="append", metavar="KEY=YAML",
+                        help="override a top-level config entry of DicomShield, e.g. --set 'RETRIEVE_MODE=GET'")
+    parser.add_argument("--workdir", help="directory for the generated config and shield.log")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("pynetdicom").setLevel(logging.CRITICAL)  # the mocks and the startup probe are noisy
+    args = parse_args()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
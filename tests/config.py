@@ -4,4 +4,5 @@ HOST = "localhost"
 AET = "DICOMSHIELD"
 PORT = 11112
 SCU_AET = "TEST_SCU"
-MOCK_SERVER_AET = "CLIENT_PACS"
\ No newline at end of file
+MOCK_SERVER_AET = "CLIENT_PACS"
+METRICS_URL = "http://localhost:9100/metrics"
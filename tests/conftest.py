@@ -1,8 +1,15 @@
 
+import argparse
+import importlib
+import os
+import sys
+
 import pytest
 import time
 import threading
+import yaml
 
+from pydicom.dataset import Dataset
 from pynetdicom import AE, VerificationPresentationContexts
 from pynetdicom.sop_class import (
     CTImageStorage,
@@ -59,4 +66,88 @@ def association(ae):
     
     if assoc.is_established:
         assoc.release()
-        time.sleep(0.1)  # Small delay for clean release
\ No newline at end of file
+        time.sleep(0.1)  # Small delay for clean release
+
+
+@pytest.fixture(scope="session")
+def mock_upstreams():
+    """Mock gPAS and mock PACS for the tests that import the modules of DicomShield/proxy"""
+    from benchmark import free_port
+    from mock_gpas import MockGPAS
+    from mock_pacs import MockPACS, create_studies
+
+    gpas = MockGPAS(free_port())
+    gpas.start()
+    pacs = MockPACS(create_studies(2, 2, 3, 16, 16), free_port())
+    pacs.start()
+    yield gpas, pacs
+    pacs.stop()
+    gpas.stop()
+
+
+def shield_config(gpas, *pacs, **ports):
+    """Config of DicomShield for the mock gPAS and PACS, listening on free ports unless given in `ports`"""
+    from benchmark import build_config, free_port
+
+    ports = {**{name: free_port() for name in ("ingress", "internal", "destination", "dicomweb")}, **ports}
+    ports["pacs"] = [upstream.port for upstream in pacs]
+    return build_config(argparse.Namespace(compress=None, max_associations=None), ports, gpas)
+
+
+@pytest.fixture(scope="session")
+def proxy_config(mock_upstreams, tmp_path_factory):
+    """Makes the modules of DicomShield/proxy importable, configured for the mock upstreams.
+
+    They read their config once, so all tests of a session share it; tests change reloadable entries in place.
+    """
+    from benchmark import SHIELD_DIR
+
+    config = shield_config(*mock_upstreams)
+    directory = tmp_path_factory.mktemp("proxy")
+    os.makedirs(directory / "configs")
+    with open(directory / "configs" / "config.yml", "w") as f:
+        yaml.safe_dump(config, f)
+
+    sys.path.insert(0, SHIELD_DIR)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import settings
+    finally:
+        os.chdir(cwd)
+    return settings.config
+
+
+def proxy_module(name):
+    """Fixture returning the module `name` of DicomShield/proxy, imported with the proxy_config"""
+    @pytest.fixture(name=name)
+    def fixture(proxy_config):
+        return importlib.import_module(name)
+    return fixture
+
+
+c_handlers = proxy_module("c_handlers")
+cancellation = proxy_module("cancellation")
+destinations = proxy_module("destinations")
+dicomweb = proxy_module("dicomweb")
+log = proxy_module("log")
+capture = proxy_module("capture")
+pseudonym_clients = proxy_module("pseudonym_clients")
+settings = proxy_module("settings")
+upstreams = proxy_module("upstreams")
+workers = proxy_module("workers")
+
+
+@pytest.fixture()
+def anonymizer(proxy_config):
+    from anonymizer import Anonymizer
+    return Anonymizer()
+
+
+def query(level="STUDY", **attrs):
+    """C-FIND/C-GET/C-MOVE identifier at `level` with `attrs`"""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = level
+    for attr, value in attrs.items():
+        setattr(ds, attr, value)
+    return ds
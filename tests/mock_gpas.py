@@ -0,0 +1,95 @@
+"""In-process FHIR pseudonymization server mimicking the gPAS/MII endpoints, used by the benchmark"""
+import hashlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+
+NS = {"f": "http://hl7.org/fhir"}
+
+PSEUDONYMIZE_ENDPOINTS = ("$pseudonymizeAllowCreate", "$pseudonymize")
+DEPSEUDONYMIZE_ENDPOINTS = ("$dePseudonymize", "$de-pseudonymize")
+
+
+def make_pseudonym(original):
+    """Deterministic pseudonym that is also a valid DICOM UID"""
+    return "2.25." + str(int(hashlib.sha256(original.encode()).hexdigest()[:30], 16))
+
+
+def _response(pairs):
+    parameters = "".join(f"""
+        <parameter>
+            <name value="pseudonym-result-set" />
+            <part><name value="original" /><valueIdentifier><value value="{original}" /></valueIdentifier></part>
+            <part><name value="pseudonym" /><valueIdentifier><value value="{pseudonym}" /></valueIdentifier></part>
+        </parameter>""" for original, pseudonym in pairs)
+    return f'<Parameters xmlns="http://hl7.org/fhir">{parameters}</Parameters>'.encode()
+
+
+class MockGPAS:
+    def __init__(self, port, latency=0.0):
+        self.port = port
+        self.latency = latency
+        self.originals = {}  # pseudonym -> original
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    def _handler(self):
+        gpas = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._reply(200, b'<CapabilityStatement xmlns="http://hl7.org/fhir" />')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                endpoint = self.path.rsplit("/", 1)[-1]
+                with gpas._lock:
+                    gpas.requests += 1
+                if gpas.latency:
+                    time.sleep(gpas.latency)
+
+                tree = ElementTree.fromstring(body)
+                values = [param.find("f:valueString", NS).get("value")
+                          for param in tree.findall("f:parameter", NS)
+                          if param.find("f:name", NS).get("value") in ("original", "pseudonym")]
+
+                if endpoint in PSEUDONYMIZE_ENDPOINTS:
+                    pairs = [(value, make_pseudonym(value)) for value in values]
+                    with gpas._lock:
+                        gpas.originals.update({pseudonym: original for original, pseudonym in pairs})
+                elif endpoint in DEPSEUDONYMIZE_ENDPOINTS:
+                    with gpas._lock:
+                        pairs = [(gpas.originals[value], value) for value in values if value in gpas.originals]
+                else:
+                    self._reply(404, b"")
+                    return
+                self._reply(200, _response(pairs))
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/fhir+xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Mock gPAS listening at port {self.port} with {self.latency * 1000:.0f} ms latency")
+        return self.server
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.port}/ttp-fhir/fhir/gpas"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,194 @@
+"""In-process upstream PACS serving synthetic studies, used by the benchmark"""
+import logging
+import os
+
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (
+    UID, ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEGLSLossless, JPEG2000Lossless, RLELossless, generate_uid,
+)
+from pynetdicom import AE, evt, AllStoragePresentationContexts, build_context
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    MRImageStorage,
+    UltrasoundImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    SecondaryCaptureImageStorage,
+    Verification,
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelGet,
+)
+
+LEVEL_KEYS = {
+    "PATIENT": "PatientID",
+    "STUDY": "StudyInstanceUID",
+    "SERIES": "SeriesInstanceUID",
+    "IMAGE": "SOPInstanceUID",
+}
+
+TRANSFER_SYNTAXES = [ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEGLSLossless, JPEG2000Lossless, RLELossless]
+
+MODALITIES = {
+    CTImageStorage: "CT",
+    MRImageStorage: "MR",
+    UltrasoundImageStorage: "US",
+    DigitalXRayImageStorageForPresentation: "DX",
+    SecondaryCaptureImageStorage: "OT",
+}
+
+
+def create_studies(studies=10, series=2, instances=50, rows=512, columns=512, sop_classes=(CTImageStorage,),
+                   transfer_syntax=ExplicitVRLittleEndian):
+    """Returns a list of synthetic instances. All instances share one pixel buffer to keep memory flat.
+
+    The series of a study cycle through `sop_classes`. For a compressed `transfer_syntax` the pixel data is a single
+    random fragment of a third of the uncompressed size: it is never decoded, only passed through. Uncompressed pixel
+    data is a 12-bit pattern of 8x8 blocks with noise in the low bits, which compresses losslessly about as well as CT.
+    """
+    transfer_syntax = UID(transfer_syntax)
+    if transfer_syntax.is_compressed:
+        pixel_data = encapsulate([os.urandom(rows * columns * 2 // 3 // 2 * 2)])
+    else:
+        noise = os.urandom(rows * columns)
+        pixel_data = b"".join(
+            (((row // 8 * 64 + column // 8) * 16 & 0x0FF0) | noise[row * columns + column] & 0x0F).to_bytes(2, "little")
+            for row in range(rows) for column in range(columns))
+    datasets = []
+    for study_index in range(studies):
+        patient_id = f"BENCH{study_index:05d}"
+        study_uid = generate_uid()
+        for series_index in range(series):
+            series_uid = generate_uid()
+            sop_class = sop_classes[(study_index * series + series_index) % len(sop_classes)]
+            for instance_number in range(1, instances + 1):
+                ds = Dataset()
+                ds.file_meta = FileMetaDataset()
+                ds.file_meta.MediaStorageSOPClassUID = sop_class
+                ds.file_meta.TransferSyntaxUID = transfer_syntax
+                ds.SOPClassUID = sop_class
+                ds.SOPInstanceUID = generate_uid()
+                ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+                ds.PatientName = f"Bench^Patient{study_index}"
+                ds.PatientID = patient_id
+                ds.PatientBirthDate = "19700101"
+                ds.StudyInstanceUID = study_uid
+                ds.SeriesInstanceUID = series_uid
+                ds.StudyID = str(study_index)
+                ds.Modality = MODALITIES.get(sop_class, "OT")
+                ds.InstanceNumber = instance_number
+                ds.Rows = rows
+                ds.Columns = columns
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = "MONOCHROME2"
+                ds.BitsAllocated = 16
+                ds.BitsStored = 16
+                ds.HighBit = 15
+                ds.PixelRepresentation = 0
+                ds.PixelData = pixel_data
+                if transfer_syntax.is_compressed:
+                    ds["PixelData"].VR = "OB"
+                    ds["PixelData"].is_undefined_length = True
+                ds.is_little_endian = True
+                ds.is_implicit_VR = False
+                datasets.append(ds)
+    return datasets
+
+
+def _matches(ds, identifier):
+    for elem in identifier:
+        if elem.keyword in ("QueryRetrieveLevel", "") or elem.VR == "SQ":
+            continue
+        value = elem.value
+        if value in (None, "", "*"):
+            continue
+        candidates = value if elem.VM > 1 else [value]
+        if str(ds.get(elem.keyword, "")) not in [str(v) for v in candidates]:
+            return False
+    return True
+
+
+class MockPACS:
+    """C-FIND/C-MOVE/C-GET SCP for a fixed list of instances"""
+
+    def __init__(self, datasets, port, ae_title="MOCK-PACS", move_destinations=None):
+        self.datasets = datasets
+        self.port = port
+        self.ae_title = ae_title
+        self.move_destinations = move_destinations or {}
+        self.server = None
+
+    def find(self, identifier):
+        level = identifier.QueryRetrieveLevel
+        key = LEVEL_KEYS[level]
+        seen = set()
+        for ds in self.datasets:
+            if not _matches(ds, identifier) or ds[key].value in seen:
+                continue
+            seen.add(ds[key].value)
+            yield ds
+
+    def matching_instances(self, identifier):
+        return [ds for ds in self.datasets if _matches(ds, identifier)]
+
+    def _handle_find(self, event):
+        identifier = event.identifier
+        for ds in self.find(identifier):
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            response = Dataset()
+            response.QueryRetrieveLevel = identifier.QueryRetrieveLevel
+            for elem in identifier:
+                if elem.keyword and elem.keyword != "QueryRetrieveLevel" and elem.keyword in ds:
+                    setattr(response, elem.keyword, ds[elem.keyword].value)
+            response[LEVEL_KEYS[identifier.QueryRetrieveLevel]] = ds[LEVEL_KEYS[identifier.QueryRetrieveLevel]]
+            yield 0xFF00, response
+
+    def _handle_move(self, event):
+        destination = self.move_destinations.get(event.move_destination)
+        if destination is None:
+            yield None, None
+            return
+        instances = self.matching_instances(event.identifier)
+        syntaxes = {(ds.SOPClassUID, ds.file_meta.TransferSyntaxUID) for ds in instances}
+        contexts = [build_context(sop_class, transfer_syntax) for sop_class, transfer_syntax in sorted(syntaxes)]
+        yield destination[0], destination[1], {"contexts": contexts or AllStoragePresentationContexts[:1]}
+        yield len(instances)
+        for ds in instances:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, ds
+
+    def _handle_get(self, event):
+        instances = self.matching_instances(event.identifier)
+        yield len(instances)
+        for ds in instances:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            yield 0xFF00, ds
+
+    def start(self):
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = 64
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, TRANSFER_SYNTAXES, scu_role=True, scp_role=True)
+        for model in (Verification,
+                      PatientRootQueryRetrieveInformationModelFind, PatientRootQueryRetrieveInformationModelMove,
+                      StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove,
+                      StudyRootQueryRetrieveInformationModelGet):
+            ae.add_supported_context(model)
+
+        handlers = [(evt.EVT_C_FIND, self._handle_find), (evt.EVT_C_MOVE, self._handle_move),
+                    (evt.EVT_C_GET, self._handle_get), (evt.EVT_C_ECHO, lambda event: 0x0000)]
+        self.server = ae.start_server(("127.0.0.1", self.port), block=False, evt_handlers=handlers)
+        logging.info(f"Mock PACS '{self.ae_title}' serving {len(self.datasets)} instances at port {self.port}")
+        return self.server
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
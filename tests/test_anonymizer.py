@@ -0,0 +1,109 @@
+import pytest
+from pydicom.dataset import Dataset
+
+from conftest import query
+from mock_gpas import make_pseudonym
+
+
+def pseudonymize(anonymizer, **attrs):
+    """Hands out the pseudonyms of `attrs` like a retrieve does, returns the pseudonymized dataset"""
+    ds = Dataset()
+    for attr, value in attrs.items():
+        setattr(ds, attr, value)
+    return anonymizer.shield_retrieve(ds)
+
+
+def test_shield_retrieve_pseudonymizes_and_clears(anonymizer):
+    ds = pseudonymize(anonymizer, PatientID="PAT1", PatientName="Doe^John", StudyInstanceUID="1.2.3")
+
+    assert ds.PatientID == make_pseudonym("PAT1")
+    assert ds.StudyInstanceUID == make_pseudonym("1.2.3")
+    assert ds.PatientName == ""
+
+
+def test_shield_query_depseudonymizes(anonymizer):
+    identifier = anonymizer.shield_query(query(PatientID=make_pseudonym("PAT1")))
+
+    assert identifier.PatientID == "PAT1"
+
+
+def test_shield_query_rejects_unknown_pseudonyms(anonymizer):
+    from pseudonym_clients import UnknownPseudonym
+
+    with pytest.raises(UnknownPseudonym):
+        anonymizer.shield_query(query(PatientID="NOT-A-PSEUDONYM"))
+
+
+def test_shield_find_exact_and_universal(anonymizer):
+    identifiers = anonymizer.shield_find(query(PatientID=make_pseudonym("PAT1"), StudyInstanceUID="*"))
+
+    assert len(identifiers) == 1
+    assert identifiers[0].PatientID == "PAT1"
+    assert identifiers[0].StudyInstanceUID == ""
+
+
+def test_shield_find_unknown_pseudonym_matches_nothing(anonymizer):
+    assert anonymizer.shield_find(query(PatientID="NOT-A-PSEUDONYM")) == []
+    assert anonymizer.shield_find(query(PatientID="NOT-A-PSEUDONYM*")) == []
+
+
+def test_shield_find_wildcard_splits_non_uid_fields(anonymizer):
+    """Every matching original of a non-UID field is queried on its own"""
+    first = pseudonymize(anonymizer, PatientID="PAT1").PatientID
+    second = pseudonymize(anonymizer, PatientID="PAT2").PatientID
+
+    identifiers = anonymizer.shield_find(query(PatientID="2.25.*"))
+
+    assert sorted(identifier.PatientID for identifier in identifiers) == ["PAT1", "PAT2"]
+    assert anonymizer.shield_find(query(PatientID=first[:-1] + "?")) != []
+    assert [identifier.PatientID for identifier in anonymizer.shield_find(query(PatientID=second))] == ["PAT2"]
+
+
+def test_shield_find_wildcard_on_uids_becomes_a_list(anonymizer):
+    pseudonymize(anonymizer, StudyInstanceUID="1.2.3")
+    pseudonymize(anonymizer, StudyInstanceUID="1.2.4")
+
+    identifiers = anonymizer.shield_find(query(StudyInstanceUID="2.25.*"))
+
+    assert len(identifiers) == 1
+    assert sorted(identifiers[0].StudyInstanceUID) == ["1.2.3", "1.2.4"]
+
+
+def test_shield_find_list_of_uids(anonymizer):
+    identifiers = anonymizer.shield_find(query(StudyInstanceUID=[make_pseudonym("1.2.3"), make_pseudonym("1.2.4")]))
+
+    assert len(identifiers) == 1
+    assert list(identifiers[0].StudyInstanceUID) == ["1.2.3", "1.2.4"]
+
+
+def test_shield_find_max_query_expansion(anonymizer, proxy_config):
+    from pseudonym_clients import PseudonymizationError
+
+    for i in range(3):
+        pseudonymize(anonymizer, PatientID=f"PAT{i}")
+    proxy_config["MAX_QUERY_EXPANSION"] = 2
+    anonymizer.configure()
+    try:
+        with pytest.raises(PseudonymizationError):
+            anonymizer.shield_find(query(PatientID="2.25.*"))
+    finally:
+        del proxy_config["MAX_QUERY_EXPANSION"]
+        anonymizer.configure()
+
+    assert len(anonymizer.shield_find(query(PatientID="2.25.*"))) == 3
+
+
+def test_shield_find_wildcards_need_a_single_worker(proxy_config, monkeypatch):
+    """The index is per process, several workers would answer differently"""
+    import workers
+    from anonymizer import Anonymizer
+    from pseudonym_clients import PseudonymizationError
+
+    monkeypatch.setattr(workers, "count", 2)
+    anonymizer = Anonymizer()
+    pseudonymize(anonymizer, PatientID="PAT1")
+
+    with pytest.raises(PseudonymizationError):
+        anonymizer.shield_find(query(PatientID="2.25.*"))
+    assert [identifier.PatientID for identifier in
+            anonymizer.shield_find(query(PatientID=make_pseudonym("PAT1")))] == ["PAT1"]
@@ -0,0 +1,103 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SHIELD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy")
+sys.path.insert(0, SHIELD_DIR)
+
+import audit
+import metrics
+
+
+def entries(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def record(log, *callers):
+    for caller in callers:
+        log.record(caller, "find", {"PatientID": {f"PSN-{caller}"}}, 1)
+
+
+def dropped():
+    return metrics.AUDIT_DROPPED_TOTAL._values.get((), 0)
+
+
+def test_full_buffer_drops_the_oldest_events(tmp_path):
+    path = tmp_path / "audit.jsonl"
+    log = audit.AuditLog(str(path), buffer_size=4, batch_size=100, interval=3600, fsync=False)
+    before = dropped()
+
+    record(log, *(f"SCU{i}" for i in range(6)))
+    log.flush()
+
+    assert [entry["caller"] for entry in entries(path)] == ["SCU2", "SCU3", "SCU4", "SCU5"]
+    assert dropped() - before == 2
+
+
+def test_full_batch_is_written_at_once(tmp_path, monkeypatch):
+    """The writer wakes up for a full batch and commits it with a single write and fsync"""
+    synced = []
+    monkeypatch.setattr(audit.os, "fsync", synced.append)
+    path = tmp_path / "audit.jsonl"
+    log = audit.AuditLog(str(path), batch_size=3, interval=3600)
+
+    record(log, "SCU0", "SCU1")
+    time.sleep(0.2)
+    assert path.read_text() == ""
+
+    record(log, "SCU2")
+    deadline = time.monotonic() + 5
+    while log.pending() or not synced:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    assert len(synced) == 1
+    [entry, *_] = entries(path)
+    assert [entry["caller"] for entry in entries(path)] == ["SCU0", "SCU1", "SCU2"]
+    assert entry["op"] == "find" and entry["keys"] == {"PatientID": ["PSN-SCU0"]} and entry["n"] == 1
+
+
+def test_files_are_rotated_by_size(tmp_path):
+    path = tmp_path / "audit.jsonl"
+    log = audit.AuditLog(str(path), max_bytes=300, backups=2, interval=3600, fsync=False)
+
+    for i in range(12):
+        record(log, f"SCU{i:02d}")
+        log.flush()
+
+    files = [path, tmp_path / "audit.jsonl.1", tmp_path / "audit.jsonl.2"]
+    assert all(os.path.getsize(file) <= 300 for file in files)
+    assert not (tmp_path / "audit.jsonl.3").exists()
+    # The newest events are kept, in order
+    callers = [entry["caller"] for file in reversed(files) for entry in entries(file)]
+    assert callers == [f"SCU{i:02d}" for i in range(12 - len(callers), 12)]
+
+
+SIGTERM_SCRIPT = """
+import sys, time
+sys.path.insert(0, {shield_dir!r})
+import audit
+
+audit.configure({{"FLUSH_INTERVAL": 3600}}, {path!r})
+for i in range(10):
+    audit._log.record(f"SCU{{i}}", "find", {{}}, 1)
+print("recorded", flush=True)
+time.sleep(60)
+"""
+
+
+def test_buffered_events_are_written_on_sigterm(tmp_path):
+    path = tmp_path / "audit.jsonl"
+    process = subprocess.Popen([sys.executable, "-c", SIGTERM_SCRIPT.format(shield_dir=SHIELD_DIR, path=str(path))],
+                               stdout=subprocess.PIPE, text=True)
+    assert process.stdout.readline() == "recorded\n"
+    assert path.read_text() == ""
+
+    process.send_signal(signal.SIGTERM)
+
+    assert process.wait(10) == -signal.SIGTERM
+    assert [entry["caller"] for entry in entries(path)] == [f"SCU{i}" for i in range(10)]
@@ -0,0 +1,187 @@
+import logging
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.dataset import FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEG2000Lossless, RLELossless
+from pynetdicom import build_context
+from pynetdicom.dsutils import decode, encode
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from conftest import query
+
+FIND_CONTEXT = build_context(StudyRootQueryRetrieveInformationModelFind)
+
+
+def test_fan_out_find_bounds_associations(c_handlers, proxy_config, mock_upstreams):
+    """Expanded queries share MAX_PARALLEL_FINDS associations per upstream"""
+    _, pacs = mock_upstreams
+    patient_ids = sorted({ds.PatientID for ds in pacs.datasets})
+    identifiers = [query(PatientID=patient_id, StudyInstanceUID="") for patient_id in patient_ids * 3]
+    proxy_config["MAX_PARALLEL_FINDS"] = 2
+    try:
+        results = c_handlers.fan_out_find(identifiers, FIND_CONTEXT)
+        found = [identifier.PatientID for _, identifier in results]
+    finally:
+        del proxy_config["MAX_PARALLEL_FINDS"]
+
+    assert results.succeeded
+    assert sorted(found) == sorted(patient_ids * 3)
+    assert len(results._associations) == 2
+
+
+def instances_of(sop_classes, per_class=2):
+    """(StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID, SOPClassUID) like find_instances returns them"""
+    return [("1.2", f"1.2.{i}", f"1.2.{i}.{j}", sop_class)
+            for i, sop_class in enumerate(sop_classes) for j in range(per_class)]
+
+
+def test_partition_instances_single_class(c_handlers):
+    instances = instances_of(["1.2.840.10008.5.1.4.1.1.2"], 5)
+
+    assert c_handlers.partition_instances(instances) == [(["1.2.840.10008.5.1.4.1.1.2"], instances)]
+
+
+def test_partition_instances_spreads_classes_over_parallel_gets(c_handlers, proxy_config):
+    instances = instances_of([f"1.2.3.{i}" for i in range(6)], 3) + instances_of(["1.2.3.0"], 6)
+    proxy_config["MAX_PARALLEL_GETS"] = 3
+    try:
+        partitions = c_handlers.partition_instances(instances)
+    finally:
+        del proxy_config["MAX_PARALLEL_GETS"]
+
+    assert len(partitions) == 3
+    assert sorted(sop_class for classes, _ in partitions for sop_class in classes) == [f"1.2.3.{i}" for i in range(6)]
+    assert sorted(instance for _, members in partitions for instance in members) == sorted(instances)
+    for classes, members in partitions:
+        assert {instance[3] for instance in members} == set(classes)
+    # Balanced by instances: the largest class (9) alone, the other five (15) split in two
+    assert sorted(len(members) for _, members in partitions) == [6, 9, 9]
+
+
+def test_partition_instances_respects_the_context_limit(c_handlers, proxy_config):
+    """More SOP classes than one association can negotiate need more associations than MAX_PARALLEL_GETS"""
+    instances = instances_of([f"1.2.3.{i}" for i in range(30)], 1)
+    proxy_config["MAX_PARALLEL_GETS"] = 1
+    try:
+        partitions = c_handlers.partition_instances(instances)
+    finally:
+        del proxy_config["MAX_PARALLEL_GETS"]
+
+    per_association = c_handlers.MAX_STORAGE_CONTEXTS // (1 + len(c_handlers.compressedTransferSyntaxes))
+    assert len(partitions) == -(-30 // per_association)
+    assert all(len(classes) <= per_association for classes, _ in partitions)
+    assert sum(len(members) for _, members in partitions) == 30
+
+
+def test_series_identifiers(c_handlers):
+    identifiers = c_handlers.series_identifiers(instances_of(["1.2.3.0", "1.2.3.1"], 2))
+
+    assert [(ds.QueryRetrieveLevel, ds.SeriesInstanceUID, list(ds.SOPInstanceUID)) for ds in identifiers] == [
+        ("IMAGE", "1.2.0", ["1.2.0.0", "1.2.0.1"]),
+        ("IMAGE", "1.2.1", ["1.2.1.0", "1.2.1.1"]),
+    ]
+
+
+def test_series_identifiers_stay_under_the_explicit_vr_limit(c_handlers):
+    """The SOP Instance UIDs of a large series are split over identifiers that keep their UI VR on the wire"""
+    uids = [f"1.2.840.99999.1.{10 ** 47 + i}" for i in range(1200)]  # 64 characters
+    instances = [("1.2", "1.2.0", uid, "1.2.840.10008.5.1.4.1.1.2") for uid in uids]
+
+    identifiers = c_handlers.series_identifiers(instances)
+
+    assert len(identifiers) > 1
+    assert [uid for ds in identifiers for uid in ds.SOPInstanceUID] == uids
+    for ds in identifiers:
+        decoded = decode(BytesIO(encode(ds, False, True)), False, True)
+        assert decoded["SOPInstanceUID"].VR == "UI"
+        assert list(decoded.SOPInstanceUID) == list(ds.SOPInstanceUID)
+
+
+def test_storage_contexts_drop_compressed_contexts_first(c_handlers):
+    sop_classes = [f"1.2.3.{i}" for i in range(20)]
+
+    contexts = c_handlers.storage_contexts(sop_classes, [RLELossless, JPEG2000Lossless])
+    assert [(cx.abstract_syntax, cx.transfer_syntax) for cx in contexts[:20]] == \
+        [(sop_class, [ExplicitVRLittleEndian, ImplicitVRLittleEndian]) for sop_class in sop_classes]
+    assert [cx.transfer_syntax for cx in contexts[20:]] == [[RLELossless]] * 20 + [[JPEG2000Lossless]] * 20
+
+    contexts = c_handlers.storage_contexts(sop_classes)
+    assert len(contexts) == 128
+    assert all(cx.transfer_syntax == [ExplicitVRLittleEndian, ImplicitVRLittleEndian] for cx in contexts[:20])
+
+
+def test_outbound_contexts_put_the_policy_first(c_handlers):
+    jpeg2000, rle = stored(JPEG2000Lossless), stored(RLELossless)
+    uncompressed = stored(ExplicitVRLittleEndian)
+
+    contexts = c_handlers.outbound_contexts([jpeg2000, rle, uncompressed], compress_syntax=RLELossless)
+
+    assert [cx.transfer_syntax for cx in contexts] == [
+        [ExplicitVRLittleEndian, ImplicitVRLittleEndian], [RLELossless], [JPEG2000Lossless]]
+
+
+def stored(transfer_syntax, sop_class="1.2.840.10008.5.1.4.1.1.4"):
+    """A dataset of `sop_class` as received in `transfer_syntax`"""
+    ds = query("IMAGE", SOPClassUID=sop_class, SOPInstanceUID="1.2.3")
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = transfer_syntax
+    return ds
+
+
+def association(*contexts):
+    """An association whose accepted contexts are the (abstract syntax, transfer syntax) `contexts`"""
+    return SimpleNamespace(accepted_contexts=[SimpleNamespace(abstract_syntax=abstract_syntax,
+                                                              transfer_syntax=[transfer_syntax])
+                                              for abstract_syntax, transfer_syntax in contexts])
+
+
+@pytest.fixture()
+def rle_mr():
+    return dcmread(get_testdata_file("MR_small_RLE.dcm"))
+
+
+def test_for_association_passes_accepted_compressed_data_through(c_handlers, rle_mr):
+    assoc = association((rle_mr.SOPClassUID, ExplicitVRLittleEndian), (rle_mr.SOPClassUID, RLELossless))
+    pixel_data = rle_mr.PixelData
+
+    sent = c_handlers.for_association(rle_mr, assoc)
+
+    assert sent.file_meta.TransferSyntaxUID == RLELossless
+    assert sent.PixelData == pixel_data
+
+
+def test_for_association_decompresses_for_uncompressed_contexts(c_handlers, rle_mr):
+    original = dcmread(get_testdata_file("MR_small.dcm"))
+
+    sent = c_handlers.for_association(rle_mr, association((rle_mr.SOPClassUID, ExplicitVRLittleEndian)))
+
+    assert sent.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+    assert (sent.pixel_array == original.pixel_array).all()
+
+
+def test_for_association_leaves_uncompressed_data_to_pynetdicom(c_handlers):
+    ds = stored(ImplicitVRLittleEndian)
+
+    assert c_handlers.for_association(ds, association((ds.SOPClassUID, ExplicitVRLittleEndian))) is ds
+    assert c_handlers.for_association(stored(RLELossless), None).file_meta.TransferSyntaxUID == RLELossless
+
+
+def test_decompress_failure_keeps_the_dataset(c_handlers, caplog, monkeypatch):
+    """Without a pixel data handler for the syntax the instance is sent as it is and its sub-operation fails"""
+    def decompress():
+        raise RuntimeError("no pixel data handler")
+
+    ds = dcmread(get_testdata_file("MR_small_jp2klossless.dcm"))
+    monkeypatch.setattr(ds, "decompress", decompress)
+    pixel_data = ds.PixelData
+
+    with caplog.at_level(logging.ERROR):
+        sent = c_handlers.decompress(ds)
+
+    assert sent is ds
+    assert sent.file_meta.TransferSyntaxUID == JPEG2000Lossless and sent.PixelData == pixel_data
+    assert "Failed to decompress" in caplog.text
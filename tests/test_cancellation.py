@@ -0,0 +1,196 @@
+"""C-CANCEL and dropped clients, with DicomShield started as a subprocess against a slow mock PACS"""
+import threading
+import time
+
+import pytest
+from pydicom.dataset import Dataset
+from pynetdicom import AE, build_role, evt
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+
+from benchmark import DESTINATION_AET, SCU_AET, Destination, LoadGenerator, Shield, free_port
+from conftest import shield_config
+from mock_gpas import MockGPAS, make_pseudonym
+from mock_pacs import TRANSFER_SYNTAXES, MockPACS, create_studies
+
+
+class SlowPACS(MockPACS):
+    """Mock PACS that takes `delays[operation]` seconds for every response and records the requests it received,
+    the instances it sent, the requests it saw cancelled and the associations aborted by DicomShield"""
+
+    def __init__(self, datasets, port, **kwargs):
+        super().__init__(datasets, port, **kwargs)
+        self.delays = {}
+        self.requests = []
+        self.sent = 0
+        self.cancelled = []
+        self.aborted = 0
+
+    def _slow(self, operation, responses):
+        self.requests.append(operation)
+        delay = self.delays.get(operation, 0)
+        time.sleep(delay)
+        for item in responses:
+            if item == (0xFE00, None):
+                self.cancelled.append(operation)
+            elif operation != "find" and isinstance(item, tuple) and isinstance(item[-1], Dataset):
+                self.sent += 1
+            yield item
+            time.sleep(delay)
+
+    def _handle_find(self, event):
+        yield from self._slow("find", super()._handle_find(event))
+
+    def _handle_move(self, event):
+        yield from self._slow("move", super()._handle_move(event))
+
+    def _handle_get(self, event):
+        yield from self._slow("get", super()._handle_get(event))
+
+    def start(self):
+        server = super().start()
+        server.bind(evt.EVT_ABORTED, self._count_abort)
+        return server
+
+    def _count_abort(self, event):
+        self.aborted += 1
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    datasets = create_studies(6, 1, 8, 16, 16)
+    gpas = MockGPAS(free_port())
+    gpas.start()
+    pacs = SlowPACS(datasets, free_port())
+    pacs.start()
+    destination = Destination(free_port())
+    server = destination.start()
+    yield pacs, gpas, destination
+    server.shutdown()
+    pacs.stop()
+    gpas.stop()
+
+
+@pytest.fixture(scope="module", params=["MOVE", "GET"])
+def shield(request, upstream, tmp_path_factory):
+    """(port, pacs) of DicomShield in both retrieve modes, sending one expanded C-FIND after the other"""
+    pacs, gpas, destination = upstream
+    config = shield_config(gpas, pacs, destination=destination.port)
+    config["RETRIEVE_MODE"] = request.param
+    config["MAX_PARALLEL_FINDS"] = 1
+    pacs.move_destinations = {"DICOMSHIELD-PACS": ("127.0.0.1", config["C_STORE_ENDPOINT"]["PORT"])}
+
+    shield = Shield(str(tmp_path_factory.mktemp(f"shield-{request.param.lower()}")), config)
+    shield.start()
+    port = config["INGRESS"]["PORT"]
+    # The mock gPAS only resolves the pseudonyms it handed out
+    assert len(LoadGenerator("127.0.0.1", port, "DICOMSHIELD").find_studies()) == 6
+    yield port, pacs
+    shield.stop()
+
+
+@pytest.fixture(autouse=True)
+def slow_pacs(upstream):
+    pacs, _, _ = upstream
+    pacs.delays = {"get": 0.3, "move": 0.3}
+    pacs.requests.clear()
+    pacs.sent = 0
+    pacs.cancelled.clear()
+    pacs.aborted = 0
+    yield pacs
+    pacs.delays = {}
+    time.sleep(1)  # Lets the upstream work that was not stopped show up in the next test
+
+
+def associate(port, received=None):
+    ae = AE(ae_title=SCU_AET)
+    ae.dimse_timeout = 5  # Also how long a dropped client waits for its responses
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+    ae.add_requested_context(CTImageStorage, TRANSFER_SYNTAXES)
+    handlers = None if received is None else \
+        [(evt.EVT_C_STORE, lambda event: received.append(event.dataset) or 0x0000)]
+    assoc = ae.associate("127.0.0.1", port, ae_title="DICOMSHIELD", ext_neg=[build_role(CTImageStorage, scp_role=True)],
+                         evt_handlers=handlers)
+    assert assoc.is_established
+    return assoc
+
+
+def study_query(pacs):
+    ds = Dataset()
+    ds.QueryRetrieveLevel = "STUDY"
+    ds.StudyInstanceUID = make_pseudonym(pacs.datasets[0].StudyInstanceUID)
+    return ds
+
+
+def send_and_cancel(assoc, operation, ds, model, after=1.0):
+    """Sends the request, a C-CANCEL `after` seconds and returns the statuses of the responses"""
+    threading.Timer(after, assoc.send_c_cancel, (1, None, model)).start()
+    if operation == "get":
+        responses = assoc.send_c_get(ds, model, msg_id=1)
+    else:
+        responses = assoc.send_c_move(ds, DESTINATION_AET, model, msg_id=1)
+    return [status.Status for status, _ in responses if status]
+
+
+def test_c_cancel_stops_the_expanded_c_finds(shield, slow_pacs):
+    """Cancelling a C-FIND that was expanded into one C-FIND per patient sends none of the remaining ones"""
+    port, pacs = shield
+    slow_pacs.delays["find"] = 0.3
+    patient_ids = list(dict.fromkeys(ds.PatientID for ds in pacs.datasets))
+    ds = Dataset()
+    ds.QueryRetrieveLevel = "STUDY"
+    ds.PatientID = [make_pseudonym(patient_id) for patient_id in patient_ids]
+    ds.StudyInstanceUID = ""
+
+    assoc = associate(port)
+    statuses = []
+    for status, _ in assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind, msg_id=1):
+        statuses.append(status.Status)
+        if status.Status == 0xFF00 and statuses.count(0xFF00) == 1:
+            assoc.send_c_cancel(1, None, StudyRootQueryRetrieveInformationModelFind)
+    assoc.release()
+    sent = len(slow_pacs.requests)
+    time.sleep(2 * len(patient_ids) * slow_pacs.delays["find"])
+
+    assert statuses[-1] == 0xFE00
+    assert len(slow_pacs.requests) == sent <= 2 < len(patient_ids)
+
+
+@pytest.mark.parametrize("operation", ["get", "move"])
+def test_c_cancel_stops_the_upstream_retrieve(shield, slow_pacs, operation):
+    port, pacs = shield
+    model = StudyRootQueryRetrieveInformationModelGet if operation == "get" \
+        else StudyRootQueryRetrieveInformationModelMove
+    received = []
+
+    assoc = associate(port, received)
+    statuses = send_and_cancel(assoc, operation, study_query(pacs), model)
+    assoc.release()
+    time.sleep(1)
+
+    assert statuses[-1] == 0xFE00
+    assert slow_pacs.cancelled or slow_pacs.aborted
+    assert len(received) <= slow_pacs.sent < 8
+
+
+def test_dropped_client_aborts_the_upstream_retrieve(shield, slow_pacs):
+    port, pacs = shield
+    received = []
+
+    assoc = associate(port, received)
+    threading.Timer(1.0, assoc.abort).start()
+    list(assoc.send_c_get(study_query(pacs), StudyRootQueryRetrieveInformationModelGet, msg_id=1))
+    deadline = time.monotonic() + 5
+    while not slow_pacs.aborted and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    time.sleep(1)
+
+    assert slow_pacs.aborted
+    assert len(received) <= slow_pacs.sent < 8
@@ -0,0 +1,52 @@
+import time
+from types import SimpleNamespace
+
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from conftest import query
+
+
+def request(patient_id):
+    return SimpleNamespace(assoc=SimpleNamespace(requestor=SimpleNamespace(ae_title="CLIENT")),
+                           context=SimpleNamespace(abstract_syntax=StudyRootQueryRetrieveInformationModelFind),
+                           identifier=query(PatientID=patient_id, PatientName="Doe^John"))
+
+
+def entries(capture, path, count):
+    """The entries of the capture once `count` of them have been flushed by the writer thread"""
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        found = list(capture.read(str(path))) if path.exists() else []
+        if len(found) >= count:
+            return found
+        time.sleep(0.01)
+    return found
+
+
+def test_capture_keeps_pseudonyms_and_clears_removed_fields(capture, anonymizer, tmp_path):
+    path = tmp_path / "capture.jsonl.gz"
+    recorder = capture.Recorder(str(path), anonymizer)
+    recorder.record(request("PSN1"), "find")
+
+    [entry] = entries(capture, path, 1)
+    identifier = Dataset.from_json(entry["identifier"])
+    assert entry["op"] == "find" and entry["calling_aet"] == "CLIENT"
+    assert identifier.PatientID == "PSN1"
+    assert identifier.PatientName == ""
+
+
+def test_capture_survives_a_broken_entry(capture, anonymizer, tmp_path, monkeypatch):
+    def shield_capture(dataset):
+        if dataset.PatientID == "BROKEN":
+            raise ValueError("cannot be recorded")
+        return dataset
+
+    monkeypatch.setattr(anonymizer, "shield_capture", shield_capture)
+    path = tmp_path / "capture.jsonl.gz"
+    recorder = capture.Recorder(str(path), anonymizer)
+    recorder.record(request("BROKEN"), "find")
+    recorder.record(request("PSN2"), "find")
+
+    assert [Dataset.from_json(entry["identifier"]).PatientID for entry in entries(capture, path, 1)] == ["PSN2"]
+    assert recorder.dropped == 1
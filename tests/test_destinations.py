@@ -0,0 +1,175 @@
+"""The pool of associations to C-MOVE destinations, with a mock PACS as the destination"""
+import threading
+import time
+
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian
+from pynetdicom import AE, build_context, evt
+from pynetdicom.sop_class import CTImageStorage, StudyRootQueryRetrieveInformationModelMove
+
+from benchmark import DESTINATION_AET, SCU_AET, Destination, LoadGenerator, Shield, free_port
+from conftest import shield_config
+from mock_gpas import make_pseudonym
+from mock_pacs import MockPACS
+
+CONTEXTS = [build_context(CTImageStorage, ExplicitVRLittleEndian)]
+
+
+class CountingPACS(MockPACS):
+    """Mock PACS counting the associations it accepted, with a C-ECHO status that can be changed"""
+
+    def __init__(self, port):
+        super().__init__([], port, ae_title="MOVE-DESTINATION")
+        self.accepted = 0
+        self.echo_status = 0x0000
+
+    def start(self):
+        server = super().start()
+        server.bind(evt.EVT_ACCEPTED, self._count)
+        server.bind(evt.EVT_C_ECHO, lambda event: self.echo_status)
+        return server
+
+    def _count(self, event):
+        self.accepted += 1
+
+
+@pytest.fixture()
+def destination():
+    pacs = CountingPACS(free_port())
+    pacs.start()
+    yield pacs
+    pacs.stop()
+
+
+@pytest.fixture()
+def acquire(destinations, destination):
+    """acquire(pool) of an association to the destination"""
+    ae = AE("DICOMSHIELD")
+
+    def acquire(pool):
+        return pool.acquire(ae, "127.0.0.1", destination.port, destination.ae_title, CONTEXTS)
+    return acquire
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_released_association_is_reused(destinations, destination, acquire):
+    pool = destinations.DestinationPool()
+
+    first = acquire(pool)
+    first.release()
+    second = acquire(pool)
+
+    assert second.assoc is first.assoc and second.is_established
+    assert destination.accepted == 1
+    assert pool.size(in_use=True) == 1
+    second.release()
+    assert pool.size() == 1
+
+
+def test_associations_per_destination_are_capped(destinations, destination, acquire):
+    pool = destinations.DestinationPool(max_associations=2, timeout=10)
+    in_use, peak = [0], [0]
+    lock = threading.Lock()
+
+    def move():
+        pooled = acquire(pool)
+        with lock:
+            in_use[0] += 1
+            peak[0] = max(peak[0], in_use[0])
+        time.sleep(0.2)
+        with lock:
+            in_use[0] -= 1
+        pooled.release()
+
+    threads = [threading.Thread(target=move) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+    assert destination.accepted == 2
+    assert len(destination.server.active_associations) == pool.size() == 2
+
+
+def test_waiting_for_a_free_association_times_out(destinations, destination, acquire):
+    pool = destinations.DestinationPool(max_associations=1, timeout=0.3)
+    pooled = acquire(pool)
+
+    with pytest.raises(destinations.DestinationBusy):
+        acquire(pool)
+    pooled.release()
+
+
+def test_idle_associations_expire(destinations, destination, acquire):
+    pool = destinations.DestinationPool(idle_timeout=1)
+    acquire(pool).release()
+
+    wait_for(lambda: pool.size() == 0)
+    wait_for(lambda: not destination.server.active_associations)
+
+    acquire(pool).release()
+    assert destination.accepted == 2
+
+
+@pytest.mark.parametrize("failure", ["echo", "abort"])
+def test_dead_association_is_replaced(destinations, destination, acquire, failure):
+    """An idle association is checked with a C-ECHO before it is reused"""
+    pool = destinations.DestinationPool(check_interval=0)
+    first = acquire(pool)
+    first.release()
+    if failure == "echo":
+        destination.echo_status = 0xC000
+    else:
+        for assoc in destination.server.active_associations:
+            assoc.abort()
+        wait_for(lambda: not first.assoc.is_established)
+
+    second = acquire(pool)
+
+    assert second.assoc is not first.assoc and second.is_established
+    assert not first.assoc.is_established
+    assert destination.accepted == 2
+    second.release()
+
+
+def test_consecutive_c_moves_share_one_association(mock_upstreams, tmp_path_factory):
+    """A C-MOVE through DicomShield after another one reuses the association to the destination"""
+    gpas, pacs = mock_upstreams
+    receiver = Destination(free_port())
+    server = receiver.start()
+    accepted = []
+    server.bind(evt.EVT_ACCEPTED, accepted.append)
+    config = shield_config(gpas, pacs, destination=receiver.port)
+    config["RETRIEVE_MODE"] = "MOVE"
+    pacs.move_destinations = {"DICOMSHIELD-PACS": ("127.0.0.1", config["C_STORE_ENDPOINT"]["PORT"])}
+    shield = Shield(str(tmp_path_factory.mktemp("shield-pool")), config)
+    shield.start()
+    try:
+        port = config["INGRESS"]["PORT"]
+        assert len(LoadGenerator("127.0.0.1", port, "DICOMSHIELD").find_studies()) == 2
+        ae = AE(ae_title=SCU_AET)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+        for study_uid in dict.fromkeys(ds.StudyInstanceUID for ds in pacs.datasets):
+            assoc = ae.associate("127.0.0.1", port, ae_title="DICOMSHIELD")
+            ds = Dataset()
+            ds.QueryRetrieveLevel = "STUDY"
+            ds.StudyInstanceUID = make_pseudonym(study_uid)
+            statuses = [status.Status for status, _ in
+                        assoc.send_c_move(ds, DESTINATION_AET, StudyRootQueryRetrieveInformationModelMove) if status]
+            assoc.release()
+            assert statuses[-1] == 0x0000
+    finally:
+        shield.stop()
+        server.shutdown()
+        pacs.move_destinations = {}
+
+    assert receiver.instances == len(pacs.datasets)
+    assert len(accepted) == 1
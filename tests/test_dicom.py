@@ -26,12 +26,11 @@ def test_c_echo(association):
 
 @pytest.mark.dependency(name="test_c_store")
 def test_c_store(association, test_dicom):
-    """Send the DICOM file via C-STORE"""
+    """C-STORE requests of clients are refused, DicomShield does not store instances"""
     logging.info("Testing C-STORE using pynetdicom")
     status = association.send_c_store(test_dicom)
 
-    # Check if the status indicates success
-    assert status.Status == 0x0000, f"C-STORE failed with status: {hex(status.Status)}"
+    assert status.Status == 0x0124, f"C-STORE was not refused, status: {hex(status.Status)}"
 
 
 @pytest.mark.dependency(depends=["test_c_store"], name="test_c_find_study_level")
@@ -0,0 +1,194 @@
+"""QIDO-RS and WADO-RS: the request parsing, and the requests against DicomShield started as a subprocess"""
+import http.client
+import json
+from io import BytesIO
+
+import pytest
+from pydicom import dcmread
+from pydicom.uid import ExplicitVRLittleEndian, JPEGBaseline8Bit
+
+from benchmark import LoadGenerator, Shield
+from conftest import shield_config
+from mock_gpas import make_pseudonym
+
+
+@pytest.mark.parametrize("path, route", [
+    ("/studies", ("qido", "STUDY", {})),
+    ("/series/", ("qido", "SERIES", {})),
+    ("/instances", ("qido", "IMAGE", {})),
+    ("/studies/1.2/series", ("qido", "SERIES", {"StudyInstanceUID": "1.2"})),
+    ("/studies/1.2/instances", ("qido", "IMAGE", {"StudyInstanceUID": "1.2"})),
+    ("/studies/1.2/series/1.3/instances",
+     ("qido", "IMAGE", {"StudyInstanceUID": "1.2", "SeriesInstanceUID": "1.3"})),
+    ("/studies/1.2", ("wado", "STUDY", {"StudyInstanceUID": "1.2"})),
+    ("/studies/1.2/series/1.3", ("wado", "SERIES", {"StudyInstanceUID": "1.2", "SeriesInstanceUID": "1.3"})),
+    ("/studies/1.2/series/1.3/instances/1.4",
+     ("wado", "IMAGE", {"StudyInstanceUID": "1.2", "SeriesInstanceUID": "1.3", "SOPInstanceUID": "1.4"})),
+    ("/studies/1.2/metadata", ("metadata", "STUDY", {"StudyInstanceUID": "1.2"})),
+    ("/studies/1.2/series/1.3/metadata",
+     ("metadata", "SERIES", {"StudyInstanceUID": "1.2", "SeriesInstanceUID": "1.3"})),
+    ("/", None),
+    ("/patients", None),
+    ("/studies/1.2/frames/1", None),
+    ("/studies/1.2/series/1.3/instances/1.4/rendered", None),
+])
+def test_parse_path(dicomweb, path, route):
+    assert dicomweb.parse_path(path) == route
+
+
+def test_parse_query(dicomweb):
+    identifier, limit, offset = dicomweb.parse_query(
+        "PatientID=PSN1&StudyDate=20200101-&includefield=BodyPartExamined,00081030&limit=10&offset=5&fuzzymatching=true",
+        "STUDY", {})
+
+    assert (limit, offset) == (10, 5)
+    assert identifier.QueryRetrieveLevel == "STUDY"
+    assert identifier.PatientID == "PSN1" and identifier.StudyDate == "20200101-"
+    assert "BodyPartExamined" in identifier and "StudyDescription" in identifier
+    assert identifier.StudyInstanceUID == ""  # A return key
+
+
+def test_parse_query_scope_and_uid_lists(dicomweb):
+    identifier, limit, offset = dicomweb.parse_query("SOPInstanceUID=1.4,1.5", "IMAGE", {"StudyInstanceUID": "1.2"})
+
+    assert (limit, offset) == (None, 0)
+    assert identifier.StudyInstanceUID == "1.2"
+    assert list(identifier.SOPInstanceUID) == ["1.4", "1.5"]
+
+
+@pytest.mark.parametrize("query", ["limit=-1", "offset=-1", "limit=ten", "offset=", "NoSuchAttribute=1",
+                                   "includefield=NoSuchAttribute"])
+def test_parse_query_rejects(dicomweb, query):
+    with pytest.raises(ValueError):
+        dicomweb.parse_query(query, "STUDY", {})
+
+
+@pytest.mark.parametrize("accept, transfer_syntax", [
+    (None, ExplicitVRLittleEndian),
+    ("*/*", ExplicitVRLittleEndian),
+    ("application/dicom", ExplicitVRLittleEndian),
+    (f'multipart/related; type="application/dicom"; transfer-syntax={JPEGBaseline8Bit}', JPEGBaseline8Bit),
+    ('multipart/related; type="application/dicom"; transfer-syntax=*', "*"),
+    ("multipart/related; type=application/dicom", ExplicitVRLittleEndian),
+    ('application/json, multipart/related; type="application/dicom"; transfer-syntax=*', "*"),
+    ('multipart/related; type="application/octet-stream"', None),
+    ("application/json", None),
+])
+def test_accepted_transfer_syntax(dicomweb, accept, transfer_syntax):
+    assert dicomweb.accepted_transfer_syntax(accept) == transfer_syntax
+
+
+@pytest.fixture(scope="module")
+def dicomweb_shield(mock_upstreams, tmp_path_factory):
+    """(DICOMweb port, pacs) of DicomShield, with the pseudonyms of the mock PACS handed out by a C-FIND"""
+    gpas, pacs = mock_upstreams
+    config = shield_config(gpas, pacs)
+    shield = Shield(str(tmp_path_factory.mktemp("shield-dicomweb")), config)
+    shield.start()
+    assert len(LoadGenerator("127.0.0.1", config["INGRESS"]["PORT"], "DICOMSHIELD").find_studies()) == 2
+    yield config["DICOMWEB"]["PORT"], pacs
+    shield.stop()
+
+
+def get(port, path, accept=None):
+    """(status, Content-Type, body) of a GET request"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        connection.request("GET", path, headers={"Accept": accept} if accept else {})
+        response = connection.getresponse()
+        return response.status, response.getheader("Content-Type", ""), response.read()
+    finally:
+        connection.close()
+
+
+def parts(content_type, body):
+    """The instances of a multipart/related response"""
+    boundary = content_type.partition("boundary=")[2].encode()
+    instances = []
+    for part in body.split(b"--" + boundary)[1:-1]:
+        headers, _, data = part.partition(b"\r\n\r\n")
+        assert b"Content-Type: application/dicom" in headers
+        instances.append(dcmread(BytesIO(data[:-2])))
+    return instances
+
+
+def study(pacs, index=0):
+    """(pseudonymized StudyInstanceUID, original instances) of a study of the mock PACS"""
+    study_uid = list(dict.fromkeys(ds.StudyInstanceUID for ds in pacs.datasets))[index]
+    return make_pseudonym(study_uid), [ds for ds in pacs.datasets if ds.StudyInstanceUID == study_uid]
+
+
+def test_qido_studies(dicomweb_shield):
+    port, pacs = dicomweb_shield
+
+    status, content_type, body = get(port, "/studies")
+
+    assert status == 200 and content_type == "application/dicom+json"
+    study_uids = {result["0020000D"]["Value"][0] for result in json.loads(body)}
+    assert study_uids == {study(pacs, index)[0] for index in range(2)}
+
+
+def test_qido_limit_offset_and_scope(dicomweb_shield):
+    port, pacs = dicomweb_shield
+    study_uid, instances = study(pacs)
+
+    status, _, body = get(port, f"/studies/{study_uid}/instances?limit=2&offset=1")
+
+    assert status == 200
+    results = json.loads(body)
+    assert len(results) == 2 < len(instances)
+    originals = {make_pseudonym(ds.SOPInstanceUID) for ds in instances}
+    assert {result["00080018"]["Value"][0] for result in results} <= originals
+
+
+def test_qido_without_matches(dicomweb_shield):
+    port, _ = dicomweb_shield
+
+    assert get(port, f"/studies?PatientID={make_pseudonym('unknown patient')}")[0] == 204
+
+
+def test_qido_bad_request(dicomweb_shield):
+    port, _ = dicomweb_shield
+
+    assert get(port, "/studies?limit=-1")[0] == 400
+    assert get(port, "/patients")[0] == 404
+
+
+def test_wado_study(dicomweb_shield):
+    port, pacs = dicomweb_shield
+    study_uid, instances = study(pacs, 1)
+
+    status, content_type, body = get(port, f"/studies/{study_uid}",
+                                     f'multipart/related; type="application/dicom"; '
+                                     f'transfer-syntax={ExplicitVRLittleEndian}')
+
+    assert status == 200 and content_type.startswith("multipart/related")
+    received = parts(content_type, body)
+    assert {ds.SOPInstanceUID for ds in received} == {make_pseudonym(ds.SOPInstanceUID) for ds in instances}
+    assert all(ds.StudyInstanceUID == study_uid and ds.PatientName == "" for ds in received)
+    assert all(ds.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian for ds in received)
+
+
+def test_wado_metadata(dicomweb_shield):
+    port, pacs = dicomweb_shield
+    study_uid, instances = study(pacs)
+
+    status, _, body = get(port, f"/studies/{study_uid}/metadata")
+
+    assert status == 200
+    metadata = json.loads(body)
+    assert len(metadata) == len(instances)
+    assert all("7FE00010" not in ds and ds["0020000D"]["Value"] == [study_uid] for ds in metadata)
+
+
+def test_wado_unknown_study(dicomweb_shield):
+    port, _ = dicomweb_shield
+
+    assert get(port, f"/studies/{make_pseudonym('unknown study')}")[0] == 404
+
+
+def test_wado_not_acceptable(dicomweb_shield):
+    port, pacs = dicomweb_shield
+    study_uid, _ = study(pacs)
+
+    assert get(port, f"/studies/{study_uid}", "application/json")[0] == 406
@@ -0,0 +1,138 @@
+"""Structured events of log.py: sampling, rate limiting and the per-request summaries"""
+import json
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import query
+
+
+@pytest.fixture()
+def events(log, caplog, monkeypatch):
+    """Returns the messages of the events logged so far, with sampling and rate limiting off"""
+    monkeypatch.setattr(log, "_sample", {})
+    monkeypatch.setattr(log, "_rate_limit", 0)
+    monkeypatch.setattr(log, "_buckets", {})
+    caplog.set_level(logging.INFO)
+    return lambda: [record.getMessage() for record in caplog.records if isinstance(record.msg, log.Event)]
+
+
+@pytest.fixture()
+def clock(log, monkeypatch):
+    """Frozen time.monotonic of log.py, advanced by assigning clock.now"""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(log.time, "monotonic", lambda: clock.now)
+    return clock
+
+
+def test_event_fields(log, events):
+    log.event("move.forward", instances=3, destination="AI NODE", seconds=0.5, note="")
+
+    assert events() == ["move.forward instances=3 destination='AI NODE' seconds=0.500 note=''"]
+
+
+def test_event_below_the_level_is_not_logged(log, events):
+    log.event("move.upstream_status", logging.DEBUG, status=0xFF00)
+
+    assert events() == []
+
+
+def test_sampling_per_operation_and_name(log, events, monkeypatch):
+    monkeypatch.setattr(log, "_sample", {"find": 0.0, "move": 1.0, "move.forward": 0.0, "get": 0.5})
+    draws = iter([0.9, 0.9, 0.9, 0.2, 0.7])
+    monkeypatch.setattr(log.random, "random", lambda: next(draws))
+
+    for name in ("find.done", "move.done", "move.forward", "get.done", "get.done", "store.refused"):
+        log.event(name)
+
+    assert events() == ["move.done", "get.done", "store.refused"]
+
+
+def test_rate_limit_reports_the_suppressed_events(log, events, clock, monkeypatch):
+    monkeypatch.setattr(log, "_rate_limit", 2)
+
+    for _ in range(5):
+        log.event("find.done")
+    log.event("get.done")  # Limited per name
+    clock.now += 1
+    log.event("find.done")
+
+    assert events() == ["find.done", "find.done", "get.done", "find.done suppressed=3"]
+
+
+def test_admit(log, clock, monkeypatch):
+    monkeypatch.setattr(log, "_sample", {})
+    monkeypatch.setattr(log, "_buckets", {})
+    monkeypatch.setattr(log, "_rate_limit", 1)
+
+    assert log._admit("find.done") == 0
+    assert log._admit("find.done") is None
+    clock.now += 0.5
+    assert log._admit("find.done") is None  # Half a token
+    clock.now += 0.5
+    assert log._admit("find.done") == 2
+
+
+def request(level="STUDY", **attrs):
+    return SimpleNamespace(identifier=query(level, **attrs),
+                           assoc=SimpleNamespace(requestor=SimpleNamespace(ae_title="WEASIS")))
+
+
+def summary(events):
+    """The fields of the single summary event logged, without its duration"""
+    [message] = events()
+    name, *fields = message.split()
+    fields = dict(field.split("=", 1) for field in fields)
+    assert float(fields.pop("seconds")) >= 0
+    return name, fields
+
+
+def test_summary_of_a_request(log, events):
+    @log.summarized("find")
+    def handle_find(event):
+        yield 0xFF00, query()
+        yield 0xFF00, query()
+        yield 0x0000, None
+
+    assert len(list(handle_find(request(StudyInstanceUID="1.2.3")))) == 3
+
+    assert summary(events) == ("find.done", {"calling_aet": "WEASIS", "query_level": "STUDY",
+                                             "study_uid": "1.2.3", "results": "2", "status": "0x0000"})
+
+
+def test_summary_of_a_failed_request(log, events):
+    @log.summarized("get")
+    def handle_get(event):
+        yield 1
+        yield 0xFF00, query()
+        raise ValueError("upstream gone")
+
+    with pytest.raises(ValueError):
+        list(handle_get(request("SERIES")))
+
+    assert summary(events) == ("get.done", {"calling_aet": "WEASIS", "query_level": "SERIES",
+                                            "study_uid": "''", "results": "1", "status": "ValueError"})
+
+
+def test_summary_of_a_closed_request(log, events):
+    """pynetdicom stops iterating a handler when the client cancels or disconnects"""
+    @log.summarized("find")
+    def handle_find(event):
+        while True:
+            yield 0xFF00, query()
+
+    handler = handle_find(request())
+    next(handler)
+    handler.close()
+
+    assert summary(events)[1]["status"] == "closed"
+
+
+def test_json_format(log, events, caplog):
+    log.event("find.done", calling_aet="WEASIS", results=12, seconds=0.41)
+
+    [record] = caplog.records
+    entry = json.loads(log.JSONFormatter().format(record))
+    assert entry["event"] == "find.done" and entry["level"] == "INFO"
+    assert (entry["calling_aet"], entry["results"], entry["seconds"]) == ("WEASIS", 12, 0.41)
@@ -0,0 +1,97 @@
+import logging
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+from utils_for_tests import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy"))
+
+import metrics
+
+
+def test_metrics_endpoint(association):
+    """Send a C-ECHO and check that the metrics endpoint reports the ingress association"""
+    association.send_c_echo()
+
+    logging.info(f"GET {METRICS_URL}")
+    r = requests.get(METRICS_URL)
+    r.raise_for_status()
+
+    assert r.headers["Content-Type"].startswith("text/plain")
+    assert "# TYPE dicomshield_upstream_request_seconds histogram" in r.text
+    assert 'dicomshield_active_associations{server="ingress"}' in r.text
+
+
+@pytest.fixture()
+def registry(monkeypatch):
+    """An empty REGISTRY for the metrics created by a test"""
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+    return metrics.REGISTRY
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = metrics.Histogram("test_seconds", "Test durations", buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, operation="find")
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{operation="find",le="0.1"} 2',
+        'test_seconds_bucket{operation="find",le="1.0"} 3',
+        'test_seconds_bucket{operation="find",le="+Inf"} 4',
+        'test_seconds_sum{operation="find"} 5.65',
+        'test_seconds_count{operation="find"} 4',
+    ]
+
+
+def test_histogram_time_iter_counts_waiting_only(registry):
+    histogram = metrics.Histogram("test_seconds", "Test durations", buckets=(0.05,))
+
+    for _ in histogram.time_iter(range(3)):
+        time.sleep(0.03)  # spent by the consumer, not waiting for the items
+
+    assert 'test_seconds_bucket{le="0.05"} 1' in histogram.render()
+
+
+def test_labels_are_sorted_and_series_kept_apart(registry):
+    counter = metrics.Counter("test_total", "Test events")
+    counter.inc(server="ingress", direction="received")
+    counter.inc(2, direction="received", server="ingress")
+    counter.inc(direction="forwarded")
+
+    assert counter.render()[2:] == [
+        'test_total{direction="received",server="ingress"} 3.0',
+        'test_total{direction="forwarded"} 1.0',
+    ]
+
+
+def test_text_exposition_format(registry):
+    metrics.Counter("test_requests_total", "Requests").inc()
+    gauge = metrics.Gauge("test_queue_depth", "Queued instances")
+    gauge.set_function(lambda: 7, server="internal")
+    gauge.set(1)
+
+    assert metrics.render() == (
+        "# HELP test_requests_total Requests\n"
+        "# TYPE test_requests_total counter\n"
+        "test_requests_total 1.0\n"
+        "# HELP test_queue_depth Queued instances\n"
+        "# TYPE test_queue_depth gauge\n"
+        "test_queue_depth 1.0\n"
+        'test_queue_depth{server="internal"} 7.0\n'
+    )
+
+
+def test_failing_gauge_callback_is_left_out(registry):
+    gauge = metrics.Gauge("test_gauge", "Broken callback")
+    gauge.set_function(lambda: 1 / 0)
+
+    assert gauge.render() == ["# HELP test_gauge Broken callback", "# TYPE test_gauge gauge"]
+
+
+def test_metric_needs_samples():
+    with pytest.raises(TypeError):
+        metrics.Metric("test_metric", "Without samples")
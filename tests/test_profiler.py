@@ -0,0 +1,89 @@
+import http.client
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy"))
+
+import metrics
+import profiler
+from benchmark import free_port
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture()
+def threads():
+    """A busy thread in spin() and an idle one waiting for the same event"""
+    stop = threading.Event()
+    busy = threading.Thread(target=spin, args=(stop,), name="busy-1")
+    idle = threading.Thread(target=stop.wait, name="idle-1")
+    busy.start()
+    idle.start()
+    yield
+    stop.set()
+    busy.join()
+    idle.join()
+
+
+def test_profile_finds_the_busy_thread(threads):
+    stacks = profiler.profile(0.3)
+
+    busy = [stack for stack in stacks if stack.startswith("busy;")]
+    assert busy and all(";test_profiler:spin" in stack for stack in busy)
+    assert sum(stacks[stack] for stack in busy) > 10
+    assert not any(stack.startswith("idle;") for stack in stacks)
+    assert profiler.folded(stacks).splitlines()[0] == f"{stacks.most_common(1)[0][0]} {stacks.most_common(1)[0][1]}"
+
+
+def test_profile_with_idle_threads(threads):
+    stacks = profiler.profile(0.1, idle=True)
+
+    assert any(stack.startswith("idle;") and stack.endswith("threading:wait") for stack in stacks)
+
+
+@pytest.fixture(scope="module")
+def debug_port():
+    port = free_port()
+    server = metrics.start_server(port, "127.0.0.1", profiling=True)
+    yield port
+    server.shutdown()
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return response.status, response.read().decode()
+    finally:
+        connection.close()
+
+
+def test_debug_profile(debug_port, threads):
+    status, body = get(debug_port, "/debug/profile?seconds=0.3")
+
+    assert status == 200
+    assert any(line.startswith("busy;") and "test_profiler:spin" in line for line in body.splitlines())
+
+
+def test_concurrent_profile_is_refused(debug_port):
+    first = threading.Thread(target=get, args=(debug_port, "/debug/profile?seconds=1"))
+    first.start()
+    time.sleep(0.3)
+
+    assert get(debug_port, "/debug/profile?seconds=0.1")[0] == 409
+    first.join()
+    assert get(debug_port, "/debug/profile?seconds=0.1")[0] == 200
+
+
+@pytest.mark.parametrize("query", ["seconds=61", "seconds=3600", "seconds=0", "seconds=-1", "seconds=ten"])
+def test_debug_seconds_are_bounded(debug_port, query):
+    assert get(debug_port, f"/debug/profile?{query}")[0] == 400
+    assert get(debug_port, f"/debug/memory?{query}")[0] == 400
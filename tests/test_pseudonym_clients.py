@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from benchmark import free_port
+from mock_gpas import make_pseudonym
+
+
+def test_circuit_breaker_opens_after_threshold(pseudonym_clients):
+    breaker = pseudonym_clients.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED and breaker.allow_request()
+
+    breaker.record_failure()
+
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow_request()
+
+
+def test_circuit_breaker_success_resets_failures(pseudonym_clients):
+    breaker = pseudonym_clients.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == breaker.CLOSED
+
+
+def test_circuit_breaker_half_open_probe(pseudonym_clients):
+    """After the reset timeout a single probe is let through, its result closes or opens the breaker again"""
+    breaker = pseudonym_clients.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    time.sleep(0.06)
+
+    assert breaker.allow_request()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow_request()  # only one probe
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED and breaker.allow_request()
+
+
+def test_cache_evicts_least_recently_used(pseudonym_clients):
+    cache = pseudonym_clients.PseudonymCache(max_size=2)
+    cache.add({"PAT1": "PSN1", "PAT2": "PSN2"})
+    cache.get_originals(["PSN1"])
+    cache.add({"PAT3": "PSN3"})
+
+    assert cache.get_pseudonyms(["PAT1", "PAT2", "PAT3"]) == ({"PAT1": "PSN1", "PAT3": "PSN3"}, ["PAT2"])
+    assert cache.get_originals(["PSN2"]) == ({}, ["PSN2"])
+
+
+def test_client_resolves_and_caches(pseudonym_clients, mock_upstreams):
+    gpas, _ = mock_upstreams
+    client = pseudonym_clients.gPASClient()
+    requests = gpas.requests
+
+    assert client.pseudonomize({0: "PAT1"}) == {"PAT1": make_pseudonym("PAT1")}
+    assert client.depseudonomize({0: make_pseudonym("PAT1")}) == {make_pseudonym("PAT1"): "PAT1"}
+    assert gpas.requests == requests + 1  # the reverse lookup is a cache hit
+
+
+def test_client_serves_cache_while_server_is_down(pseudonym_clients):
+    """Degraded mode: cached values are still resolved, others fail fast once the breaker is open"""
+    client = pseudonym_clients.gPASClient()
+    client.breaker = pseudonym_clients.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    client.cache.add({"PAT1": "PSN1"})
+    client.base_url = f"http://127.0.0.1:{free_port()}/gpas"  # nothing listens there
+
+    for _ in range(2):
+        with pytest.raises(pseudonym_clients.PseudonymServerUnavailable):
+            client.pseudonomize({0: "PAT2"})
+    assert client.breaker.state == client.breaker.OPEN
+
+    assert client.pseudonomize({0: "PAT1"}) == {"PAT1": "PSN1"}
+    assert client.depseudonomize({0: "PSN1"}) == {"PSN1": "PAT1"}
+    with pytest.raises(pseudonym_clients.PseudonymServerUnavailable, match="Circuit breaker is open"):
+        client.depseudonomize({0: "PSN2"})
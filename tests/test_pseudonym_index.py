@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy"))
+
+from pseudonym_index import PseudonymIndex, is_wildcard
+
+
+def test_is_wildcard():
+    assert is_wildcard("PSN12*") and is_wildcard("PSN12??")
+    assert not is_wildcard("PSN123")
+
+
+def test_match_star_and_question_mark():
+    index = PseudonymIndex()
+    for pseudonym, original in (("PSN120", "PAT0"), ("PSN121", "PAT1"), ("PSN1234", "PAT2"), ("PSN200", "PAT3")):
+        index.add("PatientID", pseudonym, original)
+
+    assert index.match("PatientID", "PSN12*") == {"PSN120": "PAT0", "PSN121": "PAT1", "PSN1234": "PAT2"}
+    assert index.match("PatientID", "PSN12?") == {"PSN120": "PAT0", "PSN121": "PAT1"}
+    assert index.match("PatientID", "*00") == {"PSN200": "PAT3"}
+    assert index.match("PatientID", "PSN3*") == {}
+
+
+def test_match_is_per_attribute():
+    index = PseudonymIndex()
+    index.add("PatientID", "PSN1", "PAT1")
+    index.add("AccessionNumber", "PSN2", "ACC2")
+
+    assert index.match("PatientID", "PSN*") == {"PSN1": "PAT1"}
+
+
+def test_entries_without_attribute_match_every_attribute():
+    """Like the pairs of CACHE_WARM_START"""
+    index = PseudonymIndex()
+    index.add(None, "PSN1", "PAT1")
+
+    assert index.match("PatientID", "PSN*") == {"PSN1": "PAT1"}
+    assert index.match("StudyInstanceUID", "PSN*") == {"PSN1": "PAT1"}
+
+
+def test_oldest_entries_are_dropped():
+    index = PseudonymIndex(max_size=2)
+    for i in range(3):
+        index.add("PatientID", f"PSN{i}", f"PAT{i}")
+
+    assert len(index) == 2
+    assert index.match("PatientID", "PSN*") == {"PSN1": "PAT1", "PSN2": "PAT2"}
+
+
+def test_disabled_index_stays_empty():
+    index = PseudonymIndex(max_size=0)
+    index.add("PatientID", "PSN1", "PAT1")
+
+    assert len(index) == 0
+    assert index.match("PatientID", "PSN*") == {}
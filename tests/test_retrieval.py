@@ -0,0 +1,204 @@
+"""C-GET and C-MOVE through DicomShield, started as a subprocess against the mock PACS and mock gPAS of the benchmark"""
+import pytest
+from pydicom.dataset import Dataset
+from pynetdicom import AE, build_role, evt
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    MRImageStorage,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+
+from benchmark import DESTINATION_AET, SCU_AET, Destination, LoadGenerator, Shield, free_port
+from conftest import shield_config
+from mock_gpas import MockGPAS, make_pseudonym
+from mock_pacs import TRANSFER_SYNTAXES, MockPACS, create_studies
+
+SOP_CLASSES = (CTImageStorage, MRImageStorage)
+
+
+class FaultyPACS(MockPACS):
+    """Mock PACS that fails the C-STORE sub-operations of the `failing` SOP Instance UIDs and can refuse
+    IMAGE-level C-FINDs"""
+
+    def __init__(self, datasets, port, **kwargs):
+        super().__init__(datasets, port, **kwargs)
+        self.failing = set()
+        self.image_level = True
+
+    def _handle_find(self, event):
+        if event.identifier.QueryRetrieveLevel == "IMAGE" and not self.image_level:
+            yield 0xC000, None  # Failure
+            return
+        yield from super()._handle_find(event)
+
+    def _fail(self, responses):
+        for item in responses:
+            if isinstance(item, tuple) and len(item) == 2 and isinstance(item[1], Dataset) \
+                    and item[1].SOPInstanceUID in self.failing:
+                item = (0xFF00, "not a dataset")  # pynetdicom counts it as a failed sub-operation
+            yield item
+
+    def _handle_move(self, event):
+        yield from self._fail(super()._handle_move(event))
+
+    def _handle_get(self, event):
+        yield from self._fail(super()._handle_get(event))
+
+
+@pytest.fixture(scope="module")
+def upstream():
+    datasets = create_studies(2, 2, 3, 16, 16, sop_classes=SOP_CLASSES)
+    gpas = MockGPAS(free_port())
+    gpas.start()
+    pacs = FaultyPACS(datasets, free_port())
+    pacs.start()
+    destination = Destination(free_port())
+    server = destination.start()
+    yield pacs, gpas, destination
+    server.shutdown()
+    pacs.stop()
+    gpas.stop()
+
+
+@pytest.fixture(scope="module", params=["MOVE", "GET"])
+def shield(request, upstream, tmp_path_factory):
+    """(port, pacs, destination) of DicomShield in both retrieve modes"""
+    pacs, gpas, destination = upstream
+    config = shield_config(gpas, pacs, destination=destination.port)
+    config["RETRIEVE_MODE"] = request.param
+    pacs.move_destinations = {"DICOMSHIELD-PACS": ("127.0.0.1", config["C_STORE_ENDPOINT"]["PORT"])}
+
+    shield = Shield(str(tmp_path_factory.mktemp(f"shield-{request.param.lower()}")), config)
+    shield.start()
+    port = config["INGRESS"]["PORT"]
+    # The mock gPAS only resolves the pseudonyms it handed out
+    assert len(LoadGenerator("127.0.0.1", port, "DICOMSHIELD").find_studies()) == 2
+    yield port, pacs, destination
+    shield.stop()
+
+
+@pytest.fixture(autouse=True)
+def reset_pacs(upstream):
+    pacs, _, _ = upstream
+    yield
+    pacs.failing.clear()
+    pacs.image_level = True
+
+
+def study(pacs, index=0):
+    """(pseudonymized StudyInstanceUID, original instances) of a study of the mock PACS"""
+    study_uid = list(dict.fromkeys(ds.StudyInstanceUID for ds in pacs.datasets))[index]
+    return make_pseudonym(study_uid), [ds for ds in pacs.datasets if ds.StudyInstanceUID == study_uid]
+
+
+def retrieve(port, study_uid, operation):
+    """Returns (final status, received datasets) of a C-GET or a C-MOVE to the destination"""
+    received = []
+
+    def handle_store(event):
+        received.append(event.dataset)
+        return 0x0000
+
+    ae = AE(ae_title=SCU_AET)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+    for sop_class in SOP_CLASSES:
+        ae.add_requested_context(sop_class, TRANSFER_SYNTAXES)
+    assoc = ae.associate("127.0.0.1", port, ae_title="DICOMSHIELD",
+                         ext_neg=[build_role(sop_class, scp_role=True) for sop_class in SOP_CLASSES],
+                         evt_handlers=[(evt.EVT_C_STORE, handle_store)])
+    assert assoc.is_established
+
+    ds = Dataset()
+    ds.QueryRetrieveLevel = "STUDY"
+    ds.StudyInstanceUID = study_uid
+    if operation == "get":
+        responses = assoc.send_c_get(ds, StudyRootQueryRetrieveInformationModelGet)
+    else:
+        responses = assoc.send_c_move(ds, DESTINATION_AET, StudyRootQueryRetrieveInformationModelMove)
+    final = None
+    for status, _ in responses:
+        if status:
+            final = status
+    assoc.release()
+    return final, received
+
+
+def is_failure(status):
+    return status.Status & 0xF000 in (0xA000, 0xC000)
+
+
+def test_c_get_pseudonymizes_all_instances(shield):
+    port, pacs, _ = shield
+    study_uid, instances = study(pacs)
+
+    final, received = retrieve(port, study_uid, "get")
+
+    assert final.Status == 0x0000
+    assert final.NumberOfCompletedSuboperations == len(instances) == len(received)
+    originals = {ds.SOPInstanceUID for ds in instances}
+    assert {ds.SOPInstanceUID for ds in received} == {make_pseudonym(uid) for uid in originals}
+    assert all(ds.StudyInstanceUID == study_uid and ds.PatientName == "" for ds in received)
+    assert {ds.SOPClassUID for ds in received} == set(SOP_CLASSES)
+
+
+def test_c_get_without_image_level_find(shield):
+    """Without an IMAGE-level C-FIND a single C-GET offering the default storage classes is sent"""
+    port, pacs, _ = shield
+    pacs.image_level = False
+    study_uid, instances = study(pacs)
+
+    final, received = retrieve(port, study_uid, "get")
+
+    assert final.Status == 0x0000
+    assert len(received) == len(instances)
+
+
+def test_c_move_forwards_all_instances(shield):
+    port, pacs, destination = shield
+    study_uid, instances = study(pacs, 1)
+    before = destination.instances
+
+    final, _ = retrieve(port, study_uid, "move")
+
+    assert final.Status == 0x0000
+    assert final.NumberOfCompletedSuboperations == len(instances)
+    assert destination.instances - before == len(instances)
+
+
+@pytest.mark.parametrize("operation", ["get", "move"])
+def test_failed_sub_operations_are_reported(shield, operation):
+    """Instances the upstream fails to deliver make the retrieve end with a warning, not with Success"""
+    port, pacs, _ = shield
+    study_uid, instances = study(pacs)
+    pacs.failing.add(instances[-1].SOPInstanceUID)
+
+    final, _ = retrieve(port, study_uid, operation)
+
+    assert final.Status == 0xB000
+    assert final.NumberOfCompletedSuboperations == len(instances) - 1
+    assert final.NumberOfFailedSuboperations == 1
+
+
+@pytest.mark.parametrize("operation", ["get", "move"])
+def test_all_sub_operations_failed(shield, operation):
+    port, pacs, _ = shield
+    study_uid, instances = study(pacs)
+    pacs.failing.update(ds.SOPInstanceUID for ds in instances)
+
+    final, received = retrieve(port, study_uid, operation)
+
+    assert is_failure(final)
+    assert not received
+
+
+@pytest.mark.parametrize("operation", ["get", "move"])
+def test_unknown_pseudonym_fails(shield, operation):
+    """An unknown pseudonym is never sent upstream as a placeholder"""
+    port, _, _ = shield
+
+    final, received = retrieve(port, make_pseudonym("unknown study"), operation)
+
+    assert is_failure(final)
+    assert not received
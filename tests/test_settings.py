@@ -0,0 +1,72 @@
+"""Reloading config.yml: reloadable entries apply to the next request, others are reported and ignored"""
+import copy
+import logging
+
+import pytest
+import yaml
+
+from conftest import query
+from mock_gpas import make_pseudonym
+
+
+@pytest.fixture()
+def config_file(settings, tmp_path, monkeypatch):
+    """write(changes) rewrites a copy of the config file with `changes`; the original config is reloaded after the
+    test"""
+    original = copy.deepcopy(settings.config)
+    path = tmp_path / "config.yml"
+    monkeypatch.setattr(settings, "PATH", str(path))
+
+    def write(**changes):
+        config = {**copy.deepcopy(original), **changes}
+        for key in [key for key, value in changes.items() if value is None]:
+            del config[key]
+        path.write_text(yaml.safe_dump(config))
+
+    yield write
+    write()
+    settings.reload()
+    assert settings.config == original
+
+
+def test_reloaded_fields_and_destinations_apply(settings, anonymizer, c_handlers, config_file, caplog):
+    config = settings.config
+    config_file(FIELDS_FOR_PSEUDO=["PatientID", "StudyInstanceUID", "SOPInstanceUID"],
+                FIELDS_FOR_REMOVAL=["PatientName", "PatientBirthDate", "PatientSex"],
+                ALLOWED_AET={"NEW-SCP": {"IP": "10.0.0.7", "PORT": 11113}})
+    caplog.set_level(logging.INFO)
+
+    changed = settings.reload()
+
+    assert sorted(changed) == ["ALLOWED_AET", "FIELDS_FOR_PSEUDO", "FIELDS_FOR_REMOVAL"]
+    assert "Reloaded" in caplog.text and "need a restart" not in caplog.text
+    # Handlers look the destinations up per request in the same dict
+    assert c_handlers.config is config and list(config["ALLOWED_AET"]) == ["NEW-SCP"]
+    assert c_handlers.destination_address(config["ALLOWED_AET"]["NEW-SCP"]) == ("10.0.0.7", 11113)
+    # Anonymizer.configure picked up the field lists
+    assert "SeriesInstanceUID" not in anonymizer.pseudonymize_fields
+    ds = anonymizer.shield_retrieve(query(PatientID="PAT1", SeriesInstanceUID="1.2.3", PatientSex="F"))
+    assert ds.PatientID == make_pseudonym("PAT1")
+    assert ds.SeriesInstanceUID == "1.2.3" and ds.PatientSex == ""
+
+
+def test_other_entries_are_reported_and_ignored(settings, config_file, caplog):
+    config = settings.config
+    ingress = copy.deepcopy(config["INGRESS"])
+    config_file(INGRESS={"AET": "RENAMED", "PORT": 1}, MAX_PARALLEL_FINDS=2, DICOMWEB=None)
+
+    changed = settings.reload()
+
+    assert changed == ["MAX_PARALLEL_FINDS"]
+    assert config["MAX_PARALLEL_FINDS"] == 2
+    assert config["INGRESS"] == ingress and "DICOMWEB" in config
+    assert "Changes to DICOMWEB, INGRESS need a restart" in caplog.text
+
+
+def test_broken_file_keeps_the_config(settings, config_file, tmp_path, caplog):
+    config = copy.deepcopy(settings.config)
+    (tmp_path / "config.yml").write_text("ALLOWED_AET: [unclosed")
+
+    assert settings.reload() == []
+    assert settings.config == config
+    assert "keeping the current config" in caplog.text
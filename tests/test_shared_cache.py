@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DicomShield", "proxy"))
+
+from shared_cache import BUCKET_SLOTS, SharedPseudonymCache
+
+
+def test_get_both_directions(tmp_path):
+    """Pairs are found by original and by pseudonym, unknown values are reported as missing"""
+    cache = SharedPseudonymCache(str(tmp_path / "cache"), 100)
+    cache.add({"PAT1": "PSN1", "PAT2": "PSN2"})
+
+    assert cache.get_pseudonyms(["PAT1", "PAT3"]) == ({"PAT1": "PSN1"}, ["PAT3"])
+    assert cache.get_originals(["PSN2", "PSN3"]) == ({"PSN2": "PAT2"}, ["PSN3"])
+
+
+def test_evicts_least_recently_used(tmp_path):
+    """A full bucket replaces its least recently used entry"""
+    cache = SharedPseudonymCache(str(tmp_path / "cache"), BUCKET_SLOTS)  # a single bucket
+    for i in range(BUCKET_SLOTS):
+        cache.add({f"PAT{i}": f"PSN{i}"})
+        time.sleep(0.002)
+    cache.get_pseudonyms(["PAT0"])
+    time.sleep(0.002)
+
+    cache.add({"PAT-NEW": "PSN-NEW"})
+
+    found, missing = cache.get_pseudonyms([f"PAT{i}" for i in range(BUCKET_SLOTS)] + ["PAT-NEW"])
+    assert missing == ["PAT1"]
+    assert found["PAT0"] == "PSN0" and found["PAT-NEW"] == "PSN-NEW"
+
+
+def test_values_longer_than_64_bytes_are_not_cached(tmp_path):
+    cache = SharedPseudonymCache(str(tmp_path / "cache"), 100)
+    cache.add({"X" * 65: "PSN1"})
+
+    assert cache.get_originals(["PSN1"]) == ({}, ["PSN1"])
+
+
+def _add_in_child(cache):
+    cache.add({"PAT-CHILD": "PSN-CHILD"})
+
+
+def test_forked_workers_share_entries():
+    """An entry added by a worker process is a hit for its parent and siblings"""
+    cache = SharedPseudonymCache(max_size=100)
+    child = get_context("fork").Process(target=_add_in_child, args=(cache,))
+    child.start()
+    child.join(10)
+
+    assert child.exitcode == 0
+    assert cache.get_originals(["PSN-CHILD"]) == ({"PSN-CHILD": "PAT-CHILD"}, [])
+
+
+def test_file_is_reused_for_the_same_domain(tmp_path):
+    path = str(tmp_path / "cache")
+    first = SharedPseudonymCache(path, 100, "gPAS\0http://gpas\0DOMAIN-A")
+    first.add({"PAT1": "PSN1"})
+
+    second = SharedPseudonymCache(path, 100, "gPAS\0http://gpas\0DOMAIN-A")
+
+    assert first.created and not second.created
+    assert second.get_pseudonyms(["PAT1"]) == ({"PAT1": "PSN1"}, [])
+
+
+def test_file_of_another_domain_is_cleared(tmp_path):
+    """Pseudonyms of another domain must never be handed out"""
+    path = str(tmp_path / "cache")
+    SharedPseudonymCache(path, 100, "gPAS\0http://gpas\0DOMAIN-A").add({"PAT1": "PSN1"})
+
+    other = SharedPseudonymCache(path, 100, "gPAS\0http://gpas\0DOMAIN-B")
+
+    assert other.created
+    assert other.get_pseudonyms(["PAT1"]) == ({}, ["PAT1"])
+    assert other.get_originals(["PSN1"]) == ({}, ["PSN1"])
+
+
+def test_file_with_another_size_is_cleared(tmp_path):
+    path = str(tmp_path / "cache")
+    SharedPseudonymCache(path, 100).add({"PAT1": "PSN1"})
+
+    other = SharedPseudonymCache(path, 200)
+
+    assert other.created
+    assert other.get_pseudonyms(["PAT1"]) == ({}, ["PAT1"])
+
+
+def test_clearing_keeps_the_file_of_other_processes_mapped(tmp_path):
+    """A larger file is cleared in place, never shrunk under the mapping of a process that still uses it"""
+    path = str(tmp_path / "cache")
+    first = SharedPseudonymCache(path, 1000, "gPAS\0http://gpas\0DOMAIN-A")
+    first.add({"PAT1": "PSN1"})
+    size = os.path.getsize(path)
+
+    other = SharedPseudonymCache(path, 100, "gPAS\0http://gpas\0DOMAIN-B")
+
+    assert other.created and os.path.getsize(path) == size
+    assert first.get_pseudonyms(["PAT1"]) == ({}, ["PAT1"])  # No SIGBUS and nothing left of the old domain
+    first.add({"PAT2": "PSN2"})
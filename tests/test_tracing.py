@@ -0,0 +1,69 @@
+"""Traces of DicomShield, started as a subprocess against the mock PACS and mock gPAS of the benchmark"""
+import json
+import re
+import time
+
+import pytest
+
+from benchmark import LoadGenerator, Shield
+from conftest import shield_config
+
+
+@pytest.fixture(scope="module")
+def traced_shield(mock_upstreams, tmp_path_factory):
+    """(ingress port, trace file) of DicomShield exporting its spans to a file"""
+    config = shield_config(*mock_upstreams)
+    config["TRACING"] = {"FILE": "traces.jsonl"}
+    workdir = tmp_path_factory.mktemp("shield-tracing")
+    shield = Shield(str(workdir), config)
+    shield.start()
+    yield config["INGRESS"]["PORT"], workdir / "traces.jsonl"
+    shield.stop()
+
+
+def exported_spans(path, timeout=10):
+    """The spans of the OTLP/JSON batches in `path`, once the exporter wrote some"""
+    deadline = time.monotonic() + timeout
+    while not path.exists() or not path.read_text().strip():
+        assert time.monotonic() < deadline, "no spans were exported"
+        time.sleep(0.1)
+    time.sleep(0.5)  # the rest of the batch
+
+    spans = []
+    for line in path.read_text().splitlines():
+        for resource_spans in json.loads(line)["resourceSpans"]:
+            assert {"key": "service.name", "value": {"stringValue": "dicomshield"}} in \
+                resource_spans["resource"]["attributes"]
+            for scope_spans in resource_spans["scopeSpans"]:
+                spans.extend(scope_spans["spans"])
+    return spans
+
+
+def test_c_find_exports_one_trace(traced_shield):
+    port, path = traced_shield
+
+    assert len(LoadGenerator("127.0.0.1", port, "DICOMSHIELD").find_studies()) == 2
+
+    spans = exported_spans(path)
+    by_id = {span["spanId"]: span for span in spans}
+    for span in spans:
+        assert re.fullmatch("[0-9a-f]{32}", span["traceId"]) and re.fullmatch("[0-9a-f]{16}", span["spanId"])
+        assert int(span["startTimeUnixNano"]) <= int(span["endTimeUnixNano"])
+        assert span["status"] == {"code": 1}
+        assert span.get("parentSpanId") is None or span["parentSpanId"] in by_id
+
+    assert len({span["traceId"] for span in spans}) == 1
+    [root] = [span for span in spans if "parentSpanId" not in span]
+    assert root["name"] == "C-FIND" and root["kind"] == 2  # server
+
+    def ancestors(span):
+        while "parentSpanId" in span:
+            span = by_id[span["parentSpanId"]]
+            yield span
+
+    names = {span["name"] for span in spans}
+    assert {"upstream.C-FIND", "pseudonymize"} <= names
+    for span in spans:
+        if span["name"] in ("upstream.C-FIND", "pseudonymize"):
+            assert span["kind"] == 3  # client
+            assert root in ancestors(span)
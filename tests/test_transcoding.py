@@ -0,0 +1,84 @@
+"""COMPRESS policies of move destinations, with DicomShield started as a subprocess against the mock PACS"""
+import threading
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.uid import DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian, RLELossless
+from pynetdicom import AE, AllStoragePresentationContexts, evt
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelMove
+
+from benchmark import DESTINATION_AET, SCU_AET, LoadGenerator, Shield, free_port
+from conftest import shield_config
+from mock_gpas import make_pseudonym
+
+
+class ReceivingDestination:
+    """Store SCP accepting `transfer_syntaxes`, keeping the received instances with their transfer syntax"""
+
+    def __init__(self, transfer_syntaxes):
+        self.port = free_port()
+        self.received = []
+        self._lock = threading.Lock()
+        ae = AE(ae_title=DESTINATION_AET)
+        for context in AllStoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax, transfer_syntaxes)
+        self.server = ae.start_server(("127.0.0.1", self.port), block=False,
+                                      evt_handlers=[(evt.EVT_C_STORE, self._handle_store)])
+
+    def _handle_store(self, event):
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+        with self._lock:
+            self.received.append(ds)
+        return 0x0000
+
+
+UNCOMPRESSED = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+
+
+@pytest.mark.parametrize("policy, accepted, mode, expected", [
+    ("rle", UNCOMPRESSED + [RLELossless], "MOVE", RLELossless),
+    ("rle", UNCOMPRESSED + [RLELossless], "GET", RLELossless),
+    ("deflate", UNCOMPRESSED + [DeflatedExplicitVRLittleEndian], "MOVE", DeflatedExplicitVRLittleEndian),
+    ("rle", UNCOMPRESSED, "MOVE", ExplicitVRLittleEndian),
+    (None, UNCOMPRESSED + [RLELossless], "MOVE", ExplicitVRLittleEndian),
+], ids=["rle", "rle-via-get", "deflate", "rle-not-accepted", "no-policy"])
+def test_instances_arrive_compressed_losslessly(mock_upstreams, tmp_path_factory, policy, accepted, mode, expected):
+    gpas, pacs = mock_upstreams
+    destination = ReceivingDestination(accepted)
+    config = shield_config(gpas, pacs, destination=destination.port)
+    config["RETRIEVE_MODE"] = mode
+    config["ALLOWED_AET"][DESTINATION_AET]["COMPRESS"] = policy
+    pacs.move_destinations = {"DICOMSHIELD-PACS": ("127.0.0.1", config["C_STORE_ENDPOINT"]["PORT"])}
+    shield = Shield(str(tmp_path_factory.mktemp(f"shield-{policy}")), config)
+    shield.start()
+    study_uid = pacs.datasets[0].StudyInstanceUID
+    instances = [ds for ds in pacs.datasets if ds.StudyInstanceUID == study_uid]
+    try:
+        port = config["INGRESS"]["PORT"]
+        assert len(LoadGenerator("127.0.0.1", port, "DICOMSHIELD").find_studies()) == 2
+        ae = AE(ae_title=SCU_AET)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelMove)
+        assoc = ae.associate("127.0.0.1", port, ae_title="DICOMSHIELD")
+        ds = Dataset()
+        ds.QueryRetrieveLevel = "STUDY"
+        ds.StudyInstanceUID = make_pseudonym(study_uid)
+        statuses = [status.Status for status, _ in
+                    assoc.send_c_move(ds, DESTINATION_AET, StudyRootQueryRetrieveInformationModelMove) if status]
+        assoc.release()
+    finally:
+        shield.stop()
+        destination.server.shutdown()
+        pacs.move_destinations = {}
+
+    assert statuses[-1] == 0x0000
+    assert len(destination.received) == len(instances)
+    pixels = np.frombuffer(instances[0].PixelData, "<u2").reshape(instances[0].Rows, instances[0].Columns)
+    for received in destination.received:
+        assert received.file_meta.TransferSyntaxUID == expected
+        if expected == RLELossless:
+            assert len(received.PixelData) < len(instances[0].PixelData)
+            assert np.array_equal(received.pixel_array, pixels)
+        else:
+            assert received.PixelData == instances[0].PixelData
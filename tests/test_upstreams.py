@@ -0,0 +1,97 @@
+"""The fan-out over several upstreams, against two mock PACS sharing one of their studies"""
+import pytest
+from pynetdicom import AE, build_context
+from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
+
+from benchmark import free_port
+from conftest import query
+from mock_gpas import make_pseudonym
+from mock_pacs import MockPACS, create_studies
+
+FIND_CONTEXT = build_context(StudyRootQueryRetrieveInformationModelFind)
+
+
+@pytest.fixture(scope="module")
+def studies():
+    """The instances of three studies, each of them a list"""
+    datasets = create_studies(3, 1, 2, 16, 16)
+    uids = list(dict.fromkeys(ds.StudyInstanceUID for ds in datasets))
+    return [[ds for ds in datasets if ds.StudyInstanceUID == uid] for uid in uids]
+
+
+@pytest.fixture(scope="module")
+def two_pacs(studies):
+    """Mock PACS "a" holding studies 0 and 1, "b" holding 0 and 2"""
+    pacs = {"a": MockPACS(studies[0] + studies[1], free_port()), "b": MockPACS(studies[0] + studies[2], free_port())}
+    for upstream in pacs.values():
+        upstream.start()
+    yield pacs
+    for upstream in pacs.values():
+        upstream.stop()
+
+
+@pytest.fixture()
+def configured(upstreams, two_pacs, monkeypatch):
+    """Both mock PACS as the UPSTREAMS, with an empty location index"""
+    targets = [upstreams.Upstream(name, "127.0.0.1", pacs.port, pacs.ae_title) for name, pacs in two_pacs.items()]
+    monkeypatch.setattr(upstreams, "upstreams", targets)
+    monkeypatch.setattr(upstreams, "primary", targets[0])
+    monkeypatch.setattr(upstreams, "location_index", upstreams.LocationIndex())
+    return targets
+
+
+def study_uids(studies, *indexes):
+    return [studies[index][0].StudyInstanceUID for index in indexes]
+
+
+def test_results_held_by_both_upstreams_are_returned_once(c_handlers, cancellation, configured, studies):
+    results = c_handlers.fan_out_find(query(PatientID="", StudyInstanceUID=""), FIND_CONTEXT)
+    found = [ds.StudyInstanceUID
+             for ds in c_handlers.pseudonymized_results(results, "STUDY", cancellation.Cancellation())]
+
+    assert results.succeeded
+    assert sorted(found) == sorted(make_pseudonym(uid) for uid in study_uids(studies, 0, 1, 2))
+
+
+def test_retrieve_is_routed_to_the_upstream_that_answered(c_handlers, upstreams, configured, studies):
+    a, b = configured
+    study_0, study_1, study_2 = study_uids(studies, 0, 1, 2)
+
+    # Unknown studies are located with a C-FIND at all upstreams, which fills the index
+    assert c_handlers.locate(query(StudyInstanceUID=study_2), FIND_CONTEXT) is b
+    assert c_handlers.locate(query(StudyInstanceUID=study_1), FIND_CONTEXT) is a
+    assert c_handlers.locate(query(StudyInstanceUID=study_0), FIND_CONTEXT) is a  # The first one holding it
+    assert sorted(upstreams.location_index.lookup(query(StudyInstanceUID=study_0))) == ["a", "b"]
+
+    instances = c_handlers.find_instances(query(StudyInstanceUID=study_2), FIND_CONTEXT, upstream=b)
+    assert sorted(instance[2] for instance in instances) == sorted(ds.SOPInstanceUID for ds in studies[2])
+
+
+def test_dead_upstream_is_skipped(c_handlers, upstreams, configured, studies, monkeypatch):
+    dead = upstreams.Upstream("dead", "127.0.0.1", free_port())
+    monkeypatch.setattr(upstreams, "upstreams", [dead, configured[0]])
+
+    results = c_handlers.fan_out_find(query(PatientID="", StudyInstanceUID=""), FIND_CONTEXT)
+    found = [identifier.StudyInstanceUID for _, identifier in results]
+
+    assert results.succeeded
+    assert sorted(found) == sorted(study_uids(studies, 0, 1))
+
+
+def test_max_associations_exhausted(c_handlers, upstreams, two_pacs):
+    upstream = upstreams.Upstream("a", "127.0.0.1", two_pacs["a"].port, two_pacs["a"].ae_title,
+                                  max_associations=1, timeout=0.2)
+    ae = AE("DICOMSHIELD")
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+
+    assoc = upstream.associate(ae, [], [])
+    assert assoc.is_established
+    with pytest.raises(upstreams.UpstreamBusy):
+        upstream.associate(ae, [], [])
+    # handle_event gives up on the query instead of waiting any longer
+    assert c_handlers.handle_event(query(StudyInstanceUID=""), FIND_CONTEXT, upstream=upstream) is None
+
+    assoc.release()
+    assoc = upstream.associate(ae, [], [])  # The slot is free again once the connection closed
+    assert assoc.is_established
+    assoc.release()
@@ -0,0 +1,172 @@
+"""The worker processes: the C-MOVE hand-over between them and their supervision"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+import yaml
+from pydicom import dcmwrite
+
+from benchmark import SHIELD_DIR
+from mock_pacs import create_studies
+
+
+@pytest.fixture()
+def two_workers(workers, tmp_path, monkeypatch):
+    """workers configured as worker 0 of 2, with its sockets in `tmp_path`"""
+    monkeypatch.setattr(workers, "count", 2)
+    monkeypatch.setattr(workers, "index", 0)
+    monkeypatch.setattr(workers, "socket_dir", str(tmp_path))
+    monkeypatch.setattr(workers, "_listeners", {})
+    return workers
+
+
+def test_move_message_id_identifies_the_worker(workers, monkeypatch):
+    monkeypatch.setattr(workers, "count", 3)
+    for index in range(3):
+        monkeypatch.setattr(workers, "index", index)
+        msg_ids = [workers.move_message_id(sequence) for sequence in range(0, 70000, 7)]
+
+        assert all(1 <= msg_id <= 65535 and workers.owner(msg_id) == index for msg_id in msg_ids)
+        # Consecutive C-MOVEs of a worker get distinct IDs until they wrap around
+        assert len({workers.move_message_id(sequence) for sequence in range(65535 // 3)}) == 65535 // 3
+
+
+def serve_as_worker(workers, monkeypatch, worker, store):
+    """Serves the hand-over socket of `worker`, the calling test stays worker 0"""
+    monkeypatch.setattr(workers, "index", worker)
+    server = workers.serve_hand_overs(store)
+    monkeypatch.setattr(workers, "index", 0)
+    return server
+
+
+def test_hand_over_to_the_owning_worker(two_workers, monkeypatch):
+    workers = two_workers
+    received = []
+
+    def store(msg_id, ds):
+        received.append((msg_id, ds))
+        return 0x0000
+
+    server = serve_as_worker(workers, monkeypatch, 1, store)
+    try:
+        [ds] = create_studies(1, 1, 1, 4, 4)
+        encoded = BytesIO()
+        dcmwrite(encoded, ds, write_like_original=False)
+        msg_id = 8  # issued by worker 1
+        assert workers.owner(msg_id) == 1
+
+        status = workers.hand_over(msg_id, SimpleNamespace(encoded_dataset=lambda: encoded.getvalue()))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert status == 0x0000
+    [(received_msg_id, received_ds)] = received
+    assert received_msg_id == msg_id
+    assert received_ds.SOPInstanceUID == ds.SOPInstanceUID and received_ds.PixelData == ds.PixelData
+
+
+def test_hand_over_to_a_missing_worker_fails(two_workers):
+    event = SimpleNamespace(encoded_dataset=lambda: b"")
+
+    assert two_workers.hand_over(2, event) == 0xA700  # Out of resources
+
+
+def test_health_check_fails_once_a_listener_stopped(two_workers, monkeypatch):
+    workers = two_workers
+    server = serve_as_worker(workers, monkeypatch, 1, lambda msg_id, ds: 0x0000)
+    try:
+        assert workers.check_health(1)
+        assert not workers.check_health(0)  # Not serving at all
+
+        listener = threading.Thread(target=lambda: None)
+        listener.start()
+        listener.join()
+        workers.listening("ingress", listener)
+
+        assert not workers.check_health(1)
+        assert workers.stopped_listeners() == ["ingress"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+SUPERVISOR = """
+import os, sys, threading, time
+sys.path.insert(0, {shield_dir!r})
+import workers
+
+workers.count = 2
+workers.HEALTH_CHECK_INTERVAL = 0.2
+workers.HEALTH_TIMEOUT = 1
+
+
+def listen():
+    while not os.path.exists(f"stop-{{os.getpid()}}"):
+        time.sleep(0.05)
+
+
+def run_worker():
+    workers.serve_hand_overs(lambda msg_id, ds: 0x0000)
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+    workers.listening("test listener", listener)
+    with open(f"worker-{{workers.index}}.pid", "w") as f:
+        f.write(str(os.getpid()))
+    while True:
+        time.sleep(1)
+
+
+workers.supervise(run_worker)
+"""
+
+
+def worker_pid(directory, worker, other_than=None, timeout=10):
+    """The pid of `worker` once it is running, other than `other_than`"""
+    path = directory / f"worker-{worker}.pid"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pid = int(path.read_text() or 0) if path.exists() else 0
+        if pid and pid != other_than:
+            return pid
+        time.sleep(0.05)
+    raise AssertionError(f"worker {worker} was not (re)started")
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split()[2] != "Z"
+
+
+def test_supervise_restarts_dead_and_unhealthy_workers(proxy_config, tmp_path):
+    os.makedirs(tmp_path / "configs")
+    with open(tmp_path / "configs" / "config.yml", "w") as f:
+        yaml.safe_dump({**proxy_config, "WORKER_SOCKET_DIR": str(tmp_path)}, f)
+    (tmp_path / "supervisor.py").write_text(SUPERVISOR.format(shield_dir=SHIELD_DIR))
+    with open(tmp_path / "supervisor.log", "w") as log:
+        supervisor = subprocess.Popen([sys.executable, "supervisor.py"], cwd=tmp_path, stdout=log, stderr=log)
+    try:
+        first, second = worker_pid(tmp_path, 0), worker_pid(tmp_path, 1)
+
+        os.kill(first, signal.SIGKILL)
+        restarted = worker_pid(tmp_path, 0, other_than=first)
+
+        (tmp_path / f"stop-{second}").touch()  # Its listener stops, the process keeps running
+        replaced = worker_pid(tmp_path, 1, other_than=second)
+        assert not is_running(second)
+    finally:
+        supervisor.send_signal(signal.SIGTERM)
+        assert supervisor.wait(10) == 0
+
+    assert not is_running(restarted) and not is_running(replaced)
+    assert "failed its health checks" in (tmp_path / "supervisor.log").read_text()